@@ -21,6 +21,8 @@ main ()
       ;;
     logharvest) autocms_logharvest
       ;;
+    logharvestall) autocms_logharvestall
+      ;;
     report) autocms_report
       ;;
     statsharvest) autocms_statsharvest
@@ -133,6 +135,12 @@ autocms_logharvest ()
   fi
 }
 
+autocms_logharvestall ()
+{
+  python logharvester.py --all
+  exit $?
+}
+
 autocms_statsharvest ()
 {
   if [ -d "${AUTOCMS_BASEDIR}/${commandline_args[1]}" ]; then
@@ -155,15 +163,22 @@ print_autocms_crontab ()
   SUBWAIT=( $( echo $AUTOCMS_TEST_SUBWAITS | tr ":" " " ) )
   SUBCOUNT=( $( echo $AUTOCMS_TEST_SUBCOUNTS | tr ":" " " ) )
   COUNT=0
+  if [[ $AUTOCMS_COMBINED_HARVEST = 1 ]]; then
+    echo "0,10,20,30,40,50 * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh logharvestall" >> autocms.crontab
+  fi
   for TESTNAME in $( echo $AUTOCMS_TEST_NAMES | tr ":" "\n" ); do
     if [ ${SUBWAIT[$COUNT]} -lt 60 ]; then
       echo "*/${SUBWAIT[$COUNT]} * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh submit $TESTNAME ${SUBCOUNT[$COUNT]}"  >> autocms.crontab
-      echo "0,10,20,30,40,50 * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh logharvest $TESTNAME" >> autocms.crontab
+      if [[ $AUTOCMS_COMBINED_HARVEST != 1 ]]; then
+        echo "0,10,20,30,40,50 * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh logharvest $TESTNAME" >> autocms.crontab
+      fi
       echo "5,15,25,35,45,55 * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh report $TESTNAME" >> autocms.crontab
     else
       SUBWAIT[$COUNT]=$(( ${SUBWAIT[$COUNT]} / 60 )) 
       echo "0 */${SUBWAIT[$COUNT]} * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh submit $TESTNAME ${SUBCOUNT[$COUNT]}"  >> autocms.crontab
-      echo "10,40 * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh logharvest $TESTNAME" >> autocms.crontab
+      if [[ $AUTOCMS_COMBINED_HARVEST != 1 ]]; then
+        echo "10,40 * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh logharvest $TESTNAME" >> autocms.crontab
+      fi
       echo "20,50 * * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh report $TESTNAME" >> autocms.crontab
     fi
     echo "57 */${AUTOCMS_STAT_INTERVAL} * * * cd $AUTOCMS_BASEDIR && $AUTOCMS_BASEDIR/autocms.sh statsharvest $TESTNAME" >> autocms.crontab 
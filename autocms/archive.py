@@ -0,0 +1,122 @@
+"""Long term archive of JobRecords purged from the tracked records.
+
+Jobs older than AUTOCMS_LOG_LIFETIME are removed from the records
+that are loaded on every harvest and report. Instead of being
+discarded, they are appended to per-day segments in the 'archive'
+directory of the test, named 'records.YYYYMMDD.pickle.gz' by the
+(UTC) day of submission.
+
+Each segment is a gzip file of concatenated members, each holding one
+pickled list of JobRecords, so archiving only appends the newly expired
+jobs and never rewrites a segment. Queries only open the segments of
+the days they cover. A job archived again, because a harvest was
+interrupted after archiving it but before saving the records, is
+returned once.
+"""
+
+import os
+import re
+import gzip
+import time
+import cPickle as pickle
+
+from .core import (
+    day_key,
+    day_start,
+    record_key
+)
+
+
+def archive_dir(testname, config):
+    """Return the archive directory of a test."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], testname, 'archive')
+
+
+def list_archive_segments(testname, config):
+    """Return a sorted list of (day, path) tuples of archive segments."""
+    adir = archive_dir(testname, config)
+    if not os.path.isdir(adir):
+        return []
+    segments = []
+    for item in os.listdir(adir):
+        match = re.match(r'^records\.([0-9]{8})\.pickle\.gz$', item)
+        if match:
+            segments.append((match.group(1), os.path.join(adir, item)))
+    return sorted(segments)
+
+
+def archive_records(records, testname, config):
+    """Append JobRecords to the archive segments of their submission day."""
+    if not records:
+        return
+    adir = archive_dir(testname, config)
+    if not os.path.isdir(adir):
+        os.makedirs(adir)
+    days = dict()
+    for job in records:
+        days.setdefault(day_key(job.submit_time), []).append(job)
+    for key, jobs in days.iteritems():
+        path = os.path.join(adir, 'records.{0}.pickle.gz'.format(key))
+        with open(path, 'ab') as handle:
+            archive = gzip.GzipFile(fileobj=handle, mode='wb')
+            pickle.dump(jobs, archive, pickle.HIGHEST_PROTOCOL)
+            archive.close()
+
+
+def read_archive_segment(path):
+    """Return the list of JobRecords stored in one archive segment.
+
+    A job archived more than once is returned once, as last archived.
+    All copies of a job are in the same segment, the one of its
+    submission day."""
+    records = []
+    positions = dict()
+    archive = gzip.open(path, 'rb')
+    try:
+        while True:
+            try:
+                jobs = pickle.load(archive)
+            except EOFError:
+                break
+            for job in jobs:
+                key = record_key(job)
+                if key in positions:
+                    records[positions[key]] = job
+                else:
+                    positions[key] = len(records)
+                    records.append(job)
+    finally:
+        archive.close()
+    return records
+
+
+def iter_archived_records(testname, config, start=None, end=None):
+    """Yield archived JobRecords submitted in [start, end).
+
+    Either limit may be None. Only the segments of days overlapping
+    the interval are read, one at a time."""
+    for key, path in list_archive_segments(testname, config):
+        if end is not None and day_start(key) >= end:
+            continue
+        if start is not None and day_start(key) + 24*3600 <= start:
+            continue
+        for job in read_archive_segment(path):
+            if start is not None and job.submit_time < start:
+                continue
+            if end is not None and job.submit_time >= end:
+                continue
+            yield job
+
+
+def purge_old_archive_segments(testname, config):
+    """Remove archive segments older than AUTOCMS_ARCHIVE_LIFETIME days.
+
+    The archive is kept forever if AUTOCMS_ARCHIVE_LIFETIME is not
+    configured."""
+    if 'AUTOCMS_ARCHIVE_LIFETIME' not in config:
+        return
+    lifetime = int(config['AUTOCMS_ARCHIVE_LIFETIME'])
+    purgetime = int(time.time()) - 3600*24*lifetime
+    for key, path in list_archive_segments(testname, config):
+        if day_start(key) + 24*3600 <= purgetime:
+            os.remove(path)
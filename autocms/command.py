@@ -0,0 +1,171 @@
+"""Execution of scheduler commands with timeouts and latency metrics.
+
+Every scheduler command goes through run_command, which executes the
+argument list directly without a shell and kills the command if it
+runs longer than its timeout. The timeout of a command is taken from
+AUTOCMS_<NAME>_TIMEOUT, e.g. AUTOCMS_SQUEUE_TIMEOUT, or else from
+AUTOCMS_COMMAND_TIMEOUT (60 seconds by default).
+
+The latency of each command is added to a histogram per command name
+kept as JSON in 'command.metrics' in AUTOCMS_BASEDIR, together with the
+number of calls, failures, and timeouts. The histograms are shown in
+the test webpage (see autocms.web).
+"""
+
+import os
+import json
+import time
+import errno
+import fcntl
+import threading
+import subprocess
+from collections import namedtuple
+
+
+# upper bounds in seconds of the latency histogram buckets, the last
+# bucket holds everything slower
+latency_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+CommandResult = namedtuple('CommandResult', ['argv', 'returncode', 'output',
+                                             'latency', 'timed_out'])
+
+
+class CommandFailed(Exception):
+    """Exception for a command whose output can not be used."""
+    def __init__(self, message, result=None):
+        super(CommandFailed, self).__init__(message)
+        self.message = message
+        self.result = result
+
+    def __str__(self):
+        return repr(self.message)
+
+
+def command_name(argv):
+    """Return the name metrics and timeouts of a command are kept under."""
+    return os.path.basename(argv[0])
+
+
+def command_timeout(name, config):
+    """Return the timeout in seconds of the named command."""
+    key = 'AUTOCMS_{0}_TIMEOUT'.format(name.upper())
+    return float(config.get(key, config.get('AUTOCMS_COMMAND_TIMEOUT', 60)))
+
+
+def metrics_path(config):
+    """Return the path of the command metrics file."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], 'command.metrics')
+
+
+def run_command(argv, config, cwd=None, env=None, merge_stderr=False):
+    """Run a command, return a CommandResult.
+
+    Standard output is returned, and standard error as well if
+    merge_stderr is set; otherwise standard error is passed through.
+    A command exceeding its timeout is killed and its output ends with
+    a line saying it timed out. A command that can not be executed has
+    return code 127 and the reason as output."""
+    name = command_name(argv)
+    timeout = command_timeout(name, config)
+    start = time.time()
+    try:
+        proc = subprocess.Popen(argv, cwd=cwd, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=(subprocess.STDOUT if merge_stderr
+                                        else None),
+                                close_fds=True)
+    except OSError as err:
+        result = CommandResult(argv, 127, '{0}: {1}\n'.format(name,
+                                                              err.strerror),
+                               time.time() - start, False)
+        record_command_latency(result, config)
+        return result
+    expired = []
+
+    def kill():
+        """Kill the command when the timeout expires."""
+        expired.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output = proc.communicate()[0]
+    finally:
+        timer.cancel()
+    timed_out = bool(expired) and proc.returncode != 0
+    if timed_out:
+        output += '{0} timed out after {1:g} seconds\n'.format(name, timeout)
+    result = CommandResult(argv, proc.returncode, output,
+                           time.time() - start, timed_out)
+    record_command_latency(result, config)
+    return result
+
+
+def check_command(argv, config, **kwargs):
+    """Run a command, return its output or raise CommandFailed."""
+    result = run_command(argv, config, **kwargs)
+    if result.returncode != 0:
+        message = '{0} failed with exit code {1}'.format(command_name(argv),
+                                                         result.returncode)
+        if result.output.strip():
+            message += ': ' + result.output.strip()
+        raise CommandFailed(message, result)
+    return result.output
+
+
+def _empty_metrics():
+    """Return the metrics of a command that has not run."""
+    return {'calls': 0, 'failures': 0, 'timeouts': 0, 'total': 0.0,
+            'max': 0.0, 'buckets': [0] * (len(latency_buckets) + 1)}
+
+
+def _bucket(latency):
+    """Return the index of the histogram bucket of a latency."""
+    for index, bound in enumerate(latency_buckets):
+        if latency <= bound:
+            return index
+    return len(latency_buckets)
+
+
+def record_command_latency(result, config):
+    """Add the latency of a CommandResult to the metrics file.
+
+    Concurrent AutoCMS processes update the file under a lock."""
+    path = metrics_path(config)
+    with open(path, 'a+') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        handle.seek(0)
+        try:
+            metrics = json.load(handle)
+        except ValueError:
+            metrics = dict()
+        name = command_name(result.argv)
+        entry = metrics.setdefault(name, _empty_metrics())
+        entry['calls'] += 1
+        entry['failures'] += result.returncode != 0
+        entry['timeouts'] += result.timed_out
+        entry['total'] += result.latency
+        entry['max'] = max(entry['max'], result.latency)
+        entry['buckets'][_bucket(result.latency)] += 1
+        handle.seek(0)
+        handle.truncate()
+        json.dump(metrics, handle, sort_keys=True)
+
+
+def load_command_metrics(config):
+    """Return the dict of metrics by command name, empty if none."""
+    try:
+        with open(metrics_path(config)) as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH)
+            return json.load(handle)
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return dict()
+        raise
+    except ValueError:
+        return dict()
@@ -4,8 +4,22 @@ __version__ = '3.0.4'
 
 import re
 import os
+import json
+import gzip
+import time
+import calendar
+import operator
+import sqlite3
 import cPickle as pickle
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 class JobRecord(object):
     """Complete information about a specific AutoCMS test job.
@@ -33,8 +47,30 @@ class JobRecord(object):
         completed (boolean): completion status of the job.
         exit_code (int): exit code returned by the job script
         exit_string: string describing the reason for job failure.
+
+    The following resource usage attributes are None unless reported by
+    the scheduler when the job completed (see apply_completion):
+
+        max_rss (int): peak resident memory of the job in bytes.
+        total_cpu (float): user and system CPU time of the job in seconds.
+        disk_read (int): bytes read from disk by the job.
+        disk_write (int): bytes written to disk by the job.
+        elapsed (float): wall clock time of the job in seconds.
+
+    Values of any other AUTOCMS_*_TOKEN found in the log are kept in the
+    tokens dictionary, and may also be read as attributes of the record.
+    The guaranteed attributes are stored in __slots__ so that records do
+    not each carry an instance dictionary.
     """
 
+    fields = ('seq', 'jobid', 'submit_time', 'submit_status',
+              'start_time', 'end_time', 'node', 'exit_code',
+              'error_string', 'completed', 'logfile')
+    usage_fields = ('max_rss', 'total_cpu', 'disk_read', 'disk_write',
+                    'elapsed')
+    __slots__ = fields + usage_fields + ('tokens',)
+    _slot_values = operator.attrgetter(*__slots__)
+
     def __init__(self, counter, jobid, subtime, retval, log):
         """Construct JobRecord object from job submission information.
 
@@ -50,6 +86,9 @@ class JobRecord(object):
         self.jobid = jobid
         self.submit_status = int(retval)
         self.logfile = log
+        self.tokens = dict()
+        for attr in self.usage_fields:
+            setattr(self, attr, None)
         if self.submit_status == 0:
             self.node = None
             self.start_time = 0
@@ -108,6 +147,12 @@ class JobRecord(object):
         else:
             return False
 
+    def cpu_efficiency(self):
+        """Return CPU time divided by wall clock time, None if unknown."""
+        if self.total_cpu is None or not self.elapsed:
+            return None
+        return self.total_cpu / float(self.elapsed)
+
     def is_retry(self):
         """Return boolean job retry status."""
         if self.jobid == 1:
@@ -115,29 +160,53 @@ class JobRecord(object):
         else:
             return False
 
-    def parse_output(self, testname, config):
-        """Parse job information from the log file."""
-        tokens = [s for s in config.keys()
-                  if re.match(r'AUTOCMS_.*_TOKEN', s)]
+    def parse_output(self, testname, config, matcher=None):
+        """Parse job information from the job summary or log file.
+
+        If the job wrote a summary file next to its log (see
+        summary_path) only the tokens in the summary are used, otherwise
+        the log is scanned for tokens. A TokenMatcher built from config
+        may be passed to avoid looking it up for every job."""
         logpath = os.path.join(config['AUTOCMS_BASEDIR'],
                                testname,
                                self.logfile)
+        self.apply_tokens(read_job_tokens(logpath, config, matcher))
+
+    def apply_completion(self, completion):
+        """Set job information reported by the scheduler.
+
+        The start and end times, node, a nonzero exit code, and the
+        resource usage of a JobCompletion (see autocms.scheduler) are
+        used where known. Tokens applied afterwards take precedence."""
+        if completion.start_time is not None:
+            self.start_time = completion.start_time
+        if completion.end_time is not None:
+            self.end_time = completion.end_time
+        if completion.node is not None:
+            self.node = completion.node
+        if completion.exit_code:
+            self.exit_code = completion.exit_code
+        for attr in self.usage_fields:
+            if getattr(completion, attr) is not None:
+                setattr(self, attr, getattr(completion, attr))
+
+    def apply_tokens(self, tokens):
+        """Set job information from (token name, value) pairs.
+
+        Pairs are applied in the order they were reported by the job,
+        so the last value of a repeated token is kept."""
         # jobs that do not specifically report success will
         # be marked as failed.
         reported_success = False
-        with open(logpath, 'r') as handle:
-            log = handle.read().splitlines()
-        for line in log:
-            for tok in tokens:
-                if re.match(config[tok], line):
-                    t_name = tok.replace('AUTOCMS_', '').replace('_TOKEN', '')
-                    t_val = line.replace(config[tok], '')
-                    if t_name == 'SUCCESS':
-                        reported_success = True
-                        self.exit_code = 0
-                        self.error_string = ''
-                    else:
-                        setattr(self, t_name, t_val)
+        for t_name, t_val in tokens:
+            if t_name == 'SUCCESS':
+                reported_success = True
+                self.exit_code = 0
+                self.error_string = ''
+            elif t_name in self.fields:
+                setattr(self, t_name, t_val)
+            else:
+                self.tokens[t_name] = t_val
         # ensure that required attributes remain ints - oddball log could
         # mess this up
         self.exit_code = int(self.exit_code)
@@ -165,14 +234,364 @@ class JobRecord(object):
 
     def __str__(self):
         """Return readable string of JobRecord object attributes."""
-        attr_list = (attr for attr in dir(self)
-                     if not attr.startswith('__') and
-                     not callable(getattr(self, attr)))
         jrs = "JobRecord object"
-        for attr in attr_list:
+        for attr in self.fields:
             jrs += "\n    {0}={1}".format(attr, repr(getattr(self, attr)))
+        for attr in self.usage_fields:
+            if getattr(self, attr) is not None:
+                jrs += "\n    {0}={1}".format(attr,
+                                               repr(getattr(self, attr)))
+        for attr in sorted(self.tokens):
+            jrs += "\n    {0}={1}".format(attr, repr(self.tokens[attr]))
         return jrs
 
+    def __getattr__(self, name):
+        """Look up attributes not in __slots__ in the tokens dictionary."""
+        if name != 'tokens':
+            try:
+                return self.tokens[name]
+            except (AttributeError, KeyError):
+                pass
+        raise AttributeError("'JobRecord' object has no attribute "
+                             "'{0}'".format(name))
+
+    def __getstate__(self):
+        """Return the field values followed by the tokens dictionary."""
+        return self._slot_values(self)
+
+    def __setstate__(self, state):
+        """Restore a JobRecord from __getstate__ or an older pickle.
+
+        JobRecords pickled before __slots__ was introduced have their
+        instance dictionary as state. Guaranteed attributes are taken
+        from it and anything else is moved to the tokens dictionary.
+        JobRecords pickled before the resource usage attributes were
+        added have them set to None."""
+        for attr in self.usage_fields:
+            setattr(self, attr, None)
+        if isinstance(state, dict):
+            state = dict(state)
+            for attr in self.fields:
+                setattr(self, attr, state.pop(attr, None))
+            self.tokens = state
+        elif len(state) == len(self.fields) + 1:
+            for attr, val in zip(self.fields + ('tokens',), state):
+                setattr(self, attr, val)
+        else:
+            for attr, val in zip(self.__slots__, state):
+                setattr(self, attr, val)
+
+
+class RecordIndex(object):
+    """Hash indexes over a JobRecord list.
+
+    by_key maps (seq, submit_time) to the JobRecord with that key, and
+    pending maps the jobid of every incomplete job to a list of its
+    JobRecords. The indexes are built once from a record list and kept
+    up to date by adding, completing, and removing jobs through the
+    index rather than the list directly."""
+
+    def __init__(self, records):
+        """Build the indexes of a JobRecord list."""
+        self.records = records
+        self.by_key = dict()
+        self.pending = dict()
+        for job in records:
+            self._index(job)
+
+    @staticmethod
+    def key(job):
+        """Return the (seq, submit_time) key of a JobRecord."""
+        return (job.seq, job.submit_time)
+
+    def _index(self, job):
+        """Add a JobRecord to the indexes."""
+        self.by_key[self.key(job)] = job
+        if not job.completed:
+            self.pending.setdefault(job.jobid, []).append(job)
+
+    def __contains__(self, key):
+        """Return True if a job with the (seq, submit_time) key exists."""
+        return key in self.by_key
+
+    def add(self, job):
+        """Append a JobRecord to the record list and the indexes."""
+        self.records.append(job)
+        self._index(job)
+
+    def complete(self, jobid):
+        """Mark the incomplete JobRecords of a jobid completed.
+
+        The JobRecords are removed from pending and returned."""
+        jobs = self.pending.pop(jobid, [])
+        for job in jobs:
+            job.completed = True
+        return jobs
+
+    def remove_if(self, condition):
+        """Remove all JobRecords for which condition(job) is True.
+
+        The record list is filtered in place in a single pass and the
+        removed JobRecords are returned."""
+        kept = []
+        removed = []
+        for job in self.records:
+            if condition(job):
+                removed.append(job)
+            else:
+                kept.append(job)
+        self.records[:] = kept
+        for job in removed:
+            if self.by_key.get(self.key(job)) is job:
+                del self.by_key[self.key(job)]
+            if not job.completed:
+                jobs = self.pending.get(job.jobid, [])
+                if job in jobs:
+                    jobs.remove(job)
+                if not jobs:
+                    self.pending.pop(job.jobid, None)
+        return removed
+
+
+class TokenMatcher(object):
+    """Find AutoCMS tokens at the beginning of log lines.
+
+    All AUTOCMS_*_TOKEN strings in the configuration are compiled into
+    a single regular expression, so each log line is examined once no
+    matter how many tokens are configured. Token strings are matched
+    literally, and if one token is a prefix of another the longest
+    matching token wins."""
+
+    def __init__(self, config):
+        """Construct a TokenMatcher from the AutoCMS configuration."""
+        self.names = dict()
+        for key in config:
+            if re.match(r'AUTOCMS_.*_TOKEN', key):
+                name = key.replace('AUTOCMS_', '').replace('_TOKEN', '')
+                self.names.setdefault(config[key], []).append(name)
+        tokens = sorted(self.names, key=len, reverse=True)
+        # most tokens share a prefix such as 'AutoCMS', check it
+        # first to quickly skip ordinary lines
+        self.prefix = os.path.commonprefix(tokens)
+        self.regex = re.compile('|'.join(re.escape(tok) for tok in tokens))
+
+    def match(self, line):
+        """Return a (token names, value) tuple or None if no token matches.
+
+        The value is the remainder of the line following the token."""
+        if not self.names or not line.startswith(self.prefix):
+            return None
+        found = self.regex.match(line)
+        if found is None:
+            return None
+        token = found.group()
+        return self.names[token], line[len(token):]
+
+
+_token_matchers = dict()
+
+
+def get_token_matcher(config):
+    """Return a cached TokenMatcher for the tokens in config."""
+    key = tuple(sorted((key, val) for key, val in config.iteritems()
+                       if re.match(r'AUTOCMS_.*_TOKEN', key)))
+    if key not in _token_matchers:
+        _token_matchers[key] = TokenMatcher(config)
+    return _token_matchers[key]
+
+
+def scan_log_tokens(logpath, matcher, head_bytes=None, tail_bytes=None):
+    """Yield (token name, value) pairs found in a log file.
+
+    See iter_log_lines for the meaning of head_bytes and tail_bytes."""
+    for line in iter_log_lines(logpath, head_bytes, tail_bytes):
+        match = matcher.match(line)
+        if match is None:
+            continue
+        t_names, t_val = match
+        for t_name in t_names:
+            yield t_name, t_val
+
+
+def day_key(timestamp):
+    """Return the YYYYMMDD day string of a timestamp in UTC."""
+    return time.strftime('%Y%m%d', time.gmtime(timestamp))
+
+
+def day_start(key):
+    """Return the timestamp of the beginning of a YYYYMMDD day in UTC."""
+    return calendar.timegm(time.strptime(key, '%Y%m%d'))
+
+
+def stamp_journal_dir(testname, config):
+    """Return the directory of the submission stamp journal of a test.
+
+    The journal is split into one segment file per (UTC) day of
+    submission, named 'submission.YYYYMMDD.stamps'."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], testname, 'stamps')
+
+
+def stamp_segment_path(testname, config, timestamp):
+    """Return the path of the stamp journal segment for a timestamp."""
+    return os.path.join(stamp_journal_dir(testname, config),
+                        'submission.' + day_key(timestamp) + '.stamps')
+
+
+def append_stamps(journal, stamps):
+    """Append submission stamps to a stamp journal segment.
+
+    The stamps are written as complete lines with a single write to a
+    file opened with O_APPEND, so concurrent submitters never interleave.
+    Stamp journal segments are never rewritten."""
+    data = ''.join(stamp.rstrip('\n') + '\n' for stamp in stamps)
+    if not data:
+        return
+    jdir = os.path.dirname(journal)
+    if jdir and not os.path.isdir(jdir):
+        try:
+            os.makedirs(jdir)
+        except OSError:
+            if not os.path.isdir(jdir):
+                raise
+    fdesc = os.open(journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fdesc, data)
+    finally:
+        os.close(fdesc)
+
+
+def summary_path(logpath):
+    """Return the path of the job summary file belonging to a log.
+
+    The summary is written by the autocms_token function of
+    autocms_job.sh, and is named as the log with '.log' replaced
+    by '.jsonl'. Compressed logs share the summary of the original log."""
+    if logpath.endswith('.gz'):
+        logpath = logpath[:-3]
+    root, ext = os.path.splitext(logpath)
+    if ext == '.log':
+        return root + '.jsonl'
+    return logpath + '.jsonl'
+
+
+def read_summary_tokens(path):
+    """Return (token name, value) pairs from a job summary file.
+
+    Each line of the summary is a JSON object with 'token' and 'value'
+    keys. Lines that cannot be decoded, such as a final line cut off
+    when the job was killed, are skipped."""
+    tokens = []
+    with open(path, 'r') as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+                tokens.append((_to_str(entry['token']),
+                               _to_str(entry['value'])))
+            except (ValueError, KeyError, TypeError):
+                continue
+    return tokens
+
+
+def find_log_file(logpath):
+    """Return the path of a log or of its compressed copy.
+
+    Old logs may have been compressed to logpath + '.gz' (see
+    autocms.harvest.manage_log_files). None is returned if neither
+    exists."""
+    if os.path.isfile(logpath):
+        return logpath
+    if os.path.isfile(logpath + '.gz'):
+        return logpath + '.gz'
+    return None
+
+
+def is_log_file(name):
+    """Return True if a file name is that of a log or compressed log."""
+    return name.endswith('.log') or name.endswith('.log.gz')
+
+
+def scan_log_files(directory):
+    """Return a list of (path, mtime) tuples of the logs in a directory.
+
+    Every file ending in '.log' or '.log.gz' is considered a log file.
+    The directory is read in a single scandir pass, using the stat
+    results cached by the directory entries where the platform provides
+    them, falling back to listdir and stat if scandir is not available."""
+    logs = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if is_log_file(entry.name) and entry.is_file():
+                logs.append((entry.path, int(entry.stat().st_mtime)))
+        return logs
+    for name in os.listdir(directory):
+        if is_log_file(name):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                logs.append((path, int(os.path.getmtime(path))))
+    return logs
+
+
+def read_job_tokens(logpath, config, matcher=None):
+    """Return the (token name, value) pairs reported by a job.
+
+    The pairs are read from the job summary file if it exists and
+    otherwise scanned from the log, or its compressed copy, within the
+    configured log_window."""
+    summary = summary_path(logpath)
+    if os.path.isfile(summary):
+        return read_summary_tokens(summary)
+    if matcher is None:
+        matcher = get_token_matcher(config)
+    head_bytes, tail_bytes = log_window(config)
+    logpath = find_log_file(logpath) or logpath
+    return list(scan_log_tokens(logpath, matcher, head_bytes, tail_bytes))
+
+
+def log_window(config):
+    """Return the (head, tail) byte counts of logs to scan from config.
+
+    Both are None, meaning the whole log is scanned, unless
+    AUTOCMS_LOG_HEAD_BYTES and AUTOCMS_LOG_TAIL_BYTES are configured."""
+    if ('AUTOCMS_LOG_HEAD_BYTES' in config and
+            'AUTOCMS_LOG_TAIL_BYTES' in config):
+        return (int(config['AUTOCMS_LOG_HEAD_BYTES']),
+                int(config['AUTOCMS_LOG_TAIL_BYTES']))
+    return None, None
+
+
+def iter_log_lines(logpath, head_bytes=None, tail_bytes=None):
+    """Yield the lines of a log file without reading it into memory.
+
+    If head_bytes and tail_bytes are given and the log is larger than
+    their sum, only the complete lines within the first head_bytes and
+    the last tail_bytes of the file are yielded. Line endings are
+    stripped. Compressed logs ending in '.gz' are always read in full,
+    as their uncompressed size is not known without reading them."""
+    if logpath.endswith('.gz'):
+        with gzip.open(logpath, 'rb') as handle:
+            for line in handle:
+                yield line.rstrip('\r\n')
+        return
+    with open(logpath, 'r') as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if (head_bytes is None or tail_bytes is None or
+                size <= head_bytes + tail_bytes):
+            for line in handle:
+                yield line.rstrip('\r\n')
+            return
+        # the last piece of the head is dropped, as it is either empty
+        # or a line cut off by the window
+        head = handle.read(head_bytes).split('\n')
+        for line in head[:-1]:
+            yield line.rstrip('\r')
+        # skip the partial line at the start of the tail window unless
+        # the window begins exactly at a new line
+        handle.seek(size - tail_bytes - 1)
+        if handle.read(1) != '\n':
+            handle.readline()
+        for line in handle:
+            yield line.rstrip('\r\n')
+
 
 class MalformedStamp(Exception):
     """Raised when loading a JobRecord from improperly formatted stamp."""
@@ -201,21 +620,307 @@ def load_configuration(filename):
     return config
 
 
-def load_records(testname, config):
-    """Get the JobRecord list from the pickle or make a new one."""
-    filepath = os.path.join(config['AUTOCMS_BASEDIR'],
-                            testname,
-                            'records.pickle')
-    if os.path.isfile(filepath):
-        records = pickle.load(open(filepath, "rb"))
+class UnknownRecordStore(Exception):
+    """Exception for record store type not implemented."""
+    def __init__(self, message):
+        super(UnknownRecordStore, self).__init__(message)
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+
+def create_record_store(testname, config):
+    """Factory function for creating RecordStore subclasses.
+
+    The backend is selected by AUTOCMS_RECORD_STORE, which defaults
+    to the original 'pickle' store if it is not configured."""
+    store_type = config.get('AUTOCMS_RECORD_STORE', 'pickle')
+    if store_type == 'pickle':
+        return PickleRecordStore(testname, config)
+    elif store_type == 'sqlite':
+        return SqliteRecordStore(testname, config)
     else:
+        raise UnknownRecordStore("Record store type '" +
+                                 store_type +
+                                 "' is not implemented.")
+
+
+def in_record_window(job, since):
+    """Return True if a JobRecord may be relevant to a window from since.
+
+    Incomplete jobs are always included. Completed jobs are included if
+    they ended at or after since, which covers any selection made on
+    the start or end time of the job."""
+    return (not job.completed) or job.end_time >= since
+
+
+class RecordStore(object):
+    """Base class for persistent JobRecord storage."""
+
+    def __init__(self, testname, config):
+        """Construct a record store for a test with AutoCMS config."""
+        self.testname = testname
+        self.config = config
+        self.testdir = os.path.join(config['AUTOCMS_BASEDIR'], testname)
+
+    def load(self, since=None):
+        """Return a list of JobRecords.
+
+        If since is given as a timestamp, only records for which
+        in_record_window is True are guaranteed to be returned."""
+        raise NotImplementedError
+
+    def save(self, records):
+        """Persist a list of JobRecords previously returned by load.
+
+        Records that were returned by load of this store but are missing
+        from the list are removed from the store, while records outside
+        the window of a windowed load are kept. If this store has not
+        loaded, the list replaces all stored records."""
+        raise NotImplementedError
+
+    def merge(self, records):
+        """Add or replace the listed JobRecords, keep all other records."""
+        raise NotImplementedError
+
+
+def record_key(job):
+    """Return the (seq, submit_time) key identifying a JobRecord."""
+    return (job.seq, job.submit_time)
+
+
+class PickleRecordStore(RecordStore):
+    """Store the whole JobRecord list in a single pickle file."""
+
+    def __init__(self, testname, config):
+        RecordStore.__init__(self, testname, config)
+        self.filepath = os.path.join(self.testdir, 'records.pickle')
+        self._loaded = False
+        self._since = None
+
+    def _read(self):
+        """Return the JobRecord list in the pickle file."""
+        if os.path.isfile(self.filepath):
+            with open(self.filepath, 'rb') as handle:
+                return pickle.load(handle)
+        return []
+
+    def load(self, since=None):
+        records = self._read()
+        self._loaded = True
+        self._since = since
+        if since is not None:
+            records = [job for job in records if in_record_window(job, since)]
+        return records
+
+    def save(self, records):
+        if self._loaded and self._since is not None:
+            # keep the stored records outside the loaded window
+            keys = set(record_key(job) for job in records)
+            records = [job for job in self._read()
+                       if record_key(job) not in keys and
+                       not in_record_window(job, self._since)] + list(records)
+        self._write(records)
+
+    def merge(self, records):
+        keys = set(record_key(job) for job in records)
+        self._write([job for job in self._read()
+                     if record_key(job) not in keys] + list(records))
+
+    def _write(self, records):
+        """Replace the pickle file by the JobRecord list."""
+        with open(self.filepath, 'wb') as handle:
+            pickle.dump(records, handle, pickle.HIGHEST_PROTOCOL)
+
+
+class SqliteRecordStore(RecordStore):
+    """Store JobRecords as indexed rows of a SQLite database.
+
+    Every JobRecord is one row keyed by (seq, submit_time). Guaranteed
+    attributes are stored in columns and the tokens dictionary is stored
+    as a JSON object in the tokens column.
+
+    Only rows which were added or changed since they were loaded are
+    written on save. If a records.pickle file exists when the database
+    is opened, its records are added to the database, keeping rows that
+    already exist, and the pickle is renamed to records.pickle.migrated."""
+
+    columns = (('seq', 'submit_time', 'jobid', 'submit_status',
+                'start_time', 'end_time', 'node', 'exit_code',
+                'error_string', 'completed', 'logfile') +
+               JobRecord.usage_fields)
+
+    usage_types = {'max_rss': 'INTEGER', 'total_cpu': 'REAL',
+                   'disk_read': 'INTEGER', 'disk_write': 'INTEGER',
+                   'elapsed': 'REAL'}
+
+    def __init__(self, testname, config):
+        RecordStore.__init__(self, testname, config)
+        self.filepath = os.path.join(self.testdir, 'records.sqlite')
+        self.picklepath = os.path.join(self.testdir, 'records.pickle')
+        self._rows = None
+        self._conn = None
+
+    def connect(self):
+        """Return the database connection, creating the schema if needed."""
+        if self._conn is not None:
+            return self._conn
+        self._conn = sqlite3.connect(self.filepath)
+        self._conn.text_factory = str
+        # jobid and node are declared without a type so that sqlite
+        # returns them with the same python type they were stored with
+        self._conn.executescript(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' seq INTEGER NOT NULL,'
+            ' submit_time INTEGER NOT NULL,'
+            ' jobid,'
+            ' submit_status INTEGER,'
+            ' start_time INTEGER,'
+            ' end_time INTEGER,'
+            ' node,'
+            ' exit_code INTEGER,'
+            ' error_string TEXT,'
+            ' completed INTEGER,'
+            ' logfile TEXT,'
+            ' tokens TEXT);\n'
+            'CREATE UNIQUE INDEX IF NOT EXISTS jobs_seq_submit_time'
+            ' ON jobs (seq, submit_time);\n'
+            'CREATE INDEX IF NOT EXISTS jobs_submit_time'
+            ' ON jobs (submit_time);\n'
+            'CREATE INDEX IF NOT EXISTS jobs_end_time ON jobs (end_time);\n'
+            'CREATE INDEX IF NOT EXISTS jobs_completed ON jobs (completed);\n'
+            'CREATE INDEX IF NOT EXISTS jobs_jobid ON jobs (jobid);\n'
+        )
+        # databases created before the resource usage columns existed
+        # are extended in place
+        existing = set(row[1] for row in
+                       self._conn.execute('PRAGMA table_info(jobs)'))
+        with self._conn:
+            for col in JobRecord.usage_fields:
+                if col not in existing:
+                    self._conn.execute('ALTER TABLE jobs ADD COLUMN '
+                                       '{0} {1}'.format(col,
+                                                        self.usage_types[col]))
+        self._migrate_pickle()
+        return self._conn
+
+    def close(self):
+        """Close the database connection."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _migrate_pickle(self):
+        """Import records.pickle into the database.
+
+        Records already in the database are kept, the others are added.
+        The pickle is renamed only after the import is committed."""
+        if not os.path.isfile(self.picklepath):
+            return
+        with open(self.picklepath, 'rb') as handle:
+            records = pickle.load(handle)
+        with self._conn:
+            self._conn.executemany(self._insert_sql('IGNORE'),
+                                   [self.record_to_row(job)
+                                    for job in records])
+        os.rename(self.picklepath, self.picklepath + '.migrated')
+
+    def _insert_sql(self, conflict='REPLACE'):
+        """Return the statement inserting one row, replacing by default."""
+        names = self.columns + ('tokens',)
+        return ('INSERT OR {0} INTO jobs ({1}) VALUES ({2})'.format(
+                conflict, ', '.join(names), ', '.join('?' for name in names)))
+
+    @classmethod
+    def record_to_row(cls, job):
+        """Return a database row tuple from a JobRecord."""
+        return (tuple(getattr(job, col) for col in cls.columns) +
+                (json.dumps(job.tokens, sort_keys=True),))
+
+    @classmethod
+    def row_to_record(cls, row):
+        """Return a JobRecord from a database row tuple."""
+        job = JobRecord.__new__(JobRecord)
+        for col, val in zip(cls.columns, row):
+            setattr(job, col, val)
+        job.completed = bool(job.completed)
+        job.tokens = json.loads(row[-1], object_hook=_str_object_hook)
+        return job
+
+    def load(self, since=None):
+        conn = self.connect()
+        query = 'SELECT {0}, tokens FROM jobs'.format(', '.join(self.columns))
+        if since is not None:
+            cursor = conn.execute(query + ' WHERE completed = 0 OR '
+                                  'end_time >= ?', (since,))
+        else:
+            cursor = conn.execute(query)
+        self._rows = dict()
         records = []
-    return records
+        for row in cursor:
+            self._rows[row[0:2]] = row
+            records.append(self.row_to_record(row))
+        return records
+
+    def save(self, records):
+        conn = self.connect()
+        if self._rows is None:
+            self.load()
+        rows = dict()
+        for job in records:
+            row = self.record_to_row(job)
+            rows[row[0:2]] = row
+        changed = [row for key, row in rows.iteritems()
+                   if self._rows.get(key) != row]
+        # only rows returned by load are deleted, so that saving after
+        # a windowed load keeps the rows outside the window
+        removed = [key for key in self._rows if key not in rows]
+        with conn:
+            conn.executemany('DELETE FROM jobs WHERE seq = ? AND '
+                             'submit_time = ?', removed)
+            conn.executemany(self._insert_sql(), changed)
+        self._rows = rows
+
+    def merge(self, records):
+        conn = self.connect()
+        with conn:
+            conn.executemany(self._insert_sql(),
+                             [self.record_to_row(job) for job in records])
+        self._rows = None
+
+
+def _str_object_hook(obj):
+    """Decode JSON objects with str instead of unicode keys and values."""
+    return dict((_to_str(key), _to_str(val)) for key, val in obj.iteritems())
+
+
+def _to_str(val):
+    """Convert unicode to a utf-8 encoded str, leave anything else."""
+    if isinstance(val, unicode):
+        return val.encode('utf-8')
+    return val
+
+
+def load_records(testname, config, since=None):
+    """Get the JobRecord list from the configured record store.
+
+    If since is given, records that completed before that timestamp
+    may be omitted (see in_record_window)."""
+    return create_record_store(testname, config).load(since)
 
 
 def save_records(records, testname, config):
-    """Write the JobRecord list to a pickle."""
-    filepath = os.path.join(config['AUTOCMS_BASEDIR'],
-                            testname,
-                            'records.pickle')
-    pickle.dump(records, open(filepath, "wb"))
+    """Write the JobRecord list to the configured record store.
+
+    The list replaces all stored records, so it must not come from a
+    windowed load_records; use merge_records for such a list."""
+    create_record_store(testname, config).save(records)
+
+
+def merge_records(records, testname, config):
+    """Add or replace the listed JobRecords in the configured record store.
+
+    Stored records missing from the list are kept, so a list from a
+    windowed load_records may be saved with this function."""
+    create_record_store(testname, config).merge(records)
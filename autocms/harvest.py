@@ -6,153 +6,546 @@ submitted and completed jobs and purge old log files.
 
 import os
 import re
+import gzip
+import json
 import time
+import shutil
+import traceback
+import multiprocessing
 
 from .core import (
     JobRecord,
-    load_records,
-    save_records
+    RecordIndex,
+    append_stamps,
+    create_record_store,
+    day_start,
+    find_log_file,
+    get_token_matcher,
+    read_job_tokens,
+    scan_log_files,
+    stamp_journal_dir,
+    stamp_segment_path,
+    summary_path
+)
+from .archive import (
+    archive_records,
+    purge_old_archive_segments
 )
 from .scheduler import create_scheduler
+from .snapshot import write_record_snapshot
+from .jobqueue import purge_queue_latency
 
 
 def list_log_files(testname, config):
     """List the absolute path of log files in a given test directory.
 
-    Any file ending in '.log' in a test directory is considered
-    a log file."""
-    logs = []
+    Any file ending in '.log' or '.log.gz' in a test directory is
+    considered a log file."""
     testdir = os.path.join(config['AUTOCMS_BASEDIR'], testname)
-    for logfile in os.listdir(testdir):
-        if re.search(r'\.log$', logfile):
-            logs.append(logfile)
-    return [os.path.join(testdir, logfile) for logfile in logs]
+    return [logpath for logpath, mtime in scan_log_files(testdir)]
 
 
-def purge_old_log_files(testname, config):
-    """Remove logs older than AUTOCMS_LOG_LIFETIME in the given test dir.
+def compress_log_file(logpath, mtime):
+    """Replace a log by a gzip compressed copy named logpath + '.gz'.
 
-    Any file ending in '.log' in a test directory is considered
-    a log file."""
-    loglist = list_log_files(testname, config)
-    purgetime = int(time.time()) - 3600*24*int(config['AUTOCMS_LOG_LIFETIME'])
-    for logfile in loglist:
-        if int(os.path.getmtime(logfile)) < purgetime:
-            os.remove(logfile)
+    The compressed log keeps the modification time of the log, so it
+    ages as if it had not been compressed."""
+    tmppath = logpath + '.gz.tmp'
+    with open(logpath, 'rb') as log:
+        with gzip.open(tmppath, 'wb') as gzlog:
+            shutil.copyfileobj(log, gzlog)
+    os.utime(tmppath, (mtime, mtime))
+    os.rename(tmppath, logpath + '.gz')
+    os.remove(logpath)
+
+
+def manage_log_files(testname, config):
+    """Compress and remove old logs in the given test dir.
+
+    Logs older than AUTOCMS_LOG_LIFETIME days are removed together with
+    their job summary files. If AUTOCMS_LOG_COMPRESS_AGE is configured,
+    logs older than that many days are compressed (see
+    compress_log_file); compressed logs are still read by the harvester
+    and copied to the web directory. The test directory is read in a
+    single pass (see scan_log_files)."""
+    testdir = os.path.join(config['AUTOCMS_BASEDIR'], testname)
+    now = int(time.time())
+    purgetime = now - 3600*24*int(config['AUTOCMS_LOG_LIFETIME'])
+    compresstime = None
+    if 'AUTOCMS_LOG_COMPRESS_AGE' in config:
+        compresstime = now - 3600*24*float(config['AUTOCMS_LOG_COMPRESS_AGE'])
+    to_remove = []
+    to_compress = []
+    for logpath, mtime in scan_log_files(testdir):
+        if mtime < purgetime:
+            to_remove.append(logpath)
+        elif (compresstime is not None and mtime < compresstime and
+              not logpath.endswith('.gz')):
+            to_compress.append((logpath, mtime))
+    for logpath in to_remove:
+        os.remove(logpath)
+        summary = summary_path(logpath)
+        if os.path.isfile(summary):
+            os.remove(summary)
+    for logpath, mtime in to_compress:
+        compress_log_file(logpath, mtime)
 
 
-def append_new_stamps(stampfile, testname, config):
-    """Find new submission stamp files, append the stamp, and delete."""
+def journal_stamps(stamps, testname, config):
+    """Append stamps to the stamp journal segments of their submission day.
+
+    Stamps that are not five space-delimited entries are appended to
+    the quarantine file instead (see quarantine_path)."""
+    segments = dict()
+    for stamp in stamps:
+        fields = stamp.split()
+        if len(fields) == 5 and fields[2].isdigit():
+            path = stamp_segment_path(testname, config, int(fields[2]))
+        else:
+            path = quarantine_path(stamp_journal_dir(testname, config))
+        segments.setdefault(path, []).append(stamp)
+    for path in sorted(segments):
+        append_stamps(path, segments[path])
+
+
+def append_new_stamps(testname, config):
+    """Move legacy stamps into the stamp journal.
+
+    Submitters used to write each stamp to its own 'stamp.*' file in the
+    test directory, and the harvester used to collect them into a single
+    'submission.stamps' file. The stamps of any such files are appended
+    to the journal segments and the files are deleted."""
     stamplist = []
     testdir = os.path.join(config['AUTOCMS_BASEDIR'], testname)
     for item in os.listdir(testdir):
         if re.match(r'^stamp\.[0-9]+\.[0-9]+', item):
             stamplist.append(os.path.join(testdir, item))
-    with open(stampfile, 'a') as shandle:
-        for newstamp_filename in stamplist:
-            with open(newstamp_filename, 'r') as nsfile:
-                shandle.write(nsfile.read() + '\n')
-            os.remove(newstamp_filename)
+    combined = os.path.join(testdir, 'submission.stamps')
+    if os.path.isfile(combined):
+        stamplist.append(combined)
+    stamps = []
+    for newstamp_filename in stamplist:
+        with open(newstamp_filename, 'r') as nsfile:
+            stamps.extend(line for line in nsfile.read().splitlines()
+                          if line.strip())
+    journal_stamps(stamps, testname, config)
+    for newstamp_filename in stamplist:
+        os.remove(newstamp_filename)
+
 
+def list_stamp_segments(testname, config):
+    """Return a sorted list of (day, path) tuples of stamp segments."""
+    jdir = stamp_journal_dir(testname, config)
+    if not os.path.isdir(jdir):
+        return []
+    segments = []
+    for item in os.listdir(jdir):
+        match = re.match(r'^submission\.([0-9]{8})\.stamps$', item)
+        if match:
+            segments.append((match.group(1), os.path.join(jdir, item)))
+    return sorted(segments)
 
-def purge_old_stamps(stampfile, config):
-    """Remove old stamps from a merged stamp file."""
+
+def purge_old_stamps(testname, config):
+    """Remove stamp segments older than AUTOCMS_LOG_LIFETIME.
+
+    A segment is removed once the whole day it covers has expired.
+    The days of the removed segments are returned."""
     purgetime = int(time.time()) - 3600*24*int(config['AUTOCMS_LOG_LIFETIME'])
-    with open(stampfile) as shandle:
-        stamplist = shandle.readlines()
-    newstamplist = []
-    for line in stamplist:
-        if len(line.split()) != 5:
-            continue
-        if int(line.split()[2]) > purgetime:
-            newstamplist.append(line)
-    with open(stampfile, 'w') as shandle:
-        for line in newstamplist:
-            shandle.write(line)
+    removed = []
+    for day, path in list_stamp_segments(testname, config):
+        if day_start(day) + 3600*24 <= purgetime:
+            os.remove(path)
+            removed.append(day)
+    return removed
+
 
+def quarantine_path(stampdir):
+    """Return the path of the file holding malformed stamps."""
+    return os.path.join(stampdir, 'malformed.stamps')
 
-def add_untracked_jobs(stampfile, records):
+
+def add_untracked_jobs(stampfile, records, index=None, offset=0):
     """Add new jobs to a JobRecords list from stamps.
 
     If the stamp corresponds to a job already in the list, it is not added.
     Any line that is not five space-delimited entries is considered a
-    a corrupted submission record and treated as an error."""
-    stampfile_corruption = False
-    jobkeys = [str(job.seq) + '.' + str(job.submit_time) for job in records]
+    a corrupted submission record and treated as an error, and is moved
+    to the quarantine file next to the stamp file (see quarantine_path).
+    Lines already in the quarantine file, such as those read again after
+    an interrupted harvest, are not added to it again.
+
+    A RecordIndex of the records may be given, and is then used to find
+    existing jobs and kept up to date. Only stamps starting at the byte
+    offset of the stamp file are read, up to the last complete line. The
+    offset following the last stamp read is returned."""
+    if index is None:
+        index = RecordIndex(records)
+    malformed = []
+    if offset > os.path.getsize(stampfile):
+        # the stamp file was replaced, read it from the beginning
+        offset = 0
     with open(stampfile) as shandle:
-        stamplist = shandle.readlines()
+        shandle.seek(offset)
+        data = shandle.read()
+    data = data[:data.rfind('\n') + 1]
+    stamplist = data.splitlines()
+    offset += len(data)
     for stamp in stamplist:
-        if len(stamp.split()) != 5:
-            if stampfile_corruption == False:
-                record_malformed_stamp(records)
-            stampfile_corruption = True
+        fields = stamp.split()
+        if len(fields) != 5:
+            malformed.append(stamp)
             continue
-        stampkey = stamp.split()[0] + '.' + stamp.split()[2]
-        if stampkey in jobkeys:
+        if (int(fields[0]), int(fields[2])) in index:
             continue
         else:
-            records.append(JobRecord.create_from_stamp(stamp))
-    if stampfile_corruption:
-        purge_malformed_stamps(stampfile)
+            index.add(JobRecord.create_from_stamp(stamp))
+    if malformed:
+        record_malformed_stamp(records, index)
+        quarantine = quarantine_path(os.path.dirname(stampfile))
+        if os.path.isfile(quarantine):
+            with open(quarantine) as qhandle:
+                quarantined = set(qhandle.read().splitlines())
+            malformed = [stamp for stamp in malformed
+                         if stamp not in quarantined]
+        append_stamps(quarantine, malformed)
+    return offset
 
 
-def record_malformed_stamp(records):
+def record_malformed_stamp(records, index=None):
     job = JobRecord(0, 0, int(time.time()), -1, None)
     job.error_string = ('AutoCMS internal error: A malformed submission '
                         'record was encountered. Some jobs may be lost.')
-    records.append(job)
+    if index is None:
+        records.append(job)
+    else:
+        index.add(job)
 
 
-def purge_malformed_stamps(stampfile):
-    """Remove malformed stamps from a merged stamp file."""
-    with open(stampfile) as shandle:
-        stamplist = shandle.readlines()
-    goodstamplist = []
-    for line in stamplist:
-        if len(line.split()) == 5:
-            goodstamplist.append(line)
-    with open(stampfile, 'w') as shandle:
-        for line in goodstamplist:
-            shandle.write(line)
-
-
-def purge_old_jobs(records, config):
-    """Remove old jobs from a JobRecords list."""
+def purge_old_jobs(records, config, index=None):
+    """Remove old jobs from a JobRecords list and return them.
+
+    If a RecordIndex of the records is given it is kept up to date."""
     purgetime = int(time.time()) - 3600*24*int(config['AUTOCMS_LOG_LIFETIME'])
-    for job in records[:]:
-        if job.submit_time < purgetime:
-            records.remove(job)
-
-
-def parse_completed_job_logs(records, scheduler, testname, config):
-    """Check scheduler for completed jobs, and parse logs if they exist."""
-    jobids_to_check = [job.jobid for job in records if job.completed == False]
-    completed_jobids = scheduler.get_completed_jobs(jobids_to_check)
-    jobs_to_parse = [job for job in records if job.jobid in completed_jobids]
-    for job in jobs_to_parse:
-        job.completed = True
-        logpath = os.path.join(config['AUTOCMS_BASEDIR'], testname,
-                               job.logfile)
-        if os.path.isfile(logpath):
-            job.parse_output(testname, config)
+    if index is None:
+        index = RecordIndex(records)
+    return index.remove_if(lambda job: job.submit_time < purgetime)
+
+
+def parse_completed_job_logs(records, scheduler, testname, config,
+                             index=None, completions=None):
+    """Check scheduler for completed jobs, and parse logs if they exist.
+
+    Jobs that wrote a summary file are parsed from the summary instead
+    of scanning the log (see JobRecord.parse_output). If a RecordIndex
+    of the records is given it is used to find incomplete jobs and
+    kept up to date. If the completed jobs have already been obtained
+    from the scheduler they can be passed as a completions dict (see
+    Scheduler.get_job_completions).
+
+    The timing, node, and exit code reported by the scheduler are set
+    before the log is parsed, so they are also known for jobs whose log
+    is missing. If AUTOCMS_PARSE_WORKERS is larger than one, logs are
+    read by a pool of that many processes (see
+    read_completed_job_tokens)."""
+    if index is None:
+        index = RecordIndex(records)
+    if completions is None:
+        completions = scheduler.get_job_completions(list(index.pending))
+    jobs_to_parse = []
+    for jobid in completions:
+        jobs_to_parse.extend(index.complete(jobid))
+    logpaths = [os.path.join(config['AUTOCMS_BASEDIR'], testname,
+                             job.logfile)
+                for job in jobs_to_parse]
+    found = [find_log_file(logpath) is not None for logpath in logpaths]
+    tokens = iter(read_completed_job_tokens(
+        [logpath for logpath, exists in zip(logpaths, found) if exists],
+        config))
+    for job, exists in zip(jobs_to_parse, found):
+        completion = completions[job.jobid]
+        if exists:
+            job.apply_completion(completion)
+            job.apply_tokens(next(tokens))
         else:
             job.exit_code = 1
             job.error_string = ("ERROR standard output of this job "
                                 "was not found.")
             job.start_time = job.submit_time
             job.end_time = job.submit_time
+            job.apply_completion(completion)
+            if completion.state is not None:
+                job.error_string += (" Scheduler job state: " +
+                                     completion.state + ".")
+
+
+def parse_workers(config):
+    """Return the number of log parsing processes from config.
+
+    AUTOCMS_PARSE_WORKERS is optional and defaults to one, in which
+    case logs are parsed in the harvesting process."""
+    return max(1, int(config.get('AUTOCMS_PARSE_WORKERS', 1)))
+
+
+def _read_tokens_worker(args):
+    """Pool worker reading the tokens of one job log."""
+    logpath, config = args
+    return read_job_tokens(logpath, config)
+
+
+def read_completed_job_tokens(logpaths, config):
+    """Return a list of the token pairs reported by each log in logpaths.
+
+    With more than one parse worker configured the logs are read
+    concurrently by a process pool. Workers only read logs and return
+    their tokens, and the results are in the order of logpaths, so
+    records are updated by the calling process alone and in the same
+    order as when parsing serially."""
+    workers = min(parse_workers(config), len(logpaths))
+    if workers <= 1:
+        matcher = get_token_matcher(config)
+        return [read_job_tokens(logpath, config, matcher)
+                for logpath in logpaths]
+    pool = multiprocessing.Pool(workers)
+    try:
+        tokens = pool.map(_read_tokens_worker,
+                          [(logpath, config) for logpath in logpaths],
+                          chunksize=max(1, len(logpaths) // (4*workers)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return tokens
+
+
+def checkpoint_path(testname, config):
+    """Return the path of the harvest checkpoint of a test."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], testname,
+                        'harvest.checkpoint')
+
+
+def load_harvest_checkpoint(testname, config):
+    """Load the harvest checkpoint of a test.
+
+    The checkpoint is a small JSON file holding the byte offset of the
+    next unread stamp in each stamp journal segment, the time of the
+    last completed job query, the jobids of incomplete jobs, the
+    submission time of the oldest job, the time of the last purge, and
+    whether legacy stamp files have been moved to the stamp journal. A
+    missing or unreadable checkpoint is returned as dirty, which causes
+    a full harvest. The stamp offsets of a checkpoint left dirty by an
+    unfinished harvest are kept, as they are saved before any stamp
+    after them is read (see TestHarvest.load)."""
+    checkpoint = {'stamp_offsets': {},
+                  'query_time': None,
+                  'pending': [],
+                  'oldest_submit': None,
+                  'purge_time': 0,
+                  'legacy_stamps_drained': False,
+                  'dirty': True}
+    try:
+        with open(checkpoint_path(testname, config)) as handle:
+            checkpoint.update(json.load(handle))
+    except (IOError, ValueError):
+        checkpoint['dirty'] = True
+        checkpoint['stamp_offsets'] = {}
+    if checkpoint['dirty']:
+        checkpoint['query_time'] = None
+        checkpoint['purge_time'] = 0
+    checkpoint['stamp_offsets'] = dict(
+        (str(day), offset)
+        for day, offset in checkpoint['stamp_offsets'].iteritems())
+    checkpoint['pending'] = [None if jobid is None else str(jobid)
+                             for jobid in checkpoint['pending']]
+    return checkpoint
+
+
+def save_harvest_checkpoint(checkpoint, testname, config):
+    """Atomically write the harvest checkpoint of a test."""
+    path = checkpoint_path(testname, config)
+    with open(path + '.new', 'w') as handle:
+        json.dump(checkpoint, handle, sort_keys=True)
+    os.rename(path + '.new', path)
+
+
+def harvest_purge_due(checkpoint, config, now):
+    """Return True if old jobs, stamps, and logs should be purged.
+
+    A purge is due if the oldest tracked job has outlived
+    AUTOCMS_LOG_LIFETIME or if the last purge was more than a day ago."""
+    purgetime = now - 3600*24*int(config['AUTOCMS_LOG_LIFETIME'])
+    oldest = checkpoint['oldest_submit']
+    if oldest is not None and int(oldest) < purgetime:
+        return True
+    return now - checkpoint['purge_time'] > 3600*24
+
+
+class TestHarvest(object):
+    """Harvesting state of a single test.
+
+    On construction the harvest checkpoint is read and the records are
+    loaded only if there are new stamps, a purge is due, or the last
+    harvest did not finish (see load_harvest_checkpoint). The jobids
+    to ask the scheduler about are then given by pending, and the
+    harvest is completed by calling finish with those found completed.
+    This allows the scheduler to be queried once for several tests."""
+
+    def __init__(self, testname, config):
+        """Read the checkpoint and new stamps of a test."""
+        self.testname = testname
+        self.config = config
+        self.now = int(time.time())
+        self.checkpoint = load_harvest_checkpoint(testname, config)
+        if (self.checkpoint['dirty'] or
+                not self.checkpoint['legacy_stamps_drained'] or
+                os.path.isfile(os.path.join(config['AUTOCMS_BASEDIR'],
+                                            testname, 'submission.stamps'))):
+            append_new_stamps(testname, config)
+            self.checkpoint['legacy_stamps_drained'] = True
+        offsets = self.checkpoint['stamp_offsets']
+        self.segments = [(day, path)
+                         for day, path in list_stamp_segments(testname, config)
+                         if os.path.getsize(path) != offsets.get(day, 0)]
+        self.purge_due = harvest_purge_due(self.checkpoint, config, self.now)
+        self.store = None
+        self.records = None
+        self.index = None
+        self.new_jobs = []
+        if self.checkpoint['dirty'] or self.segments or self.purge_due:
+            self.load()
+
+    def load(self):
+        """Load the records and add the jobs of new stamps."""
+        if not self.checkpoint['dirty']:
+            self.checkpoint['dirty'] = True
+            save_harvest_checkpoint(self.checkpoint, self.testname,
+                                    self.config)
+        self.store = create_record_store(self.testname, self.config)
+        self.records = self.store.load()
+        self.index = RecordIndex(self.records)
+        tracked = len(self.records)
+        offsets = self.checkpoint['stamp_offsets']
+        for day, path in self.segments:
+            offsets[day] = add_untracked_jobs(path, self.records, self.index,
+                                              offsets.get(day, 0))
+        self.new_jobs = self.records[tracked:]
+
+    def pending(self):
+        """Return the jobids of the incomplete jobs of the test."""
+        if self.index is None:
+            return list(self.checkpoint['pending'])
+        return list(self.index.pending)
+
+    def since(self):
+        """Return the time after which completed jobs must be reported.
+
+        This is the time of the last scheduler query or the submission
+        of the oldest new job, or None after an unfinished harvest."""
+        since = self.checkpoint['query_time']
+        if since is not None and self.new_jobs:
+            since = min([since] + [job.submit_time for job in self.new_jobs])
+        return since
+
+    def finish(self, completions, scheduler):
+        """Parse completed jobs, purge old information and save.
+
+        Completions is a dict of the JobCompletions of the completed
+        pending jobs (see Scheduler.get_job_completions). If the records
+        were not loaded and none of the pending jobs completed only the
+        checkpoint is updated."""
+        checkpoint = self.checkpoint
+        if self.index is None:
+            if not completions:
+                checkpoint['query_time'] = self.now
+                save_harvest_checkpoint(checkpoint, self.testname,
+                                        self.config)
+                return
+            self.load()
+        records = self.records
+        parse_completed_job_logs(records, scheduler, self.testname,
+                                 self.config, self.index, completions)
+        if self.purge_due:
+            expired = purge_old_jobs(records, self.config, self.index)
+            # jobs that expired before ever being tracked, e.g. when a full
+            # harvest rereads old stamps, are not archived again
+            new_jobs = set(id(job) for job in self.new_jobs)
+            archive_records([job for job in expired
+                             if id(job) not in new_jobs],
+                            self.testname, self.config)
+            purge_old_archive_segments(self.testname, self.config)
+            for day in purge_old_stamps(self.testname, self.config):
+                checkpoint['stamp_offsets'].pop(day, None)
+            manage_log_files(self.testname, self.config)
+            purge_queue_latency(self.config)
+            checkpoint['purge_time'] = self.now
+        self.store.save(records)
+        write_record_snapshot(records, self.testname, self.config)
+        checkpoint.update({
+            'query_time': self.now,
+            'pending': list(self.index.pending),
+            'oldest_submit': min(job.submit_time for job in records)
+                             if records else None,
+            'dirty': False})
+        save_harvest_checkpoint(checkpoint, self.testname, self.config)
+
+
+def perform_harvesting(testnames, config):
+    """Harvest several tests with a single scheduler query.
+
+    The scheduler is asked once about the incomplete jobs of all tests,
+    and the completed jobids are handed to each test's harvest (see
+    TestHarvest). A test that fails to harvest does not stop the
+    others; its traceback is printed and the names of the failed tests
+    are returned."""
+    scheduler = create_scheduler(config['AUTOCMS_SCHEDULER'], config)
+    harvests = []
+    failed = []
+    for testname in testnames:
+        try:
+            harvests.append(TestHarvest(testname, config))
+        except Exception:
+            traceback.print_exc()
+            failed.append(testname)
+    pending = set()
+    sinces = []
+    for harvest in harvests:
+        jobids = harvest.pending()
+        if jobids:
+            pending.update(jobids)
+            sinces.append(harvest.since())
+    completions = dict()
+    if pending:
+        since = None if None in sinces else min(sinces)
+        completions = scheduler.get_job_completions(list(pending),
+                                                    since=since)
+    for harvest in harvests:
+        try:
+            harvest.finish(dict((jobid, completions[jobid])
+                                for jobid in harvest.pending()
+                                if jobid in completions), scheduler)
+        except Exception:
+            traceback.print_exc()
+            failed.append(harvest.testname)
+    return failed
 
 
 def perform_test_harvesting(testname, config):
-    """Track new submitted jobs, parse logs, and purge old information."""
-    records = load_records(testname, config)
+    """Track new submitted jobs, parse logs, and purge old information.
+
+    Only stamps appended to the stamp journal since the last harvest
+    are read, and the scheduler is only asked for jobs completed since
+    the last query or the submission of the oldest new job. Legacy
+    stamp files are only looked for in a full harvest. If there are no
+    new stamps, no newly completed jobs, and no purge is due the records
+    are neither loaded nor saved (see load_harvest_checkpoint).
+
+    Purged jobs are moved to the record archive (see autocms.archive)."""
     scheduler = create_scheduler(config['AUTOCMS_SCHEDULER'], config)
-    stampfile = os.path.join(config['AUTOCMS_BASEDIR'],
-                             testname, 'submission.stamps')
-    append_new_stamps(stampfile, testname, config)
-    add_untracked_jobs(stampfile, records)
-    parse_completed_job_logs(records, scheduler, testname, config)
-    purge_old_jobs(records, config)
-    purge_old_stamps(stampfile, config)
-    purge_old_log_files(testname, config)
-    save_records(records, testname, config)
+    harvest = TestHarvest(testname, config)
+    completions = dict()
+    if harvest.pending():
+        completions = scheduler.get_job_completions(harvest.pending(),
+                                                    since=harvest.since())
+    harvest.finish(completions, scheduler)
@@ -0,0 +1,181 @@
+"""Shared snapshot of the jobs in the scheduler queue.
+
+Submitters and reports all need to know which AutoCMS jobs are queued.
+Instead of each asking the scheduler, the queue is queried once and the
+parsed jobs are cached in 'queue.snapshot' in AUTOCMS_BASEDIR. Any
+consumer within AUTOCMS_QUEUE_TTL seconds (60 by default) of the query
+reuses the cached snapshot.
+
+The time each query took is kept in the snapshot and appended to
+'queue.latency' in AUTOCMS_BASEDIR as lines of
+'<unix time> <seconds> <number of jobs>', so a slow scheduler shows up.
+Lines older than AUTOCMS_LOG_LIFETIME days are removed by the harvester
+(see purge_queue_latency).
+"""
+
+import os
+import json
+import time
+from collections import namedtuple
+
+from .core import _to_str
+
+
+QueueJob = namedtuple('QueueJob', ['jobid', 'state', 'submit_time',
+                                   'start_time', 'elapsed', 'node'])
+
+
+def queue_snapshot_path(config):
+    """Return the path of the cached queue snapshot."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], 'queue.snapshot')
+
+
+def queue_latency_path(config):
+    """Return the path of the queue query latency log."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], 'queue.latency')
+
+
+class QueueSnapshot(object):
+    """The queued jobs as seen by one scheduler query.
+
+    Attributes:
+        jobs: list of QueueJob tuples, times in unix seconds or None.
+        query_time (int): unix time of the query.
+        latency (float): seconds the query took."""
+
+    def __init__(self, jobs, query_time, latency):
+        self.jobs = jobs
+        self.query_time = query_time
+        self.latency = latency
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def in_state(self, state):
+        """Return the jobs in the given state, e.g. 'RUNNING'."""
+        return [job for job in self.jobs if job.state == state]
+
+    def running(self):
+        """Return the running jobs."""
+        return self.in_state('RUNNING')
+
+    def pending(self):
+        """Return the pending jobs."""
+        return self.in_state('PENDING')
+
+    def time_in_state(self, job, now=None):
+        """Return the seconds a job has been pending or running by now.
+
+        Pending jobs count from submission, running jobs from the
+        elapsed time reported by the query plus the age of the snapshot.
+        None is returned if the needed time is unknown."""
+        if now is None:
+            now = time.time()
+        if job.state == 'PENDING':
+            if job.submit_time is None:
+                return None
+            return max(now - job.submit_time, 0)
+        if job.elapsed is not None:
+            return job.elapsed + max(self.age(now), 0)
+        if job.start_time is not None:
+            return max(now - job.start_time, 0)
+        return None
+
+    def age(self, now=None):
+        """Return the seconds since the query."""
+        if now is None:
+            now = time.time()
+        return now - self.query_time
+
+    def __repr__(self):
+        """Describe object id, query time, and number of jobs."""
+        return ('<{0}.{1} object at {2} query_time: {3} jobs: {4}>'.format(
+                    self.__class__.__module__,
+                    self.__class__.__name__,
+                    hex(id(self)),
+                    self.query_time,
+                    len(self)))
+
+
+def queue_ttl(config):
+    """Return the seconds a queue snapshot may be reused."""
+    return int(config.get('AUTOCMS_QUEUE_TTL', 60))
+
+
+def load_queue_snapshot(config):
+    """Return the cached QueueSnapshot, or None if there is none."""
+    try:
+        with open(queue_snapshot_path(config)) as handle:
+            state = json.load(handle)
+        jobs = [QueueJob(*[_to_str(val) for val in row])
+                for row in state['jobs']]
+        return QueueSnapshot(jobs, state['query_time'], state['latency'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_queue_snapshot(snapshot, config):
+    """Write a QueueSnapshot to the cache.
+
+    Concurrent writers each write their own temporary file, which then
+    replaces the cache, so readers never see a partial snapshot."""
+    path = queue_snapshot_path(config)
+    tmppath = '{0}.{1}'.format(path, os.getpid())
+    with open(tmppath, 'w') as handle:
+        json.dump({'query_time': snapshot.query_time,
+                   'latency': snapshot.latency,
+                   'jobs': [list(job) for job in snapshot.jobs]}, handle)
+    os.rename(tmppath, path)
+
+
+def invalidate_queue_snapshot(config):
+    """Remove the cached snapshot, e.g. after submitting jobs."""
+    try:
+        os.unlink(queue_snapshot_path(config))
+    except OSError:
+        pass
+
+
+def get_queue_snapshot(scheduler, config):
+    """Return a QueueSnapshot no older than AUTOCMS_QUEUE_TTL.
+
+    The cached snapshot is returned if it is recent enough, otherwise
+    the scheduler is queried and the cache and latency log updated."""
+    snapshot = load_queue_snapshot(config)
+    if snapshot is not None and 0 <= snapshot.age() < queue_ttl(config):
+        return snapshot
+    query_start = time.time()
+    jobs = scheduler.query_queue()
+    latency = time.time() - query_start
+    snapshot = QueueSnapshot(jobs, int(query_start), latency)
+    save_queue_snapshot(snapshot, config)
+    with open(queue_latency_path(config), 'a') as handle:
+        handle.write('{0} {1:.3f} {2}\n'.format(snapshot.query_time,
+                                                latency, len(jobs)))
+    return snapshot
+
+
+def purge_queue_latency(config):
+    """Remove queue latency lines older than AUTOCMS_LOG_LIFETIME days.
+
+    The trimmed log is written to a temporary file which then replaces
+    the log. Lines appended by another process in between are lost,
+    which only drops a latency measurement."""
+    path = queue_latency_path(config)
+    purgetime = int(time.time()) - 3600*24*int(config['AUTOCMS_LOG_LIFETIME'])
+    try:
+        with open(path) as handle:
+            lines = handle.readlines()
+    except IOError:
+        return
+    kept = []
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0].isdigit() and int(fields[0]) >= purgetime:
+            kept.append(line)
+    if len(kept) == len(lines):
+        return
+    tmppath = '{0}.{1}'.format(path, os.getpid())
+    with open(tmppath, 'w') as handle:
+        handle.writelines(kept)
+    os.rename(tmppath, path)
@@ -0,0 +1,317 @@
+"""Supervisor executing AutoCMS jobs on the local machine.
+
+The local scheduler does not start job scripts itself. It writes a
+status file '<jobid>.json' for each job to the spool directory
+'local.spool' in AUTOCMS_BASEDIR and makes sure a supervisor process
+is running, started as
+
+    python -m autocms.localexec <configfile>
+
+The supervisor starts queued jobs in order of their jobid, at most
+AUTOCMS_MAXENQUEUE at a time, as 'bash <testname>.local' in the test
+directory with AUTOCMS_COUNTER and AUTOCMS_CONFIGFILE exported and
+output to the log file of the job. When a job ends it is reaped with
+wait4, and its end time, exit code, peak RSS and CPU time are written
+to its status file. The status 'state' is PENDING, RUNNING, or
+COMPLETED.
+
+Only one supervisor runs at a time, holding a lock on 'supervisor.lock'
+in the spool. It exits once it has been idle for a while, and is started
+again by the next submission. Status files of jobs completed more than
+AUTOCMS_LOG_LIFETIME days ago are removed by the supervisor.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import socket
+import subprocess
+
+from .core import load_configuration
+
+
+# seconds between supervisor scans of the spool
+poll_interval = 0.2
+
+# seconds without jobs after which the supervisor exits
+idle_timeout = 30
+
+# first jobid given out by the supervisor, above any process id (at most
+# 2**22 on Linux), which the local scheduler used as jobid before
+first_jobid = 10000000
+
+
+def spool_dir(config):
+    """Return the spool directory of the local scheduler."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], 'local.spool')
+
+
+def status_path(jobid, config):
+    """Return the path of the status file of a job."""
+    return os.path.join(spool_dir(config), str(jobid) + '.json')
+
+
+def read_job_status(jobid, config):
+    """Return the status dict of a job, or None if it has none."""
+    try:
+        with open(status_path(jobid, config)) as handle:
+            return json.load(handle)
+    except (IOError, ValueError):
+        return None
+
+
+def write_job_status(status, config):
+    """Write the status dict of a job, replacing the file atomically."""
+    path = status_path(status['jobid'], config)
+    tmppath = '{0}.{1}'.format(path, os.getpid())
+    with open(tmppath, 'w') as handle:
+        json.dump(status, handle, sort_keys=True)
+    os.rename(tmppath, path)
+
+
+def list_job_statuses(config):
+    """Return the status dicts of all spooled jobs ordered by jobid."""
+    spool = spool_dir(config)
+    if not os.path.isdir(spool):
+        return []
+    statuses = []
+    for item in os.listdir(spool):
+        if not item.endswith('.json'):
+            continue
+        status = read_job_status(item[:-5], config)
+        if status is not None:
+            statuses.append(status)
+    statuses.sort(key=lambda status: int(status['jobid']))
+    return statuses
+
+
+def _locked(handle, blocking=True):
+    """Lock an open file exclusively, return False if it is locked."""
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(handle, flags)
+    except IOError as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+def next_jobid(config):
+    """Return a new jobid from the sequence file of the spool.
+
+    Jobids start at first_jobid, see is_supervisor_jobid."""
+    path = os.path.join(spool_dir(config), 'jobid.seq')
+    with open(path, 'a+') as handle:
+        _locked(handle)
+        handle.seek(0)
+        jobid = max(int(handle.read().strip() or 0) + 1, first_jobid)
+        handle.seek(0)
+        handle.truncate()
+        handle.write(str(jobid))
+    return str(jobid)
+
+
+def is_supervisor_jobid(jobid):
+    """Return True if a jobid was given out by next_jobid.
+
+    Other jobids are process ids of jobs started before the supervisor
+    was used, which have no status file."""
+    try:
+        return int(jobid) >= first_jobid
+    except (TypeError, ValueError):
+        return False
+
+
+def spool_job(counter, testname, config):
+    """Queue a job for the supervisor, return its PENDING status dict."""
+    spool = spool_dir(config)
+    if not os.path.isdir(spool):
+        try:
+            os.makedirs(spool)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    jobid = next_jobid(config)
+    status = {'jobid': jobid,
+              'testname': testname,
+              'counter': int(counter),
+              'logfile': testname + '.local.o' + jobid + '.log',
+              'state': 'PENDING',
+              'submit_time': int(time.time()),
+              'start_time': None,
+              'end_time': None,
+              'exit_code': None,
+              'node': None,
+              'max_rss': None,
+              'total_cpu': None,
+              'pid': None}
+    write_job_status(status, config)
+    return status
+
+
+def ensure_supervisor(config):
+    """Start a supervisor unless one is running."""
+    lockpath = os.path.join(spool_dir(config), 'supervisor.lock')
+    with open(lockpath, 'a') as handle:
+        if not _locked(handle, blocking=False):
+            return
+    # release the lock before starting, the supervisor takes it itself
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_dir] + [path for path in [env.get('PYTHONPATH')] if path])
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen([sys.executable, '-m', 'autocms.localexec',
+                          config['AUTOCMS_CONFIGFILE']],
+                         cwd=config['AUTOCMS_BASEDIR'], env=env,
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+
+class Supervisor(object):
+    """Launch spooled jobs and record how they end, see module docstring."""
+
+    def __init__(self, config):
+        self.config = config
+        self.max_running = int(config['AUTOCMS_MAXENQUEUE'])
+        self.node = socket.gethostname()
+        # pid -> status dict of jobs started by this supervisor
+        self.children = dict()
+        # the Popen objects are kept so that subprocess does not reap
+        # the jobs itself before wait4 gets their resource usage
+        self.procs = dict()
+
+    def start_job(self, status):
+        """Launch the job script of a PENDING job."""
+        testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                               status['testname'])
+        env = dict(os.environ)
+        env['AUTOCMS_COUNTER'] = str(status['counter'])
+        env['AUTOCMS_CONFIGFILE'] = self.config['AUTOCMS_CONFIGFILE']
+        status['start_time'] = int(time.time())
+        status['node'] = self.node
+        try:
+            with open(os.path.join(testdir, status['logfile']), 'w') as log:
+                proc = subprocess.Popen(
+                    ['bash', status['testname'] + '.local'], cwd=testdir,
+                    env=env, stdout=log, stderr=subprocess.STDOUT,
+                    close_fds=True)
+        except (IOError, OSError):
+            # the test directory is gone or not usable
+            status['state'] = 'COMPLETED'
+            status['end_time'] = status['start_time']
+            status['exit_code'] = 127
+            write_job_status(status, self.config)
+            return
+        status['state'] = 'RUNNING'
+        status['pid'] = proc.pid
+        write_job_status(status, self.config)
+        self.children[proc.pid] = status
+        self.procs[proc.pid] = proc
+
+    def reap(self):
+        """Record the end of every job that has exited."""
+        while self.children:
+            try:
+                pid, exit_status, usage = os.wait4(-1, os.WNOHANG)
+            except OSError as err:
+                if err.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            status = self.children.pop(pid, None)
+            if status is None:
+                continue
+            self.procs.pop(pid).returncode = exit_status
+            status['state'] = 'COMPLETED'
+            status['end_time'] = int(time.time())
+            if os.WIFEXITED(exit_status):
+                status['exit_code'] = os.WEXITSTATUS(exit_status)
+            else:
+                status['exit_code'] = 128 + os.WTERMSIG(exit_status)
+            # ru_maxrss is in kilobytes on linux
+            status['max_rss'] = usage.ru_maxrss * 1024
+            status['total_cpu'] = usage.ru_utime + usage.ru_stime
+            write_job_status(status, self.config)
+
+    def scan(self, now):
+        """Start pending jobs up to the limit, return the number left.
+
+        Jobs left RUNNING by an earlier supervisor are counted as running
+        until their process is gone, and then completed with an unknown
+        exit code. Old completed jobs are removed from the spool."""
+        lifetime = int(self.config['AUTOCMS_LOG_LIFETIME'])*24*3600
+        running = len(self.children)
+        pending = []
+        for status in list_job_statuses(self.config):
+            if status['state'] == 'PENDING':
+                pending.append(status)
+            elif (status['state'] == 'RUNNING' and
+                    status['pid'] not in self.children):
+                if _process_alive(status['pid']):
+                    running += 1
+                else:
+                    status['state'] = 'COMPLETED'
+                    status['end_time'] = int(now)
+                    write_job_status(status, self.config)
+            elif (status['state'] == 'COMPLETED' and
+                    (status['end_time'] or 0) < now - lifetime):
+                os.unlink(status_path(status['jobid'], self.config))
+        started = pending[:max(self.max_running - running, 0)]
+        for status in started:
+            self.start_job(status)
+        return len(pending) - len(started) + running
+
+    def run(self):
+        """Supervise jobs until idle for idle_timeout seconds.
+
+        Jobs spooled while the supervisor was giving up its lock are
+        picked up before exiting."""
+        lockpath = os.path.join(spool_dir(self.config), 'supervisor.lock')
+        while True:
+            with open(lockpath, 'a') as lock:
+                if not _locked(lock, blocking=False):
+                    return
+                self._supervise()
+            if not any(status['state'] == 'PENDING'
+                       for status in list_job_statuses(self.config)):
+                return
+
+    def _supervise(self):
+        """Start and reap jobs until there is nothing to do for a while."""
+        idle_since = time.time()
+        while True:
+            self.reap()
+            now = time.time()
+            if self.scan(now) > 0 or self.children:
+                idle_since = now
+            elif now - idle_since > idle_timeout:
+                return
+            time.sleep(poll_interval)
+
+
+def _process_alive(pid):
+    """Return True if a process with the pid exists."""
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def main():
+    """Run the supervisor with the configuration file given as argument."""
+    config = load_configuration(sys.argv[1])
+    Supervisor(config).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
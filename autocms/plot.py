@@ -128,3 +128,40 @@ def create_default_statistics_plot(df, filepath, size=(8,4), days=7):
                       dpi=80,
                       bbox_inches='tight',
                       pad_inches=0.2)
+
+
+def create_resource_usage_plot(df, filepath, size=(8,4), days=7):
+    """Create a job memory and CPU efficiency plot from DataFrame."""
+    min_time = int(time.time()) - 24*3600*days
+    df = df[df.index > min_time]
+    df.index = [convert_timestamp(ts) for ts in df.index]
+    fig, ax = plt.subplots()
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Peak Memory [MB]')
+    ax2 = ax.twinx()
+    ax2.set_ylabel('CPU Efficiency (%)')
+    df.plot(kind='line', figsize=size, y='max_max_rss',
+            color='Red', lw=2, label='Max. Peak Memory', ax=ax)
+    df.plot(kind='line', figsize=size, y='mean_max_rss',
+            color='Blue', lw=2, label='Mean Peak Memory', ax=ax)
+    df.plot(kind='line', figsize=size, y='mean_cpu_efficiency',
+            color='Green', lw=2, style='--', label='CPU Efficiency', ax=ax2)
+    lines, labels = ax.get_legend_handles_labels()
+    lines2, labels2 = ax2.get_legend_handles_labels()
+    ax2.legend(lines + lines2,
+               ['Max. Peak Memory', 'Mean Peak Memory', 'CPU Efficiency'],
+               loc='best', fontsize=12, framealpha=0.7)
+    ax.legend_.remove()
+    tickw = int(math.ceil(days/6))
+    ax.xaxis.set_major_locator(matplotlib.dates.DayLocator(interval=tickw))
+    ax.xaxis.set_major_formatter(
+        matplotlib.dates.DateFormatter('%b %d')
+    )
+    x1, x2, y1, y2 = ax.axis()
+    ax.axis((x1, x2, 0, y2 * 1.1))
+    ax2.set_ylim(0, 110)
+    ax.grid(False)
+    ax.figure.savefig(filepath,
+                      dpi=80,
+                      bbox_inches='tight',
+                      pad_inches=0.2)
@@ -2,11 +2,25 @@
 
 import os
 import re
-import subprocess
 import time
 import socket
+from collections import namedtuple
 
+from . import localexec
 from .core import JobRecord
+from .command import (
+    CommandFailed,
+    check_command,
+    run_command
+)
+from .slurmrest import (
+    SlurmRestClient,
+    SlurmRestError
+)
+from .jobqueue import (
+    QueueJob,
+    get_queue_snapshot
+)
 
 
 class UnknownScheduler(Exception):
@@ -23,6 +37,8 @@ def create_scheduler(sched_type, config):
     """Factory function for creating Scheduler subclasses."""
     if sched_type == 'slurm':
         return SlurmScheduler(config)
+    elif sched_type == 'slurmrest':
+        return SlurmRestScheduler(config)
     elif sched_type == 'local':
         return LocalScheduler(config)
     else:
@@ -31,6 +47,21 @@ def create_scheduler(sched_type, config):
                                "' is not implemented.")
 
 
+JobCompletion = namedtuple('JobCompletion',
+                           ['jobid', 'state', 'start_time', 'end_time',
+                            'node', 'exit_code'] +
+                           list(JobRecord.usage_fields))
+
+
+def job_completion(jobid, state=None, start_time=None, end_time=None,
+                   node=None, exit_code=None, **usage):
+    """Return a JobCompletion, None meaning unknown for all but jobid.
+
+    Resource usage (see JobRecord.usage_fields) is given by keyword."""
+    return JobCompletion(jobid, state, start_time, end_time, node, exit_code,
+                         *[usage.get(attr) for attr in JobRecord.usage_fields])
+
+
 def submission_failure_preamble(timestamp):
     """Return a string to be prepended to a submission failure log."""
     preamble = "Job submission failed at {0}\n".format(timestamp)
@@ -46,14 +77,33 @@ class Scheduler(object):
         """Construct a scheduler object with AutoCMS config."""
         self.config = config
 
-    def get_completed_jobs(self, joblist):
+    def get_completed_jobs(self, joblist, since=None):
         """Return a list of recently completed jobs.
 
-        Joblist is a list of jobids to check for completion."""
+        Joblist is a list of jobids to check for completion. If since
+        is given only jobs completed after that unix time need to be
+        returned, otherwise the scheduler decides how far to look back."""
         raise NotImplementedError
 
+    def get_job_completions(self, joblist, since=None):
+        """Return a dict of JobCompletion tuples of completed jobs.
+
+        The dict is keyed by the jobids in joblist that have completed
+        (see get_completed_jobs). Schedulers that know when and where
+        a job ran and how it ended fill in the remaining fields, which
+        are otherwise None."""
+        return dict((jobid, job_completion(jobid))
+                    for jobid in self.get_completed_jobs(joblist, since))
+
     def enqueued_job_count(self):
         """Count the number of jobs that user has on the queue."""
+        return len(get_queue_snapshot(self, self.config))
+
+    def query_queue(self):
+        """Return a list of QueueJob tuples of the jobs on the queue.
+
+        Consumers should use autocms.jobqueue.get_queue_snapshot, which
+        shares one recent query between them."""
         raise NotImplementedError
 
     def submit_job(self, counter, testname):
@@ -67,35 +117,126 @@ class Scheduler(object):
         log file to the JobRecord."""
         raise NotImplementedError
 
+    def submits_in_batches(self):
+        """Return True if submit_jobs submits all jobs with one command."""
+        return False
+
+    def submit_jobs(self, counters, testname):
+        """Submit one job for each counter in a list.
+
+        Returns a list of JobRecord objects in the order of counters, see
+        submit_job. Schedulers able to submit several jobs at once
+        should override this, by default jobs are submitted one by one."""
+        return [self.submit_job(counter, testname) for counter in counters]
+
 
 class SlurmScheduler(Scheduler):
     """Interface to slurm scheduler."""
 
+    # job states after which a job will not run again
+    final_states = frozenset(['BOOT_FAIL', 'CANCELLED', 'COMPLETED',
+                              'DEADLINE', 'FAILED', 'NODE_FAIL',
+                              'OUT_OF_MEMORY', 'PREEMPTED', 'TIMEOUT'])
+
+    sacct_format = ('JobID,State,Start,End,NodeList,ExitCode,'
+                    'Elapsed,TotalCPU,MaxRSS,AveDiskRead,AveDiskWrite')
+
     def __init__(self, config):
         Scheduler.__init__(self, config)
 
-    def get_completed_jobs(self, joblist):
-        cmd = ('sacct --state=CA,CD,F,NF,TO '
-               '-S $(date +%Y-%m-%d -d @$(( $(date +%s) - 172800 )) ) '
-               '--accounts={0} --user={1} -n -o "jobid" | '
-               'grep -e "^[0-9]* "'.format(self.config['AUTOCMS_GNAME'],
-                                           self.config['AUTOCMS_UNAME']))
-        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output = result.communicate()[0].splitlines()
-        completed_jobs = [line.strip() for line in output]
-        for job in completed_jobs[:]:
-            if not job in joblist:
-                completed_jobs.remove(job)
-        return completed_jobs
+    def get_completed_jobs(self, joblist, since=None):
+        return list(self.get_job_completions(joblist, since))
 
-    def enqueued_job_count(self):
-        cmd = ('squeue -h --user={0} --account={1} | '
-               'wc -l'.format(self.config['AUTOCMS_UNAME'],
-                              self.config['AUTOCMS_GNAME']))
-        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output = result.communicate()[0].splitlines()
-        count = int(output[0].strip())
-        return count
+    def get_job_completions(self, joblist, since=None):
+        """Query sacct about the jobs in joblist only.
+
+        Jobids are passed to sacct -j in chunks of AUTOCMS_SACCT_CHUNK
+        (200 by default), so the accounting database is only asked about
+        outstanding jobs and since is not needed. The same query returns
+        the resource usage of the jobs. Jobs of a chunk whose sacct fails
+        are left to the next harvest."""
+        jobids = sorted(set(str(jobid) for jobid in joblist
+                            if jobid is not None))
+        chunk = int(self.config.get('AUTOCMS_SACCT_CHUNK', 200))
+        completions = dict()
+        for first in range(0, len(jobids), chunk):
+            cmd = ['sacct', '-P', '-n',
+                   '--user=' + self.config['AUTOCMS_UNAME'],
+                   '-j', ','.join(jobids[first:first + chunk]),
+                   '-o', self.sacct_format]
+            result = run_command(cmd, self.config)
+            if result.returncode == 0:
+                completions.update(self.parse_sacct_output(result.output))
+        return completions
+
+    @classmethod
+    def parse_sacct_output(cls, output):
+        """Return JobCompletions of finished jobs in sacct -P output.
+
+        State, times, node, exit code, elapsed and CPU time are taken
+        from the line of the job allocation. Memory and disk usage are
+        only reported for job steps ('<jobid>.batch', '<jobid>.0', ...),
+        so the largest MaxRSS and the sum of the disk usage of all steps
+        are used."""
+        allocations = []
+        steps = dict()
+        for line in output.splitlines():
+            fields = line.strip().split('|')
+            if len(fields) != 11:
+                continue
+            jobid, step = fields[0].split('.')[0], '.' in fields[0]
+            if step:
+                steps.setdefault(jobid, []).append(fields)
+            else:
+                allocations.append(fields)
+        completions = dict()
+        for fields in allocations:
+            jobid, state, start, end, node, exit_code = fields[0:6]
+            # states like "CANCELLED by 1234" carry extra words
+            state = state.split(' ')[0] if state else ''
+            if state not in cls.final_states:
+                continue
+            rss = [sacct_bytes(step[8]) for step in steps.get(jobid, [])]
+            reads = [sacct_bytes(step[9]) for step in steps.get(jobid, [])]
+            writes = [sacct_bytes(step[10]) for step in steps.get(jobid, [])]
+            completions[jobid] = job_completion(
+                jobid, state, sacct_time(start), sacct_time(end),
+                node if node and node != 'None assigned' else None,
+                sacct_exit_code(exit_code),
+                elapsed=sacct_duration(fields[6]),
+                total_cpu=sacct_duration(fields[7]),
+                max_rss=_max_known(rss),
+                disk_read=_sum_known(reads),
+                disk_write=_sum_known(writes))
+        return completions
+
+    squeue_format = '%i|%T|%V|%S|%M|%N'
+
+    def query_queue(self):
+        """Run one squeue for the jobs of the AutoCMS user and account.
+
+        CommandFailed is raised if squeue fails, as an empty queue would
+        be assumed otherwise."""
+        # -r lists pending array tasks one per line like any other job
+        cmd = ['squeue', '-h', '-r',
+               '--user=' + self.config['AUTOCMS_UNAME'],
+               '--account=' + self.config['AUTOCMS_GNAME'],
+               '--format=' + self.squeue_format]
+        return self.parse_squeue_output(check_command(cmd, self.config))
+
+    @classmethod
+    def parse_squeue_output(cls, output):
+        """Return a list of QueueJob tuples from squeue_format output."""
+        jobs = []
+        for line in output.splitlines():
+            fields = line.strip().split('|')
+            if len(fields) != 6:
+                continue
+            jobid, state, submit, start, elapsed, node = fields
+            jobs.append(QueueJob(jobid, state, sacct_time(submit),
+                                 sacct_time(start), sacct_duration(elapsed),
+                                 node or None))
+        return jobs
 
     def submit_job(self, counter, testname):
         slurm_script = testname + '.slurm'
@@ -103,88 +244,482 @@ class SlurmScheduler(Scheduler):
                                testname)
         # need to go ahead and export the config path in case
         # this was not called through autocms.sh
-        cmd = ('cd {0}; export AUTOCMS_COUNTER={1}; '
-               'export AUTOCMS_CONFIGFILE={2}; '
-               'sbatch --account={3} {4} '
-               '--export=AUTOCMS_COUNTER,AUTOCMS_CONFIGFILE '
-               '2>&1'.format(testdir,
-                             counter,
-                             self.config['AUTOCMS_CONFIGFILE'],
-                             self.config['AUTOCMS_GNAME'],
-                             slurm_script))
-        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        env = dict(os.environ)
+        env['AUTOCMS_COUNTER'] = str(counter)
+        env['AUTOCMS_CONFIGFILE'] = self.config['AUTOCMS_CONFIGFILE']
+        cmd = ['sbatch',
+               '--account=' + self.config['AUTOCMS_GNAME'],
+               slurm_script,
+               '--export=AUTOCMS_COUNTER,AUTOCMS_CONFIGFILE']
         timestamp = int(time.time())
-        sub_output = result.communicate()[0]
+        result = run_command(cmd, self.config, cwd=testdir, env=env,
+                             merge_stderr=True)
+        sub_output = result.output
         if result.returncode == 0:
             jobid = re.sub('Submitted batch job ',
                            '',
                            sub_output.splitlines()[0].strip())
             logfile = testname + '.' + 'slurm' + '.o' + str(jobid) + '.log'
         else:
-            timeouterror = 'timed out'
-            if timeouterror in sub_output:
-               jobid = 1
-            else: 
-               jobid = 2
-            logfile = (testname + '.' + 'submission' + '.o' +
-                       str(timestamp) + "." + str(counter) + '.log')
-            logpath = os.path.join(self.config['AUTOCMS_BASEDIR'],
-                                   testname,
-                                   logfile)
-            sub_output = submission_failure_preamble(timestamp) + sub_output
-            with open(logpath, 'w') as log:
-                log.write(sub_output)
+            return self._failed_submission(counter, testname, timestamp,
+                                           result.returncode, sub_output)
         return JobRecord(counter, jobid, timestamp, result.returncode, logfile)
 
+    def submits_in_batches(self):
+        return self.config.get('AUTOCMS_SLURM_ARRAY', '0') == '1'
+
+    def submit_jobs(self, counters, testname):
+        """Submit the jobs as one job array with a single sbatch call.
+
+        Task i of the array runs with AUTOCMS_COUNTER_BASE set to the
+        first counter and SLURM_ARRAY_TASK_ID set to the offset of its
+        counter, from which autocms_job.sh sets AUTOCMS_COUNTER. Each
+        task writes its own log, '<testname>.slurm.o<jobid>_<task>.log',
+        and is recorded with the jobid '<jobid>_<task>' that sacct and
+        squeue report for it. Arrays are only used for more than one job
+        if AUTOCMS_SLURM_ARRAY is set to 1."""
+        if len(counters) < 2 or not self.submits_in_batches():
+            return Scheduler.submit_jobs(self, counters, testname)
+        counters = [int(counter) for counter in counters]
+        base = min(counters)
+        offsets = [counter - base for counter in counters]
+        testdir = os.path.join(self.config['AUTOCMS_BASEDIR'], testname)
+        env = dict(os.environ)
+        env['AUTOCMS_COUNTER'] = str(base)
+        env['AUTOCMS_COUNTER_BASE'] = str(base)
+        env['AUTOCMS_CONFIGFILE'] = self.config['AUTOCMS_CONFIGFILE']
+        cmd = ['sbatch',
+               '--account=' + self.config['AUTOCMS_GNAME'],
+               '--array=' + self.array_spec(offsets),
+               '--output=' + testname + '.slurm.o%A_%a.log',
+               '--export=AUTOCMS_COUNTER,AUTOCMS_COUNTER_BASE,'
+               'AUTOCMS_CONFIGFILE',
+               testname + '.slurm']
+        timestamp = int(time.time())
+        result = run_command(cmd, self.config, cwd=testdir, env=env,
+                             merge_stderr=True)
+        sub_output = result.output
+        if result.returncode != 0:
+            return [self._failed_submission(counter, testname, timestamp,
+                                            result.returncode, sub_output)
+                    for counter in counters]
+        jobid = re.sub('Submitted batch job ', '',
+                       sub_output.splitlines()[0].strip())
+        records = []
+        for counter, offset in zip(counters, offsets):
+            taskid = '{0}_{1}'.format(jobid, offset)
+            logfile = testname + '.slurm.o' + taskid + '.log'
+            records.append(JobRecord(counter, taskid, timestamp, 0, logfile))
+        return records
+
+    @staticmethod
+    def array_spec(offsets):
+        """Return the sbatch --array value for a list of task offsets."""
+        if offsets == range(offsets[0], offsets[0] + len(offsets)):
+            return '{0}-{1}'.format(offsets[0], offsets[-1])
+        return ','.join(str(offset) for offset in offsets)
+
+    def _failed_submission(self, counter, testname, timestamp, returncode,
+                           sub_output):
+        """Write the submission log of a failed sbatch, return its record."""
+        timeouterror = 'timed out'
+        if timeouterror in sub_output:
+           jobid = 1
+        else: 
+           jobid = 2
+        logfile = (testname + '.' + 'submission' + '.o' +
+                   str(timestamp) + "." + str(counter) + '.log')
+        logpath = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                               testname,
+                               logfile)
+        sub_output = submission_failure_preamble(timestamp) + sub_output
+        with open(logpath, 'w') as log:
+            log.write(sub_output)
+        return JobRecord(counter, jobid, timestamp, returncode, logfile)
+
+
+def _max_known(values):
+    """Return the largest value that is not None, or None."""
+    known = [val for val in values if val is not None]
+    return max(known) if known else None
+
+
+def _sum_known(values):
+    """Return the sum of the values that are not None, or None."""
+    known = [val for val in values if val is not None]
+    return sum(known) if known else None
+
+
+def sacct_time(value):
+    """Return a unix timestamp from a sacct time, None if unknown."""
+    try:
+        return int(time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S')))
+    except ValueError:
+        return None
+
+
+def sacct_exit_code(value):
+    """Return the exit code of a sacct "code:signal" value.
+
+    If the job was killed by a signal, 128 plus the signal number is
+    returned as a shell would. None is returned if unknown."""
+    try:
+        code, signal = [int(part) for part in value.split(':')]
+    except ValueError:
+        return None
+    if code == 0 and signal != 0:
+        return 128 + signal
+    return code
+
+
+def sacct_duration(value):
+    """Return seconds from a sacct [DD-[HH:]]MM:SS[.sss] duration.
+
+    None is returned if the value is empty or cannot be read."""
+    try:
+        days = 0
+        if '-' in value:
+            days, value = value.split('-', 1)
+            days = int(days)
+        parts = [float(part) for part in value.split(':')]
+    except ValueError:
+        return None
+    if not 2 <= len(parts) <= 3:
+        return None
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds*60 + part
+    return days*86400 + seconds
+
+
+def sacct_bytes(value):
+    """Return bytes from a sacct size such as '1024', '512K' or '1.5G'.
+
+    Suffixes are binary multiples. None is returned if the value is
+    empty or cannot be read."""
+    multipliers = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30,
+                   'T': 1 << 40, 'P': 1 << 50}
+    value = value.strip()
+    multiplier = 1
+    if value and value[-1] in multipliers:
+        multiplier = multipliers[value[-1]]
+        value = value[:-1]
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        return None
+
+
+class SlurmRestScheduler(SlurmScheduler):
+    """Interface to slurm through slurmrestd, see autocms.slurmrest.
+
+    The queue and the job completions are each read with one request
+    for all jobs of the AutoCMS user, and the jobs of a cron tick are
+    submitted with one request as a job array if AUTOCMS_SLURM_ARRAY
+    is 1."""
+
+    def __init__(self, config):
+        SlurmScheduler.__init__(self, config)
+        self.client = SlurmRestClient(config)
+
+    def get_job_completions(self, joblist, since=None):
+        """Ask slurmdbd about the user's jobs since the given time.
+
+        The window starts AUTOCMS_SLURMREST_LAG seconds (300 by default)
+        before since, so that jobs which ended before the previous
+        harvest but were only recorded by slurmdbd after it are still
+        found. Without since, the jobs of the last AUTOCMS_LOG_LIFETIME
+        days are asked about. If the request fails the jobs are left to
+        the next harvest."""
+        wanted = set(str(jobid) for jobid in joblist if jobid is not None)
+        if not wanted:
+            return dict()
+        if since is None:
+            since = (int(time.time()) -
+                     3600*24*int(self.config['AUTOCMS_LOG_LIFETIME']))
+        else:
+            since -= int(self.config.get('AUTOCMS_SLURMREST_LAG', 300))
+        try:
+            result = self.client.accounting(since)
+        except SlurmRestError:
+            return dict()
+        return dict((jobid, completion) for jobid, completion in
+                    self.parse_accounting_response(result).iteritems()
+                    if jobid in wanted)
+
+    @classmethod
+    def parse_accounting_response(cls, result):
+        """Return JobCompletions of finished jobs in a slurmdb response.
+
+        Array tasks are keyed '<array jobid>_<task>' as they are
+        submitted. The peak memory and disk usage are taken from the
+        TRES of the job steps like sacct reports them."""
+        completions = dict()
+        for job in result.get('jobs', []):
+            state = _rest_state(job.get('state', {}).get('current'))
+            if state not in cls.final_states:
+                continue
+            jobid = _rest_jobid(job.get('job_id'),
+                                job.get('array', {}).get('job_id'),
+                                job.get('array', {}).get('task_id'))
+            times = job.get('time', {})
+            total_cpu = None
+            if 'total' in times:
+                total_cpu = (
+                    (_rest_number(times['total'].get('seconds')) or 0) +
+                    (_rest_number(times['total'].get('microseconds')) or 0)
+                    / 1e6)
+            steps = [step.get('tres', {}) for step in job.get('steps', [])]
+            node = job.get('nodes')
+            completions[jobid] = job_completion(
+                jobid, state, _rest_time(times.get('start')),
+                _rest_time(times.get('end')),
+                str(node) if node and node != 'None assigned' else None,
+                _rest_exit_code(job.get('exit_code')),
+                elapsed=_rest_number(times.get('elapsed')),
+                total_cpu=total_cpu,
+                max_rss=_max_known(_rest_tres(tres, 'requested', 'max',
+                                              'mem') for tres in steps),
+                disk_read=_sum_known(_rest_tres(tres, 'requested', 'total',
+                                                'fs') for tres in steps),
+                disk_write=_sum_known(_rest_tres(tres, 'consumed', 'total',
+                                                 'fs') for tres in steps))
+        return completions
+
+    def query_queue(self):
+        """List the jobs of the AutoCMS user and account with one request.
+
+        CommandFailed is raised if the request fails, as an empty queue
+        would be assumed otherwise."""
+        try:
+            result = self.client.jobs()
+        except SlurmRestError as err:
+            raise CommandFailed(err.message)
+        return self.parse_jobs_response(result, self.config['AUTOCMS_UNAME'],
+                                        self.config['AUTOCMS_GNAME'],
+                                        time.time())
+
+    @classmethod
+    def parse_jobs_response(cls, result, user, account, now):
+        """Return QueueJob tuples of the pending and running jobs.
+
+        A pending job array is listed by slurmctld as a single job, it is
+        expanded into a QueueJob for each pending task."""
+        jobs = []
+        for job in result.get('jobs', []):
+            if (job.get('user_name') != user or
+                    job.get('account') != account):
+                continue
+            state = _rest_state(job.get('job_state'))
+            if state not in ('PENDING', 'RUNNING'):
+                continue
+            submit = _rest_time(job.get('submit_time'))
+            array_jobid = _rest_number(job.get('array_job_id'))
+            task = _rest_number(job.get('array_task_id'))
+            tasks = job.get('array_task_string')
+            if state == 'PENDING' and array_jobid and task is None and tasks:
+                for task in _rest_task_ids(tasks):
+                    jobs.append(QueueJob('{0}_{1}'.format(array_jobid, task),
+                                         state, submit, None, None, None))
+                continue
+            jobid = _rest_jobid(job.get('job_id'), array_jobid, task)
+            if state == 'PENDING':
+                jobs.append(QueueJob(jobid, state, submit, None, None, None))
+            else:
+                start = _rest_time(job.get('start_time'))
+                node = job.get('nodes')
+                jobs.append(QueueJob(jobid, state, submit, start,
+                                     None if start is None else now - start,
+                                     str(node) if node else None))
+        return jobs
+
+    def submit_job(self, counter, testname):
+        return self._submit([int(counter)], testname, False)[0]
+
+    def submit_jobs(self, counters, testname):
+        """Submit the jobs with one request, see SlurmScheduler.submit_jobs."""
+        if len(counters) < 2 or not self.submits_in_batches():
+            return Scheduler.submit_jobs(self, counters, testname)
+        return self._submit([int(counter) for counter in counters],
+                            testname, True)
+
+    def _submit(self, counters, testname, array):
+        """Submit one job, or a job array of the counters, return records."""
+        testdir = os.path.join(self.config['AUTOCMS_BASEDIR'], testname)
+        base = min(counters)
+        offsets = [counter - base for counter in counters]
+        environment = {'AUTOCMS_COUNTER': str(base),
+                       'AUTOCMS_CONFIGFILE': self.config['AUTOCMS_CONFIGFILE']}
+        job = {'account': self.config['AUTOCMS_GNAME'],
+               'name': testname + '.slurm',
+               'current_working_directory': testdir}
+        if array:
+            environment['AUTOCMS_COUNTER_BASE'] = str(base)
+            job['array'] = self.array_spec(offsets)
+            output = testname + '.slurm.o%A_%a.log'
+        else:
+            output = testname + '.slurm.o%j.log'
+        job['standard_output'] = os.path.join(testdir, output)
+        job['environment'] = ['{0}={1}'.format(name, value) for name, value
+                              in sorted(environment.iteritems())]
+        timestamp = int(time.time())
+        try:
+            with open(os.path.join(testdir, testname + '.slurm')) as handle:
+                script = handle.read()
+            jobid = str(self.client.submit(script, job)['job_id'])
+        except (IOError, KeyError, SlurmRestError) as err:
+            message = getattr(err, 'message', None) or str(err)
+            return [self._failed_submission(counter, testname, timestamp, 1,
+                                            message + '\n')
+                    for counter in counters]
+        if not array:
+            logfile = testname + '.slurm.o' + jobid + '.log'
+            return [JobRecord(base, jobid, timestamp, 0, logfile)]
+        records = []
+        for counter, offset in zip(counters, offsets):
+            taskid = '{0}_{1}'.format(jobid, offset)
+            logfile = testname + '.slurm.o' + taskid + '.log'
+            records.append(JobRecord(counter, taskid, timestamp, 0, logfile))
+        return records
+
+
+def _rest_number(value):
+    """Return a slurmrestd number, which may be {"set": .., "number": ..}."""
+    if isinstance(value, dict):
+        if not value.get('set', True) or value.get('infinite'):
+            return None
+        value = value.get('number')
+    return value
+
+
+def _rest_time(value):
+    """Return a unix time from slurmrestd, None if unknown or zero."""
+    value = _rest_number(value)
+    return int(value) if value else None
+
+
+def _rest_state(value):
+    """Return a job state from slurmrestd, which may be a list of flags."""
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return str(value) if value else ''
+
+
+def _rest_jobid(job_id, array_job_id, task_id):
+    """Return the jobid of a job, '<array jobid>_<task>' for array tasks."""
+    array_job_id = _rest_number(array_job_id)
+    task_id = _rest_number(task_id)
+    if array_job_id and task_id is not None:
+        return '{0}_{1}'.format(array_job_id, task_id)
+    return str(_rest_number(job_id))
+
+
+def _rest_exit_code(value):
+    """Return the exit code of a slurmrestd exit_code, 128 + signal if
+    killed by a signal, or None if unknown."""
+    if not isinstance(value, dict):
+        return _rest_number(value)
+    signal = _rest_number(value.get('signal', {}).get('signal_id'))
+    if value.get('status') == 'SIGNALED' and signal:
+        return 128 + signal
+    return _rest_number(value.get('return_code'))
+
+
+def _rest_tres(tres, kind, stat, tres_type):
+    """Return the count of a TRES type in a step's tres[kind][stat]."""
+    for item in tres.get(kind, {}).get(stat, []):
+        if item.get('type') == tres_type:
+            return _rest_number(item.get('count'))
+    return None
+
+
+def _rest_task_ids(tasks):
+    """Return the task ids of an array task string such as '0-9:2,12%4'."""
+    task_ids = []
+    for part in tasks.split('%')[0].split(','):
+        step = 1
+        if ':' in part:
+            part, step = part.split(':')
+            step = int(step)
+        if '-' in part:
+            first, last = part.split('-')
+            task_ids.extend(range(int(first), int(last) + 1, step))
+        elif part:
+            task_ids.append(int(part))
+    return task_ids
+
 
 class LocalScheduler(Scheduler):
-    """Run jobs in the background of the local machine."""
+    """Run jobs on the local machine under the autocms.localexec supervisor.
+
+    Submitted jobs are queued in the spool of the supervisor, which runs
+    at most AUTOCMS_MAXENQUEUE of them at a time and records how each
+    ended in its status file."""
 
     def __init__(self, config):
         Scheduler.__init__(self, config)
 
-    def get_completed_jobs(self, joblist):
-        cmd = ('ps -u {0}'.format(self.config['AUTOCMS_UNAME']))
-        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output = result.communicate()[0].splitlines()
-        running_procs = [line.split()[0] for line in output]
-        completed_jobs = joblist[:]
-        for job in joblist:
-            if job in running_procs:
-                completed_jobs.remove(job)
-        return completed_jobs
+    def get_completed_jobs(self, joblist, since=None):
+        return list(self.get_job_completions(joblist, since))
 
-    def enqueued_job_count(self):
-        # there is no queue, return 0
-        return 0
+    def get_job_completions(self, joblist, since=None):
+        """Read the status files of the jobs in joblist.
+
+        Jobs started before the supervisor was used have no status file
+        and are reported completed without further information. Jobs of
+        the supervisor whose status file is missing, for example because
+        it could not be written, stay pending until they are purged after
+        AUTOCMS_LOG_LIFETIME days."""
+        completions = dict()
+        for jobid in joblist:
+            if jobid is None:
+                continue
+            status = localexec.read_job_status(jobid, self.config)
+            if status is None:
+                if not localexec.is_supervisor_jobid(jobid):
+                    completions[jobid] = job_completion(jobid)
+            elif status['state'] == 'COMPLETED':
+                elapsed = None
+                if (status['start_time'] is not None and
+                        status['end_time'] is not None):
+                    elapsed = status['end_time'] - status['start_time']
+                node = status['node']
+                completions[jobid] = job_completion(
+                    jobid, 'COMPLETED', status['start_time'],
+                    status['end_time'],
+                    None if node is None else str(node),
+                    status['exit_code'], max_rss=status['max_rss'],
+                    total_cpu=status['total_cpu'], elapsed=elapsed)
+        return completions
+
+    def query_queue(self):
+        jobs = []
+        for status in localexec.list_job_statuses(self.config):
+            if status['state'] == 'COMPLETED':
+                continue
+            elapsed = None
+            if status['start_time'] is not None:
+                elapsed = time.time() - status['start_time']
+            node = status['node']
+            jobs.append(QueueJob(str(status['jobid']), str(status['state']),
+                                 status['submit_time'], status['start_time'],
+                                 elapsed, None if node is None else str(node)))
+        return jobs
 
     def submit_job(self, counter, testname):
-        local_script = testname + '.local'
         timestamp = int(time.time())
-        logfile = (testname + '.local.o' + str(timestamp) +
-                   '.' + str(counter) + '.log')
-        testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
-                               testname)
-        cmd = ('cd {0}; export AUTOCMS_COUNTER={1}; '
-               ' export AUTOCMS_CONFIGFILE={2}; '
-               ' nohup bash {3} > {4} '
-               ' 2>&1 &'.format(testdir,
-                                counter,
-                                self.config['AUTOCMS_CONFIGFILE'],
-                                local_script,
-                                logfile))
-        result = subprocess.Popen(cmd,
-                                  shell=True,
-                                  stdout=subprocess.PIPE)
-        sub_output = result.communicate()[0]
-        if result.returncode == 0:
-            jobid = result.pid
-        else:
-            jobid = None
+        try:
+            status = localexec.spool_job(counter, testname, self.config)
+            localexec.ensure_supervisor(self.config)
+        except (IOError, OSError) as err:
+            logfile = (testname + '.local.o' + str(timestamp) +
+                       '.' + str(counter) + '.log')
             logpath = os.path.join(self.config['AUTOCMS_BASEDIR'],
                                    testname,
                                    logfile)
-            sub_output = submission_failure_preamble(timestamp) + sub_output
+            sub_output = submission_failure_preamble(timestamp) + str(err)
             with open(logpath, 'w') as log:
                 log.write(sub_output)
-        return JobRecord(counter, jobid, timestamp, result.returncode, logfile)
+            return JobRecord(counter, None, timestamp, 1, logfile)
+        return JobRecord(counter, str(status['jobid']), status['submit_time'],
+                         0, str(status['logfile']))
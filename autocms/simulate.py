@@ -0,0 +1,544 @@
+"""Discrete-event simulation of AutoCMS running tests for weeks or months.
+
+The real perform_test_submission, perform_test_harvesting (or
+perform_harvesting with AUTOCMS_COMBINED_HARVEST=1),
+perform_stats_harvesting, and perform_test_reporting are called on the
+schedule the generated crontab would call them (see autocms.sh), against
+a simulated scheduler and a virtual clock, in a separate AUTOCMS_BASEDIR
+and AUTOCMS_WEBDIR. Simulated time jumps from one scheduled call to the
+next, so weeks of operation take minutes.
+
+The simulated scheduler draws the queue wait, run time, node, exit code,
+error string, and resource usage of each submitted job from the
+completed jobs in the records of the test in the historical
+AUTOCMS_BASEDIR, and submissions fail at the historical rate. Logs with
+the AutoCMS tokens are written once a job ends, with the end time as
+their modification time.
+
+For every stage the number of calls, CPU time, and bytes read and
+written by the process are measured, and the number of job records is
+counted after each harvest, so the effect of e.g. AUTOCMS_MAXENQUEUE,
+AUTOCMS_TEST_SUBWAITS, AUTOCMS_TEST_SUBCOUNTS or AUTOCMS_LOG_LIFETIME
+can be compared before changing the production configuration.
+"""
+
+import os
+import time
+import heapq
+import random
+import shutil
+import resource
+import importlib
+import threading
+
+from .core import (
+    JobRecord,
+    load_records
+)
+from .scheduler import (
+    Scheduler,
+    job_completion,
+    submission_failure_preamble
+)
+from .jobqueue import QueueJob
+
+
+# AutoCMS modules calling time.time(), given the virtual clock instead
+clocked_modules = ('archive', 'core', 'harvest', 'jobqueue', 'plot',
+                   'scheduler', 'stats', 'submit', 'web')
+
+# AutoCMS modules creating schedulers, given SimulatedScheduler instead
+scheduled_modules = ('harvest', 'submit', 'web')
+
+# the cluster SimulatedScheduler objects submit to while simulating
+active_cluster = None
+
+
+class SimulationError(Exception):
+    """Exception for a simulation that can not be run."""
+    def __init__(self, message):
+        super(SimulationError, self).__init__(message)
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+
+class VirtualClock(object):
+    """Stand-in for the time module reporting the simulated time.
+
+    Functions taking an optional time default to the simulated time,
+    sleep advances it, and everything else is the real time module."""
+
+    def __init__(self, now):
+        self.now = float(now)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def ctime(self, seconds=None):
+        return time.ctime(self.now if seconds is None else seconds)
+
+    def localtime(self, seconds=None):
+        return time.localtime(self.now if seconds is None else seconds)
+
+    def gmtime(self, seconds=None):
+        return time.gmtime(self.now if seconds is None else seconds)
+
+    def strftime(self, fmt, timetuple=None):
+        if timetuple is None:
+            timetuple = time.localtime(self.now)
+        return time.strftime(fmt, timetuple)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def install_clock(clock):
+    """Replace the time module of the AutoCMS modules with a clock.
+
+    Return a dict of the replaced modules to pass to remove_clock."""
+    replaced = dict()
+    for name in clocked_modules:
+        module = importlib.import_module('autocms.' + name)
+        replaced[module] = module.time
+        module.time = clock
+    return replaced
+
+
+def remove_clock(replaced):
+    """Restore the time modules replaced by install_clock."""
+    for module, original in replaced.iteritems():
+        module.time = original
+
+
+def install_scheduler():
+    """Make the AutoCMS modules create a SimulatedScheduler.
+
+    The scheduler type 'simulated' creates a SimulatedScheduler, any
+    other type is passed on to the original factory. Return a dict of
+    the replaced factories to pass to remove_scheduler."""
+    replaced = dict()
+    for name in scheduled_modules:
+        module = importlib.import_module('autocms.' + name)
+        replaced[module] = module.create_scheduler
+        module.create_scheduler = _simulated_factory(module.create_scheduler)
+    return replaced
+
+
+def remove_scheduler(replaced):
+    """Restore the scheduler factories replaced by install_scheduler."""
+    for module, original in replaced.iteritems():
+        module.create_scheduler = original
+
+
+def _simulated_factory(factory):
+    """Wrap a scheduler factory to also create SimulatedSchedulers."""
+    def create_scheduler(sched_type, config):
+        if sched_type == 'simulated':
+            return SimulatedScheduler(config)
+        return factory(sched_type, config)
+    return create_scheduler
+
+
+class JobHistory(object):
+    """Outcomes of historical jobs that simulated jobs are drawn from.
+
+    Attributes:
+        samples: list of completed JobRecords submitted without error.
+        submit_failure_rate (float): fraction of failed submissions."""
+
+    def __init__(self, records):
+        self.samples = [job for job in records
+                        if job.completed and job.submit_status == 0 and
+                        job.submit_time <= job.start_time <= job.end_time]
+        failed = sum(1 for job in records if job.submit_status != 0)
+        self.submit_failure_rate = (float(failed) / len(records)
+                                    if records else 0.0)
+
+    @classmethod
+    def from_test(cls, testname, config):
+        """Return the history of a test in the configured record store."""
+        history = cls(load_records(testname, config))
+        if not history.samples:
+            raise SimulationError('No completed jobs in the records of '
+                                  'test ' + testname + '.')
+        return history
+
+    def sample(self, rand):
+        """Return a random completed historical JobRecord."""
+        return rand.choice(self.samples)
+
+
+class SimulatedJob(object):
+    """A job submitted to the simulated cluster."""
+
+    __slots__ = ('jobid', 'testname', 'submit_time', 'start_time',
+                 'end_time', 'past', 'logpath', 'logged')
+
+    def __init__(self, jobid, testname, submit_time, past, logpath):
+        self.jobid = jobid
+        self.testname = testname
+        self.submit_time = submit_time
+        self.start_time = submit_time + past.wait_time()
+        self.end_time = self.start_time + past.run_time()
+        self.past = past
+        self.logpath = logpath
+        self.logged = False
+
+
+class SimulatedCluster(object):
+    """Jobs of all simulated tests, replaying historical outcomes.
+
+    Only submission and the queue use a lock, since the submitter may
+    submit from several threads (see autocms.submit)."""
+
+    def __init__(self, histories, clock, config, seed=None):
+        self.histories = histories
+        self.clock = clock
+        self.config = config
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.jobs = dict()
+        self.open_jobs = dict()
+        self.next_jobid = 100000
+        self.submitted = 0
+
+    def submit(self, counter, testname):
+        """Queue a job, return its JobRecord."""
+        now = int(self.clock.time())
+        testdir = os.path.join(self.config['AUTOCMS_BASEDIR'], testname)
+        history = self.histories[testname]
+        with self.lock:
+            self.submitted += 1
+            failed = self.rand.random() < history.submit_failure_rate
+            past = history.sample(self.rand)
+            jobid = str(self.next_jobid)
+            self.next_jobid += 1
+        if failed:
+            logfile = '{0}.submission.o{1}.{2}.log'.format(testname, now,
+                                                           counter)
+            with open(os.path.join(testdir, logfile), 'w') as log:
+                log.write(submission_failure_preamble(now) +
+                          'Simulated submission failure.\n')
+            return JobRecord(counter, 2, now, 1, logfile)
+        logfile = '{0}.sim.o{1}.log'.format(testname, jobid)
+        job = SimulatedJob(jobid, testname, now, past,
+                           os.path.join(testdir, logfile))
+        with self.lock:
+            self.jobs[jobid] = job
+            self.open_jobs[jobid] = job
+        return JobRecord(counter, jobid, now, 0, logfile)
+
+    def finish_jobs(self):
+        """Write the logs of the jobs that have ended by now."""
+        now = self.clock.time()
+        with self.lock:
+            ended = [job for job in self.open_jobs.itervalues()
+                     if job.end_time <= now]
+            for job in ended:
+                del self.open_jobs[job.jobid]
+        for job in ended:
+            self.write_log(job)
+
+    def write_log(self, job):
+        """Write the log a job would have written, dated at its end."""
+        config = self.config
+        past = job.past
+        lines = [config['AUTOCMS_start_time_TOKEN'] + str(job.start_time),
+                 config['AUTOCMS_node_TOKEN'] + str(past.node)]
+        if past.is_success():
+            lines.append(config['AUTOCMS_SUCCESS_TOKEN'])
+        else:
+            lines.append(config['AUTOCMS_error_string_TOKEN'] +
+                         str(past.error_string))
+        lines.append(config['AUTOCMS_end_time_TOKEN'] + str(job.end_time))
+        lines.append(config['AUTOCMS_exit_code_TOKEN'] + str(past.exit_code))
+        with open(job.logpath, 'w') as log:
+            log.write('\n'.join(lines) + '\n')
+        os.utime(job.logpath, (job.end_time, job.end_time))
+        job.logged = True
+
+    def completions(self, joblist):
+        """Return JobCompletions of the listed jobs that have ended."""
+        self.finish_jobs()
+        now = self.clock.time()
+        completions = dict()
+        for jobid in joblist:
+            job = self.jobs.get(str(jobid))
+            if job is None or job.end_time > now:
+                continue
+            past = job.past
+            completions[jobid] = job_completion(
+                jobid, 'COMPLETED' if past.exit_code == 0 else 'FAILED',
+                job.start_time, job.end_time, past.node, past.exit_code,
+                **dict((attr, getattr(past, attr))
+                       for attr in JobRecord.usage_fields))
+        return completions
+
+    def queue(self):
+        """Return QueueJob tuples of the pending and running jobs."""
+        self.finish_jobs()
+        now = self.clock.time()
+        jobs = []
+        with self.lock:
+            open_jobs = sorted(self.open_jobs.values(),
+                               key=lambda job: int(job.jobid))
+        for job in open_jobs:
+            if job.start_time > now:
+                jobs.append(QueueJob(job.jobid, 'PENDING', job.submit_time,
+                                     None, None, None))
+            else:
+                jobs.append(QueueJob(job.jobid, 'RUNNING', job.submit_time,
+                                     job.start_time, now - job.start_time,
+                                     job.past.node))
+        return jobs
+
+
+class SimulatedScheduler(Scheduler):
+    """Scheduler of the active SimulatedCluster, AUTOCMS_SCHEDULER=simulated.
+
+    Only usable while a Simulation is running."""
+
+    def __init__(self, config):
+        super(SimulatedScheduler, self).__init__(config)
+        if active_cluster is None:
+            raise SimulationError('The simulated scheduler is only '
+                                  'available while simulating.')
+        self.cluster = active_cluster
+
+    def get_completed_jobs(self, joblist, since=None):
+        return list(self.cluster.completions(joblist))
+
+    def get_job_completions(self, joblist, since=None):
+        return self.cluster.completions(joblist)
+
+    def query_queue(self):
+        return self.cluster.queue()
+
+    def submit_job(self, counter, testname):
+        return self.cluster.submit(counter, testname)
+
+
+class StageUsage(object):
+    """Resources used by all calls of one stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.cpu_time = 0.0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.wall_time = 0.0
+
+    def measure(self, perform):
+        """Call perform, adding the resources it used."""
+        cpu_start = _cpu_time()
+        io_start = _io_bytes()
+        wall_start = time.time()
+        try:
+            perform()
+        finally:
+            self.wall_time += time.time() - wall_start
+            self.cpu_time += _cpu_time() - cpu_start
+            io_end = _io_bytes()
+            if io_start is not None and io_end is not None:
+                self.read_bytes += io_end[0] - io_start[0]
+                self.write_bytes += io_end[1] - io_start[1]
+            self.calls += 1
+
+
+def _cpu_time():
+    """Return user and system CPU seconds of the process and children."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime +
+            children.ru_utime + children.ru_stime)
+
+
+def _io_bytes():
+    """Return (read, written) bytes of the process, None if unknown.
+
+    These are the rchar and wchar counts of /proc/self/io, which include
+    reads and writes served by the page cache."""
+    try:
+        with open('/proc/self/io') as handle:
+            counts = dict(line.split(':') for line in handle)
+        return int(counts['rchar']), int(counts['wchar'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def crontab_schedule(config):
+    """Return (stage, testname, period, offset) of the crontab entries.
+
+    Periods and offsets are in seconds; the entries match the crontab
+    printed by autocms.sh. The testname of a combined harvest is None."""
+    testnames = config['AUTOCMS_TEST_NAMES'].split(':')
+    subwaits = config['AUTOCMS_TEST_SUBWAITS'].split(':')
+    combined = config.get('AUTOCMS_COMBINED_HARVEST') == '1'
+    stat_period = 3600*int(config['AUTOCMS_STAT_INTERVAL'])
+    schedule = []
+    if combined:
+        schedule.append(('harvest', None, 600, 0))
+    for testname, subwait in zip(testnames, subwaits):
+        subwait = int(subwait)
+        if subwait < 60:
+            schedule.append(('submit', testname, 60*subwait, 0))
+            if not combined:
+                schedule.append(('harvest', testname, 600, 0))
+            schedule.append(('report', testname, 600, 300))
+        else:
+            schedule.append(('submit', testname, 3600*(subwait // 60), 0))
+            if not combined:
+                schedule.append(('harvest', testname, 1800, 600))
+            schedule.append(('report', testname, 1800, 1200))
+        schedule.append(('stats', testname, stat_period, 57*60))
+    return schedule
+
+
+def _next_due(after, period, offset):
+    """Return the first time past after of offset plus a multiple of period."""
+    return (after - offset) // period * period + period + offset
+
+
+class Simulation(object):
+    """Run AutoCMS for a span of virtual time, see module docstring.
+
+    The configuration is a copy of config with AUTOCMS_BASEDIR and
+    AUTOCMS_WEBDIR set to the simulation directory and the simulated
+    scheduler selected. Histories is a dict of a JobHistory for each
+    test in AUTOCMS_TEST_NAMES. If a list of stages is given only
+    those are performed."""
+
+    def __init__(self, histories, config, simdir, start=None, seed=None,
+                 stages=None):
+        self.config = dict(config)
+        self.config['AUTOCMS_BASEDIR'] = simdir
+        self.config['AUTOCMS_WEBDIR'] = os.path.join(simdir, 'web')
+        self.config['AUTOCMS_SCHEDULER'] = 'simulated'
+        self.testnames = config['AUTOCMS_TEST_NAMES'].split(':')
+        for testname in self.testnames:
+            if testname not in histories:
+                raise SimulationError('No job history for test ' +
+                                      testname + '.')
+        if start is None:
+            start = int(time.time()) // 60 * 60
+        self.start = start
+        self.clock = VirtualClock(start)
+        self.cluster = SimulatedCluster(histories, self.clock, self.config,
+                                        seed)
+        self.stages = dict((name, StageUsage(name)) for name in
+                           ('submit', 'harvest', 'stats', 'report'))
+        # the stages to simulate, e.g. without reports
+        self.simulated_stages = stages or list(self.stages)
+        self.num_records = dict((testname, 0) for testname in self.testnames)
+        self.max_records = dict((testname, 0) for testname in self.testnames)
+        counts = config['AUTOCMS_TEST_SUBCOUNTS'].split(':')
+        self.subcounts = dict(zip(self.testnames,
+                                  [int(count) for count in counts]))
+
+    def setup(self, sourcedir):
+        """Create the test directories, copying the web files needed.
+
+        The stylesheet and each test's description.html are copied from
+        the AutoCMS base directory sourcedir."""
+        shutil.copy(os.path.join(sourcedir, 'default.css'),
+                    self.config['AUTOCMS_BASEDIR'])
+        for testname in self.testnames:
+            testdir = os.path.join(self.config['AUTOCMS_BASEDIR'], testname)
+            if not os.path.isdir(testdir):
+                os.makedirs(testdir)
+            description = os.path.join(sourcedir, testname,
+                                       'description.html')
+            if os.path.isfile(description):
+                shutil.copy(description, testdir)
+
+    def perform(self, stage, testname):
+        """Return a function performing a stage for a test."""
+        # imported here since autocms.submit imports autocms.scheduler,
+        # which creates the simulated scheduler from this module
+        from .submit import perform_test_submission
+        from .harvest import perform_harvesting, perform_test_harvesting
+        from .stats import perform_stats_harvesting
+        from .web import perform_test_reporting
+        config = self.config
+        if stage == 'submit':
+            count = self.subcounts.get(testname, 1)
+            return lambda: perform_test_submission(count, testname, config)
+        if stage == 'harvest' and testname is None:
+            return lambda: perform_harvesting(self.testnames, config)
+        if stage == 'harvest':
+            return lambda: perform_test_harvesting(testname, config)
+        if stage == 'stats':
+            return lambda: perform_stats_harvesting(testname, config)
+        return lambda: perform_test_reporting(testname, config)
+
+    def count_records(self, testnames):
+        """Update the record counts of tests after a harvest."""
+        for testname in testnames:
+            count = len(load_records(testname, self.config))
+            self.num_records[testname] = count
+            self.max_records[testname] = max(count,
+                                             self.max_records[testname])
+
+    def run(self, seconds):
+        """Simulate the crontab for the given number of seconds."""
+        global active_cluster
+        end = self.start + seconds
+        events = []
+        for order, entry in enumerate(crontab_schedule(self.config)):
+            stage, testname, period, offset = entry
+            if stage not in self.simulated_stages:
+                continue
+            due = _next_due(self.start - 1, period, offset)
+            events.append((due, order, entry))
+        heapq.heapify(events)
+        replaced = install_clock(self.clock)
+        factories = install_scheduler()
+        active_cluster = self.cluster
+        try:
+            while events and events[0][0] < end:
+                due, order, entry = heapq.heappop(events)
+                stage, testname, period, offset = entry
+                self.clock.now = due
+                self.stages[stage].measure(self.perform(stage, testname))
+                if stage == 'harvest':
+                    self.count_records([testname] if testname else
+                                       self.testnames)
+                heapq.heappush(events, (_next_due(due, period, offset),
+                                        order, entry))
+            self.clock.now = end
+        finally:
+            active_cluster = None
+            remove_scheduler(factories)
+            remove_clock(replaced)
+
+    def report(self):
+        """Return a text report of the resources used by each stage."""
+        lines = ['Simulated {0:.1f} days from {1}, {2} jobs submitted.'.format(
+                     (self.clock.now - self.start) / 86400.0,
+                     time.ctime(self.start), self.cluster.submitted),
+                 '',
+                 '{0:<8} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+                     'stage', 'calls', 'cpu [s]', 'cpu/call', 'read [MB]',
+                     'write [MB]')]
+        for name in ('submit', 'harvest', 'stats', 'report'):
+            usage = self.stages[name]
+            lines.append('{0:<8} {1:7d} {2:10.2f} {3:10.4f} {4:10.2f} '
+                         '{5:10.2f}'.format(
+                             name, usage.calls, usage.cpu_time,
+                             usage.cpu_time / max(usage.calls, 1),
+                             usage.read_bytes / 1e6,
+                             usage.write_bytes / 1e6))
+        lines.append('')
+        lines.append('{0:<20} {1:>10} {2:>10}'.format('test', 'records',
+                                                      'max'))
+        for testname in self.testnames:
+            lines.append('{0:<20} {1:10d} {2:10d}'.format(
+                testname, self.num_records[testname],
+                self.max_records[testname]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,234 @@
+"""Client of the slurmrestd REST API with pooled keep-alive connections.
+
+The slurmrest scheduler (see autocms.scheduler.SlurmRestScheduler) asks
+slurmrestd instead of forking sbatch, squeue and sacct. It is configured
+with:
+
+    AUTOCMS_SLURMREST_URL      'unix:///path/to/slurmrestd.socket' or
+                               'http://host:port' of slurmrestd
+    AUTOCMS_SLURMREST_TOKEN    JWT of AUTOCMS_UNAME, e.g. from
+                               'scontrol token', else SLURM_JWT from the
+                               environment is used
+    AUTOCMS_SLURMREST_VERSION  API version of the paths (v0.0.39)
+    AUTOCMS_SLURMREST_TIMEOUT  seconds to wait for a response, by
+                               default AUTOCMS_COMMAND_TIMEOUT (60)
+    AUTOCMS_SLURMREST_LAG      seconds before the previous harvest from
+                               which completed jobs are looked up (300)
+
+Connections are HTTP/1.1 and kept open between requests. Idle
+connections are pooled per URL, so every scheduler object and thread of
+a process reuses them. The latency of each request is added to the
+command metrics under 'slurmrest.<request>' (see autocms.command).
+"""
+
+import os
+import json
+import time
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+
+from .command import (
+    CommandResult,
+    record_command_latency
+)
+
+
+class SlurmRestError(Exception):
+    """Exception for a failed slurmrestd request."""
+    def __init__(self, message, status=None):
+        super(SlurmRestError, self).__init__(message)
+        self.message = message
+        self.status = status
+
+    def __str__(self):
+        return repr(self.message)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection over a unix domain socket."""
+
+    def __init__(self, path, timeout):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections to one slurmrestd, shared by threads.
+
+    Attributes:
+        prefix: path of the URL that request paths are appended to.
+        opened (int): number of connections opened so far."""
+
+    def __init__(self, url, timeout):
+        parsed = urlparse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.timeout = timeout
+        if self.scheme == 'unix':
+            self.address = parsed.path
+            self.prefix = ''
+        elif self.scheme in ('http', 'https'):
+            self.address = parsed.netloc
+            self.prefix = parsed.path.rstrip('/')
+        else:
+            raise SlurmRestError('Unsupported slurmrestd URL ' + url)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def _connect(self):
+        """Return a new connection."""
+        with self.lock:
+            self.opened += 1
+        if self.scheme == 'unix':
+            return UnixHTTPConnection(self.address, self.timeout)
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.address,
+                                           timeout=self.timeout)
+        return httplib.HTTPConnection(self.address, timeout=self.timeout)
+
+    def request(self, method, path, body, headers):
+        """Send a request, return the response status and body.
+
+        A request failing on a reused connection, which slurmrestd may
+        have closed while idle, is sent once more on a new connection."""
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+            try:
+                conn.request(method, self.prefix + path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+            return response.status, data
+
+    def close(self):
+        """Close the idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+# ConnectionPool by (URL, timeout)
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(url, timeout):
+    """Return the shared ConnectionPool of a slurmrestd URL."""
+    with _pools_lock:
+        key = (url, timeout)
+        if key not in _pools:
+            _pools[key] = ConnectionPool(url, timeout)
+        return _pools[key]
+
+
+def close_connection_pools():
+    """Close the idle connections of all pools."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+
+class SlurmRestClient(object):
+    """Requests to slurmrestd made on behalf of AUTOCMS_UNAME."""
+
+    def __init__(self, config):
+        self.config = config
+        self.version = config.get('AUTOCMS_SLURMREST_VERSION', 'v0.0.39')
+        self.token = (config.get('AUTOCMS_SLURMREST_TOKEN') or
+                      os.environ.get('SLURM_JWT', ''))
+        timeout = float(config.get('AUTOCMS_SLURMREST_TIMEOUT',
+                                   config.get('AUTOCMS_COMMAND_TIMEOUT', 60)))
+        self.pool = get_connection_pool(config['AUTOCMS_SLURMREST_URL'],
+                                        timeout)
+
+    def call(self, name, method, path, query=None, payload=None):
+        """Send a request, return the decoded JSON response.
+
+        SlurmRestError is raised if the request fails, times out, or the
+        response reports errors."""
+        headers = {'Accept': 'application/json',
+                   'X-SLURM-USER-NAME': self.config['AUTOCMS_UNAME'],
+                   'X-SLURM-USER-TOKEN': self.token}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        if query:
+            path += '?' + urllib.urlencode(sorted(query.items()))
+        start = time.time()
+        status = None
+        timed_out = False
+        try:
+            status, data = self.pool.request(method, path, body, headers)
+        except socket.timeout:
+            timed_out = True
+            raise SlurmRestError('slurmrestd request {0} timed out after '
+                                 '{1:g} seconds'.format(name,
+                                                        self.pool.timeout))
+        except (httplib.HTTPException, socket.error) as err:
+            raise SlurmRestError('slurmrestd request {0} failed: '
+                                 '{1}'.format(name, err))
+        finally:
+            returncode = 0 if status == 200 else (status or 1)
+            record_command_latency(
+                CommandResult(['slurmrest.' + name], returncode, '',
+                              time.time() - start, timed_out), self.config)
+        try:
+            result = json.loads(data)
+        except ValueError:
+            raise SlurmRestError('slurmrestd request {0} returned status '
+                                 '{1} without JSON'.format(name, status),
+                                 status)
+        errors = [error.get('description') or error.get('error') or
+                  str(error) for error in result.get('errors') or []]
+        if status != 200 or errors:
+            raise SlurmRestError('slurmrestd request {0} returned status '
+                                 '{1}: {2}'.format(name, status,
+                                                   '; '.join(errors)),
+                                 status)
+        return result
+
+    def jobs(self):
+        """Return the response listing the jobs known to slurmctld."""
+        return self.call('jobs', 'GET',
+                         '/slurm/{0}/jobs'.format(self.version))
+
+    def accounting(self, start_time):
+        """Return the accounting response of the user's jobs since then."""
+        return self.call('accounting', 'GET',
+                         '/slurmdb/{0}/jobs'.format(self.version),
+                         {'users': self.config['AUTOCMS_UNAME'],
+                          'start_time': int(start_time)})
+
+    def submit(self, script, job):
+        """Submit a batch script with job properties, return the response."""
+        return self.call('submit', 'POST',
+                         '/slurm/{0}/job/submit'.format(self.version),
+                         payload={'script': script, 'job': job})
@@ -0,0 +1,181 @@
+"""Columnar snapshot of JobRecords for read-only consumers.
+
+After each harvest the guaranteed numeric attributes of all JobRecords
+of a test are written as one NumPy array per column to a new versioned
+directory 'records.snapshot.<suffix>' in the test directory, and the
+symlink 'records.snapshot' is switched to it. The node and error_string
+attributes are stored as integer codes into interned string tables.
+The optional resource usage attributes are stored as float columns
+with NaN where the usage is unknown.
+
+Readers memory-map the arrays, so loading a snapshot costs almost
+nothing regardless of the number of records, and windows and aggregates
+can be computed with vectorized operations instead of iterating over
+JobRecord objects.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+from .core import (
+    JobRecord,
+    _to_str
+)
+
+
+numeric_columns = (('seq', 'int64'),
+                   ('submit_time', 'int64'),
+                   ('start_time', 'int64'),
+                   ('end_time', 'int64'),
+                   ('exit_code', 'int64'),
+                   ('submit_status', 'int64'),
+                   ('completed', 'bool'))
+
+string_columns = ('node', 'error_string')
+
+usage_columns = JobRecord.usage_fields
+
+
+def snapshot_path(testname, config):
+    """Return the path of the snapshot directory of a test."""
+    return os.path.join(config['AUTOCMS_BASEDIR'], testname,
+                        'records.snapshot')
+
+
+def write_record_snapshot(records, testname, config):
+    """Write a columnar snapshot of a JobRecord list.
+
+    The snapshot is written to a new versioned directory. The snapshot
+    symlink is then pointed at it by renaming a new symlink over it,
+    which is atomic, so readers always find a complete snapshot. The
+    previous version is kept for readers still mapping it, and older
+    versions are removed."""
+    snapdir = snapshot_path(testname, config)
+    testdir = os.path.dirname(snapdir)
+    newdir = tempfile.mkdtemp(prefix='records.snapshot.', dir=testdir)
+    os.chmod(newdir, 0o755)
+    for name, dtype in numeric_columns:
+        column = np.fromiter((getattr(job, name) for job in records),
+                             dtype=dtype, count=len(records))
+        np.save(os.path.join(newdir, name + '.npy'), column)
+    for name in usage_columns:
+        column = np.fromiter((_to_float(getattr(job, name))
+                              for job in records),
+                             dtype='float64', count=len(records))
+        np.save(os.path.join(newdir, name + '.npy'), column)
+    tables = dict()
+    for name in string_columns:
+        table = []
+        index = dict()
+        codes = np.empty(len(records), dtype='int32')
+        for row, job in enumerate(records):
+            val = getattr(job, name)
+            if val not in index:
+                index[val] = len(table)
+                table.append(val)
+            codes[row] = index[val]
+        np.save(os.path.join(newdir, name + '.npy'), codes)
+        tables[name] = table
+    with open(os.path.join(newdir, 'strings.json'), 'w') as handle:
+        json.dump(tables, handle)
+    previous = None
+    if os.path.islink(snapdir):
+        previous = os.path.basename(os.path.realpath(snapdir))
+    elif os.path.isdir(snapdir):
+        # snapshot directory written before snapshots were versioned
+        shutil.rmtree(snapdir)
+    link = snapdir + '.link'
+    if os.path.lexists(link):
+        os.unlink(link)
+    os.symlink(os.path.basename(newdir), link)
+    os.rename(link, snapdir)
+    keep = (os.path.basename(newdir), previous)
+    for name in os.listdir(testdir):
+        path = os.path.join(testdir, name)
+        if (name.startswith('records.snapshot.') and name not in keep and
+                os.path.isdir(path) and not os.path.islink(path)):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_record_snapshot(testname, config):
+    """Return the RecordSnapshot of a test or None if there is none.
+
+    The snapshot symlink is resolved once, so that all columns are
+    mapped from the same version even if a new one is written."""
+    snapdir = os.path.realpath(snapshot_path(testname, config))
+    if not os.path.isfile(os.path.join(snapdir, 'strings.json')):
+        return None
+    return RecordSnapshot(snapdir)
+
+
+class RecordSnapshot(object):
+    """Memory-mapped columns of the JobRecords of a test.
+
+    Each name in numeric_columns is an attribute holding a read-only
+    array with one entry per job. Each name in usage_columns is a
+    float array which is NaN where the usage is unknown. Each name in
+    string_columns has a '<name>_codes' array and a '<name>_table'
+    list, such that the value for job i is
+    <name>_table[<name>_codes[i]]."""
+
+    def __init__(self, snapdir):
+        """Map the snapshot stored in snapdir."""
+        self.snapdir = snapdir
+        for name, dtype in numeric_columns:
+            setattr(self, name, self._load(name))
+        for name in usage_columns:
+            if os.path.exists(os.path.join(snapdir, name + '.npy')):
+                setattr(self, name, self._load(name))
+            else:
+                # snapshot written before usage was recorded
+                setattr(self, name, np.full(len(self.seq), np.nan))
+        with open(os.path.join(snapdir, 'strings.json')) as handle:
+            tables = json.load(handle)
+        for name in string_columns:
+            setattr(self, name + '_codes', self._load(name))
+            setattr(self, name + '_table',
+                    [_to_str(val) for val in tables[name]])
+
+    def _load(self, name):
+        """Return a memory-mapped column of the snapshot."""
+        path = os.path.join(self.snapdir, name + '.npy')
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:
+            # empty columns cannot be memory-mapped
+            return np.load(path)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def success(self):
+        """Return a boolean array of job success, see JobRecord.is_success."""
+        return self.exit_code == 0
+
+    def count_by(self, name, mask):
+        """Return a dict of counts of a string column for selected jobs."""
+        table = getattr(self, name + '_table')
+        codes = getattr(self, name + '_codes')[mask]
+        counts = np.bincount(codes, minlength=max(len(table), 1))
+        return dict((table[code], int(count))
+                    for code, count in enumerate(counts) if count)
+
+    def __repr__(self):
+        """Describe object id, snapshot directory, and number of jobs."""
+        return ('<{0}.{1} object at {2} snapdir: {3} jobs: {4}>'.format(
+                    self.__class__.__module__,
+                    self.__class__.__name__,
+                    hex(id(self)),
+                    self.snapdir,
+                    len(self)))
+
+
+def _to_float(val):
+    """Convert an optional number to a float, NaN if it is None."""
+    if val is None:
+        return np.nan
+    return float(val)
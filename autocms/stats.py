@@ -4,13 +4,50 @@ import os
 import time
 import importlib
 
+import numpy as np
 import pandas as pd
 
 from .core import load_records
+from .snapshot import load_record_snapshot
 
 
 default_stat_columns = ["time", "success", "failure", "min_runtime",
-                        "mean_runtime", "max_runtime"]
+                        "mean_runtime", "max_runtime", "mean_max_rss",
+                        "max_max_rss", "mean_cpu_time", "mean_cpu_efficiency",
+                        "mean_disk_read", "mean_disk_write"]
+
+
+def usage_stats(max_rss, total_cpu, elapsed, disk_read, disk_write):
+    """Return the resource usage part of a default statistics row.
+
+    The arguments are float arrays of the usage of the jobs in the
+    statistics window, NaN where unknown. Memory and disk usage are
+    given in MB, CPU time in seconds and CPU efficiency in percent.
+    Values without any known usage are left empty."""
+    megabyte = float(1 << 20)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        efficiency = np.where(elapsed > 0, total_cpu/elapsed*100, np.nan)
+    values = [(max_rss, np.mean, megabyte),
+              (max_rss, np.max, megabyte),
+              (total_cpu, np.mean, 1.0),
+              (efficiency, np.mean, 1.0),
+              (disk_read, np.mean, megabyte),
+              (disk_write, np.mean, megabyte)]
+    row = []
+    for column, aggregate, unit in values:
+        known = column[~np.isnan(column)]
+        if len(known) == 0:
+            row.append('')
+        else:
+            row.append('{0:.1f}'.format(aggregate(known)/unit))
+    return ','.join(row)
+
+
+def _usage_column(records, attr):
+    """Return a float array of a usage attribute, NaN where unknown."""
+    return np.array([np.nan if getattr(job, attr) is None
+                     else getattr(job, attr) for job in records],
+                    dtype='float64')
 
 
 def harvest_default_stats(records, config):
@@ -30,16 +67,50 @@ def harvest_default_stats(records, config):
         mean_runtime = sum(runtimes)/float(len(runtimes))
     successes = sum(1 for job in stat_records if job.is_success())
     failures = sum(1 for job in stat_records if not job.is_success())
-    return "{},{},{},{},{},{}".format(now, successes, failures, min_runtime,
-                                      mean_runtime, max_runtime)
+    usage = usage_stats(*[_usage_column(stat_records, attr)
+                          for attr in ('max_rss', 'total_cpu', 'elapsed',
+                                       'disk_read', 'disk_write')])
+    return "{},{},{},{},{},{},{}".format(now, successes, failures,
+                                         min_runtime, mean_runtime,
+                                         max_runtime, usage)
+
+
+def harvest_snapshot_stats(snapshot, config):
+    """Return the same row as harvest_default_stats from a RecordSnapshot."""
+    now = int(time.time())
+    harvest_time = now - int(config['AUTOCMS_STAT_INTERVAL'])*3600
+    in_window = snapshot.completed & (snapshot.end_time > harvest_time)
+    success = snapshot.success()
+    runtimes = (snapshot.end_time - snapshot.start_time)[in_window & success]
+    if len(runtimes) == 0:
+        max_runtime = 0
+        min_runtime = 0
+        mean_runtime = 0
+    else:
+        max_runtime = int(runtimes.max())
+        min_runtime = int(runtimes.min())
+        mean_runtime = float(runtimes.sum())/len(runtimes)
+    successes = int((in_window & success).sum())
+    failures = int((in_window & ~success).sum())
+    usage = usage_stats(*[getattr(snapshot, attr)[in_window]
+                          for attr in ('max_rss', 'total_cpu', 'elapsed',
+                                       'disk_read', 'disk_write')])
+    return "{},{},{},{},{},{},{}".format(now, successes, failures,
+                                         min_runtime, mean_runtime,
+                                         max_runtime, usage)
 
 
 def append_stats_row(colnames, row, testname, config):
-    """Add a line to the persistent statistics log of a test."""
+    """Add a line to the persistent statistics log of a test.
+
+    If the file was started with fewer columns, for example before the
+    resource usage columns were added to the defaults, its heading is
+    replaced and the older rows are padded with empty values."""
     statfile = os.path.join(config['AUTOCMS_BASEDIR'], testname,
                             'statistics.csv')
     if os.path.isfile(statfile):
         write_headings = False
+        _extend_stats_columns(statfile, colnames)
     else:
         write_headings = True
     with open(statfile, 'a') as stat_handle:
@@ -48,6 +119,22 @@ def append_stats_row(colnames, row, testname, config):
         stat_handle.write(row + '\n')
 
 
+def _extend_stats_columns(statfile, colnames):
+    """Rewrite a statistics file whose heading is a prefix of colnames."""
+    with open(statfile) as stat_handle:
+        heading = stat_handle.readline().rstrip('\n').split(',')
+        if (len(heading) >= len(colnames) or
+                list(colnames[:len(heading)]) != heading):
+            return
+        padding = ',' * (len(colnames) - len(heading))
+        newfile = statfile + '.new'
+        with open(newfile, 'w') as new_handle:
+            new_handle.write(','.join(colnames) + '\n')
+            for line in stat_handle:
+                new_handle.write(line.rstrip('\n') + padding + '\n')
+    os.rename(newfile, statfile)
+
+
 def load_stats(testname, config):
     """Return a pandas DataFrame from a statistics file."""
     statfile = os.path.join(config['AUTOCMS_BASEDIR'], testname,
@@ -59,10 +146,9 @@ def load_stats(testname, config):
 
 def perform_stats_harvesting(testname, config):
     """Analyze job records for given test and create row of statistics."""
-    records = load_records(testname, config)
     # use custom data columns if the test has configured one
     stat_columns = default_stat_columns
-    harvest_stats = harvest_default_stats
+    harvest_stats = None
     try:
         test_custom = importlib.import_module('autocms.custom.' + testname)
         if hasattr(test_custom, 'harvest_stats'):
@@ -71,5 +157,17 @@ def perform_stats_harvesting(testname, config):
             stat_columns = getattr(test_custom, 'stat_columns')
     except ImportError:
         pass
-    row = harvest_stats(records, config)
+    # default statistics only need the columnar snapshot
+    snapshot = None
+    if harvest_stats is None:
+        snapshot = load_record_snapshot(testname, config)
+    if snapshot is not None:
+        row = harvest_snapshot_stats(snapshot, config)
+    else:
+        if harvest_stats is None:
+            harvest_stats = harvest_default_stats
+        # only jobs ending within the statistics interval are considered
+        since = int(time.time()) - int(config['AUTOCMS_STAT_INTERVAL'])*3600
+        records = load_records(testname, config, since)
+        row = harvest_stats(records, config)
     append_stats_row(stat_columns, row, testname, config)
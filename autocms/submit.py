@@ -1,32 +1,231 @@
 """Functions to submit and register new jobs."""
 
 import os
+import sys
+import json
 import time
+import fcntl
+import random
+import threading
+from multiprocessing.pool import ThreadPool
 
+from .core import (
+    append_stamps,
+    stamp_segment_path
+)
 from .scheduler import create_scheduler
+from .jobqueue import invalidate_queue_snapshot
+from .command import CommandFailed
 
 
-def submit_and_stamp(counter, testname, scheduler, config):
-    """Submit a job to the scheduler and produce a newstamp file.
+class SubmitHealth(object):
+    """Persistent view of how well the scheduler accepts submissions.
+
+    The state is kept as JSON in 'submit.health' in AUTOCMS_BASEDIR and
+    shared by the submitters of all tests:
+
+        failures (int): consecutive submissions that timed out (jobid 1)
+            or took longer than AUTOCMS_SUBMIT_SLOW seconds (30).
+        latency (float): moving average of submission command seconds.
+        retry_after (float): unix time before which no new submission
+            should be tried once the circuit breaker is open.
+
+    After AUTOCMS_SUBMIT_FAILURES (3) consecutive failures the circuit
+    breaker opens and submission is skipped until retry_after, which is
+    pushed out by an exponentially growing, jittered delay on every
+    further failure (see backoff_delay). A single healthy submission
+    closes the breaker. Every recorded submission updates the health
+    file under a lock, so the submitters of concurrently running tests
+    see each other's failures. Methods may be called from several
+    threads."""
+
+    def __init__(self, config):
+        self.config = config
+        self.failures = 0
+        self.latency = None
+        self.retry_after = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def path(config):
+        """Return the path of the health file."""
+        return os.path.join(config['AUTOCMS_BASEDIR'], 'submit.health')
+
+    @classmethod
+    def load(cls, config):
+        """Return the saved SubmitHealth, or a healthy one if none is saved."""
+        health = cls(config)
+        try:
+            with open(cls.path(config)) as handle:
+                fcntl.flock(handle, fcntl.LOCK_SH)
+                health._read(handle)
+        except IOError:
+            pass
+        return health
+
+    def _read(self, handle):
+        """Take the state from an open health file, healthy if it is empty."""
+        self.failures = 0
+        self.latency = None
+        self.retry_after = 0
+        try:
+            state = json.load(handle)
+            self.failures = int(state['failures'])
+            self.latency = state['latency']
+            self.retry_after = float(state['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    def _write(self, handle):
+        """Replace the contents of an open health file by the state."""
+        state = {'failures': self.failures, 'latency': self.latency,
+                 'retry_after': self.retry_after}
+        handle.seek(0)
+        handle.truncate()
+        json.dump(state, handle, sort_keys=True)
+
+    def save(self):
+        """Write the health file under its lock."""
+        with open(self.path(self.config), 'a+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            with self._lock:
+                self._write(handle)
+
+    def backoff_delay(self, failures, rand=random.random):
+        """Return seconds to wait after the given number of failures.
+
+        The delay doubles from AUTOCMS_SUBMIT_BACKOFF (10) with every
+        failure up to AUTOCMS_SUBMIT_MAX_BACKOFF (600), and a random
+        fraction of up to half of it is taken off so that submitters
+        do not retry in step."""
+        base = float(self.config.get('AUTOCMS_SUBMIT_BACKOFF', 10))
+        cap = float(self.config.get('AUTOCMS_SUBMIT_MAX_BACKOFF', 600))
+        delay = min(base * 2**max(failures - 1, 0), cap)
+        return delay * (1 - 0.5*rand())
+
+    def circuit_open(self, now=None):
+        """Return True if submission should be skipped for now."""
+        if now is None:
+            now = time.time()
+        threshold = int(self.config.get('AUTOCMS_SUBMIT_FAILURES', 3))
+        with self._lock:
+            return self.failures >= threshold and now < self.retry_after
+
+    def record(self, latency, timed_out, now=None):
+        """Account one submission command, return True if it was healthy.
+
+        The outcome is applied to the state in the health file, which
+        may have been changed by other submitters, and saved at once."""
+        if now is None:
+            now = time.time()
+        slow = float(self.config.get('AUTOCMS_SUBMIT_SLOW', 30))
+        healthy = not timed_out and latency <= slow
+        with open(self.path(self.config), 'a+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            with self._lock:
+                handle.seek(0)
+                self._read(handle)
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency = 0.7*self.latency + 0.3*latency
+                if healthy:
+                    self.failures = 0
+                    self.retry_after = 0
+                else:
+                    self.failures += 1
+                    self.retry_after = now + self.backoff_delay(self.failures)
+                self._write(handle)
+        return healthy
+
+
+def _timed_submission(submit, health):
+    """Run a submission function returning JobRecords, record its health."""
+    start = time.time()
+    records = submit()
+    timed_out = any(job.jobid == 1 for job in records)
+    health.record(time.time() - start, timed_out)
+    return records, timed_out
+
+
+def _stamp_records(records, testname, config):
+    """Append the stamps of JobRecords with one write per journal segment.
+
+    The path of the segment of the last record is returned."""
+    stamp_path = None
+    segments = dict()
+    for job in records:
+        stamp_path = stamp_segment_path(testname, config, job.submit_time)
+        segments.setdefault(stamp_path, []).append(job.stamp())
+    for path, stamps in segments.iteritems():
+        append_stamps(path, stamps)
+    return stamp_path
+
+
+def submit_and_stamp(counter, testname, scheduler, config, health=None):
+    """Submit a job to the scheduler and append its stamp to the journal.
+
+    Submissions that time out are stamped and retried up to
+    AUTOCMS_SUBMIT_RETRIES (3) times after a backoff delay, unless the
+    SubmitHealth circuit breaker opens. The full path of the stamp
+    journal segment is returned, or None if the breaker was open."""
+    if health is None:
+        health = SubmitHealth(config)
+    retries = int(config.get('AUTOCMS_SUBMIT_RETRIES', 3))
+    stamp_path = None
+    for attempt in range(0, retries + 1):
+        if health.circuit_open():
+            break
+        records, timed_out = _timed_submission(
+            lambda: [scheduler.submit_job(counter, testname)], health)
+        stamp_path = _stamp_records(records, testname, config)
+        if not timed_out or attempt == retries:
+            break
+        time.sleep(health.backoff_delay(attempt + 1))
+    return stamp_path
+
+
+def submit_and_stamp_jobs(counters, testname, scheduler, config,
+                          health=None):
+    """Submit a job for each counter at once and journal all their stamps.
+
+    The stamps are appended with one write per journal segment. Timed
+    out submissions are retried as in submit_and_stamp. The list of
+    JobRecords of the last submission attempt is returned."""
+    if health is None:
+        health = SubmitHealth(config)
+    retries = int(config.get('AUTOCMS_SUBMIT_RETRIES', 3))
+    records = []
+    for attempt in range(0, retries + 1):
+        if health.circuit_open():
+            break
+        records, timed_out = _timed_submission(
+            lambda: scheduler.submit_jobs(counters, testname), health)
+        _stamp_records(records, testname, config)
+        if not timed_out or attempt == retries:
+            break
+        time.sleep(health.backoff_delay(attempt + 1))
+    return records
+
+
+def submit_concurrently(counters, testname, scheduler, config, health):
+    """Submit one job per counter with up to AUTOCMS_SUBMIT_CONCURRENCY
+    (4) submissions running at the same time."""
+    workers = min(int(config.get('AUTOCMS_SUBMIT_CONCURRENCY', 4)),
+                  len(counters))
+    if workers <= 1:
+        for counter in counters:
+            submit_and_stamp(counter, testname, scheduler, config, health)
+        return
+    pool = ThreadPool(workers)
+    try:
+        pool.map(lambda counter: submit_and_stamp(counter, testname,
+                                                  scheduler, config, health),
+                 counters)
+    finally:
+        pool.close()
+        pool.join()
 
-    The full path of the newstamp file is returned."""
-    retry = 0
-    while retry < 6:
-      result = scheduler.submit_job(counter, testname)
-      stamp_filename = ('stamp.' +
-                        str(result.submit_time) + '.' +
-                        str(counter))
-      stamp_path = os.path.join(config['AUTOCMS_BASEDIR'],
-                                testname,
-                                stamp_filename)
-      with open(stamp_path, 'w') as stampfile:
-          stampfile.write(result.stamp())
-      if result.jobid != 1:
-        return stamp_path
-        break
-      retry = retry + 1
-      time.sleep(10)
-      return stamp_path
 
 def get_job_counter(testname, config):
     """Return an integer for the counter to pass to the next job."""
@@ -51,15 +250,39 @@ def set_job_counter(count, testname, config):
 
 
 def perform_test_submission(num_jobs, testname, config):
-    """Submit up to num_jobs depending on the queue, incrementing counter."""
+    """Submit up to num_jobs depending on the queue, incrementing counter.
+
+    Nothing is submitted, and the queue is not queried, while the
+    SubmitHealth circuit breaker is open. Nothing is submitted either
+    if the queue can not be queried."""
+    health = SubmitHealth.load(config)
+    if health.circuit_open():
+        sys.stderr.write('Scheduler unhealthy after {0} failed submissions, '
+                         'not submitting before {1}.\n'.format(
+                             health.failures, time.ctime(health.retry_after)))
+        return
     # Ensure that we don't have too many jobs already waiting
     scheduler = create_scheduler(config['AUTOCMS_SCHEDULER'], config)
-    jobcount = scheduler.enqueued_job_count()
+    try:
+        jobcount = scheduler.enqueued_job_count()
+    except CommandFailed as err:
+        sys.stderr.write('Not submitting, the queue is unknown: '
+                         '{0}\n'.format(err.message))
+        return
     available_slots = int(config['AUTOCMS_MAXENQUEUE']) - jobcount
+    num_jobs = min(num_jobs, available_slots)
+    if num_jobs <= 0:
+        return
     counter = get_job_counter(testname, config)
-    while num_jobs > 0 and available_slots > 0:
-        submit_and_stamp(counter, testname, scheduler, config)
-        num_jobs -= 1
-        available_slots -= 1
-        counter += 1
-    set_job_counter(counter, testname, config)
+    counters = range(counter, counter + num_jobs)
+    try:
+        if scheduler.submits_in_batches():
+            # all jobs of the tick go to the scheduler in one submission
+            submit_and_stamp_jobs(counters, testname, scheduler, config,
+                                  health)
+        else:
+            submit_concurrently(counters, testname, scheduler, config, health)
+    finally:
+        set_job_counter(counter + num_jobs, testname, config)
+        # the cached queue no longer includes all jobs
+        invalidate_queue_snapshot(config)
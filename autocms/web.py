@@ -1,17 +1,30 @@
 """AutoCMSWebpage class to simplify generating a web page."""
  
 import os
+import gzip
 import time
-import re
 import shutil
 import importlib
-import subprocess
 import datetime
 
 from .stats import load_stats
-from .core import (load_records, __version__)
+from .core import (
+    load_records,
+    find_log_file,
+    scan_log_files,
+    __version__
+)
+from .snapshot import load_record_snapshot
+from .scheduler import create_scheduler
+from .jobqueue import get_queue_snapshot
+from .command import (
+    CommandFailed,
+    latency_buckets,
+    load_command_metrics
+)
 from .plot import (
     create_default_statistics_plot,
+    create_resource_usage_plot,
     create_run_and_waittime_plot
 )
 
@@ -19,18 +32,29 @@ from .plot import (
 class AutoCMSWebpage(object):
     """Class for building and writing a page to report on an AutoCMS test."""
 
-    def __init__(self, records, testname, config):
+    def __init__(self, records, testname, config, all_records=False):
         """Construct new AutoCMSWebpage object.
 
         Arguments:
              records - dictionary of JobRecords
              testname - name of the autocms test directory
-             config - autocms configuration dictionary"""
+             config - autocms configuration dictionary
+             all_records - True if records are all JobRecords of the test
+
+        If records are all the JobRecords of the test and the harvester
+        wrote a columnar snapshot of them, the snapshot is used to count
+        jobs without iterating over the records. Pages built from a
+        selection of the records always count from the records."""
         self.records = records
         self.testname = testname
         self.config = config
+        self.snapshot = None
+        if all_records:
+            self.snapshot = load_record_snapshot(testname, config)
         self.page = ""
         self.logs_to_copy = []
+        self._queue = None
+        self._queue_error = None
 
     def begin_page(self,descriptive_name=None):
         """Write head and open webpage body, state name and time.
@@ -89,22 +113,31 @@ class AutoCMSWebpage(object):
         shutil.copyfile(src_stylesheet, dst_stylesheet)
 
     def _copy_job_logs(self):
-        """Copy job logs with displayed links to webdir."""
+        """Copy job logs with displayed links to webdir.
+
+        Compressed logs (see autocms.harvest.manage_log_files) are
+        decompressed, so that the links to the logs remain valid."""
         basedir = os.path.join(self.config['AUTOCMS_BASEDIR'], self.testname)
         webdir = os.path.join(self.config['AUTOCMS_WEBDIR'], self.testname)
         for log in self.logs_to_copy:
             if log is None:
                 continue
-            src_file = os.path.join(basedir, log)
+            src_file = find_log_file(os.path.join(basedir, log))
             dst_file = os.path.join(webdir, log)
-            if not os.path.isfile(src_file):
+            if src_file is None:
                 continue
             # dont copy logs already at the destination
             # not only does it waste time, they will not be
             # removed until much later as their mtime is now
             if os.path.isfile(dst_file):
                 continue
-            shutil.copy(src_file, dst_file)
+            if src_file.endswith('.gz'):
+                # compressed logs are served uncompressed
+                with gzip.open(src_file, 'rb') as src:
+                    with open(dst_file, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+            else:
+                shutil.copy(src_file, dst_file)
 
     def copy_statistics_csv_file(self):
         """Copy the statistics file to the webdir."""
@@ -154,6 +187,10 @@ class AutoCMSWebpage(object):
                 attr_counts[key] += 1
             else:
                 attr_counts[key] = 1
+        self._add_count_table(attr_counts, header, width)
+
+    def _add_count_table(self, attr_counts, header, width):
+        """Writes a table from a dictionary of counts by attribute value."""
         if not attr_counts:
             return
         self.page += ('<div class="textbox" '
@@ -165,6 +202,12 @@ class AutoCMSWebpage(object):
                           attr_counts[attr], attr))
         self.page += '</table></div>\n'
 
+    def _recent_failures_mask(self, min_time):
+        """Return a snapshot mask of failed jobs started after min_time."""
+        snap = self.snapshot
+        return (snap.completed & ~snap.success() &
+                (snap.start_time > min_time))
+
     def add_failures_by_node(self, width, hours):
         """Writes a list of nodes by number of errors.
 
@@ -172,13 +215,18 @@ class AutoCMSWebpage(object):
 
         Does not do anything if no jobs have failed in the last hours."""
         min_time = int(time.time()) - 3600*hours
-        failures = (job for job in self.records if
-                        job.completed and not job.is_success() and
-                        job.start_time > min_time)
         header = ('<div class="textbox-header">'
                   'Number of failed jobs by worker node:</div>\n'
                   '<br />(previous {0} hours)<br />'
                   '<br />\n<table>'.format(hours))
+        if self.snapshot is not None:
+            counts = self.snapshot.count_by(
+                'node', self._recent_failures_mask(min_time))
+            self._add_count_table(counts, header, width)
+            return
+        failures = (job for job in self.records if
+                        job.completed and not job.is_success() and
+                        job.start_time > min_time)
         self.add_count_jobs_by_attribute(failures, 'node', header, width)
 
     def add_failures_by_reason(self, width, hours):
@@ -188,13 +236,18 @@ class AutoCMSWebpage(object):
 
         Does not do anything if no jobs have failed in the last hours."""
         min_time = int(time.time()) - 3600*hours
-        failures = (job for job in self.records if
-                        job.completed and not job.is_success() and
-                        job.start_time > min_time)
         header = ('<div class="textbox-header">'
                   'Number of failed jobs by reason:</div>\n'
                   '<br />(previous {0} hours)<br />'
                   '<br />\n<table>'.format(hours))
+        if self.snapshot is not None:
+            counts = self.snapshot.count_by(
+                'error_string', self._recent_failures_mask(min_time))
+            self._add_count_table(counts, header, width)
+            return
+        failures = (job for job in self.records if
+                        job.completed and not job.is_success() and
+                        job.start_time > min_time)
         self.add_count_jobs_by_attribute(failures, 'error_string',
                                          header, width)
 
@@ -212,12 +265,18 @@ class AutoCMSWebpage(object):
                       'Recent job success rates:</div>\n')
         for t in times:
             min_time = int(time.time()) - t*3600
-            failures = sum(1 for job in self.records
-                           if not job.is_success() and
-                           job.start_time > min_time)
-            successes = sum(1 for job in self.records
-                            if job.is_success() and
-                            job.start_time > min_time)
+            if self.snapshot is not None:
+                recent = self.snapshot.start_time > min_time
+                success = self.snapshot.success()
+                failures = int((recent & ~success).sum())
+                successes = int((recent & success).sum())
+            else:
+                failures = sum(1 for job in self.records
+                               if not job.is_success() and
+                               job.start_time > min_time)
+                successes = sum(1 for job in self.records
+                                if job.is_success() and
+                                job.start_time > min_time)
             self.page += ("<br /><br />\nSuccessful jobs in the last "
                           "{0} hours: {1}".format(t, successes))
             self.page += ("<br />\nFailed jobs in the last "
@@ -267,29 +326,49 @@ class AutoCMSWebpage(object):
                     self.page += '</span>'
         self.page += '</div>\n'
 
+    def queue_snapshot(self):
+        """Return the shared QueueSnapshot, queried at most once per page.
+
+        None is returned if the scheduler could not be queried."""
+        if self._queue is None and self._queue_error is None:
+            scheduler = create_scheduler(self.config['AUTOCMS_SCHEDULER'],
+                                         self.config)
+            try:
+                self._queue = get_queue_snapshot(scheduler, self.config)
+            except CommandFailed as err:
+                self._queue_error = err.message
+        return self._queue
+
+    def _add_queue_error(self):
+        """Writes why the queue is unknown and closes the textbox."""
+        self.page += ("<br />\nQueue state unavailable: {0}".format(
+                          self._queue_error))
+        self.page += '</div>\n'
+
+    def _add_queue_time(self, queue):
+        """Writes when the queue was queried and how long it took."""
+        self.page += ("<br />\nQueue state from {0} (query took "
+                      "{1:.2f} s).".format(time.ctime(queue.query_time),
+                                           queue.latency))
+
     def add_currentrunning_jobs(self, width):
         """Writes running jobs"""
         self.page += ('<div class="textbox" '
                       'style="max-width:{0}%;">\n'.format(width))
         self.page += ('<div class="textbox-header">'
                       'Current running jobs on {0}:</div>\n'.format(time.ctime()))
-        cmd = ('squeue -h --user={0} --account={1}'.format(self.config['AUTOCMS_UNAME'],
-                                                           self.config['AUTOCMS_GNAME']))
-        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output = result.communicate()[0].splitlines()
-        runningjobs = 0
-        for i in range(0, len(output)):
-          if output[i].split()[4] == 'R':
-            runningjobs +=1
-        self.page += ("<br />\nNumber of running jobs: {0}".format(runningjobs))
-        for i in range(0, len(output)):
-          if output[i].split()[4] == 'R':
-            if len(output[i].split()[5]) > 5:
-              self.page += ("<br />\nJob {0} has been running on {1} for "
-                            "{2}.".format(output[i].split()[0], output[i].split()[7], output[i].split()[5]))
-            else:
-              self.page += ("<br />\nJob {0} has been running on {1} for "
-                            "00:{2}.".format(output[i].split()[0], output[i].split()[7], output[i].split()[5]))
+        queue = self.queue_snapshot()
+        if queue is None:
+            self._add_queue_error()
+            return
+        running = queue.running()
+        self._add_queue_time(queue)
+        self.page += ("<br />\nNumber of running jobs: {0}".format(len(running)))
+        now = time.time()
+        for job in running:
+            self.page += ("<br />\nJob {0} has been running on {1} for "
+                          "{2}.".format(job.jobid, job.node,
+                                        _duration(queue.time_in_state(job, now))))
         self.page += '</div>\n'
 
     def add_currentpending_jobs(self, width):
@@ -298,23 +377,19 @@ class AutoCMSWebpage(object):
                       'style="max-width:{0}%;">\n'.format(width))
         self.page += ('<div class="textbox-header">'
                       'Current pending jobs on {0}:</div>\n'.format(time.ctime()))
-        cmd = ('squeue -h --user={0} --account={1}'.format(self.config['AUTOCMS_UNAME'],
-                                                           self.config['AUTOCMS_GNAME']))
-        result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        output = result.communicate()[0].splitlines()
-        pendingjobs = 0
-        for i in range(0, len(output)):
-          if output[i].split()[4] == 'PD':
-            pendingjobs +=1
-        self.page += ("<br />\nNumber of pending jobs: {0}".format(pendingjobs))
-        for i in range(0, len(output)):
-          if output[i].split()[4] == 'PD':
-            cmdpending = ('sacct -j {0} -o submit -X --noheader'.format(output[i].split()[0]))
-            resultpending = subprocess.Popen(cmdpending, shell=True, stdout=subprocess.PIPE)
-            outputpending = resultpending.communicate()[0].splitlines()
-            epochtime = int(time.mktime(time.strptime(outputpending[0][:-1], "%Y-%m-%dT%H:%M:%S")))
-            timediff = str(datetime.timedelta(seconds=int(time.time()) - epochtime))
-            self.page += ("<br />\nJob {0} has been pending for {1}.".format(output[i].split()[0], timediff))
+        queue = self.queue_snapshot()
+        if queue is None:
+            self._add_queue_error()
+            return
+        pending = queue.pending()
+        self._add_queue_time(queue)
+        self.page += ("<br />\nNumber of pending jobs: {0}".format(len(pending)))
+        # submit times come with the queue snapshot, no query per job
+        now = time.time()
+        for job in pending:
+            self.page += ("<br />\nJob {0} has been pending for {1}.".format(
+                              job.jobid,
+                              _duration(queue.time_in_state(job, now))))
         self.page += '</div>\n'
 
     def add_job_zero_long(self, header):
@@ -390,6 +465,37 @@ class AutoCMSWebpage(object):
         self.add_job_listing(records_to_print, header, itemheader,
                              error_string='Error Type', **attr_desc)
 
+    def add_command_latencies(self, width):
+        """Writes a table of scheduler command latency histograms.
+
+        Each row gives the calls, failures, timeouts, mean and maximum
+        latency of a command, and the calls by latency bucket (see
+        autocms.command). Nothing is added if no command has run."""
+        metrics = load_command_metrics(self.config)
+        if not metrics:
+            return
+        self.page += ('<div class="textbox" '
+                      'style="max-width:{0}%;">\n'.format(width))
+        self.page += ('<div class="textbox-header">'
+                      'Scheduler command latency:</div>\n<table>\n')
+        bounds = ['&le;{0:g} s'.format(bound) for bound in latency_buckets]
+        bounds.append('&gt;{0:g} s'.format(latency_buckets[-1]))
+        self.page += ('<tr><th>command</th><th>calls</th><th>failed</th>'
+                      '<th>timed out</th><th>mean</th><th>max</th>' +
+                      ''.join('<th>{0}</th>'.format(bound)
+                              for bound in bounds) + '</tr>\n')
+        for name in sorted(metrics):
+            entry = metrics[name]
+            mean = entry['total'] / max(entry['calls'], 1)
+            self.page += ('<tr><td>{0}</td><td>{1}</td><td>{2}</td>'
+                          '<td>{3}</td><td>{4:.2f} s</td><td>{5:.2f} s</td>'
+                          '{6}</tr>\n'.format(
+                              name, entry['calls'], entry['failures'],
+                              entry['timeouts'], mean, entry['max'],
+                              ''.join('<td>{0}</td>'.format(count)
+                                      for count in entry['buckets'])))
+        self.page += '</table></div>\n'
+
     def add_divider(self):
         """Write a <hr /> divider and clear floats."""
         self.page += '<hr style="clear:both;"/>\n'
@@ -434,14 +540,23 @@ class AutoCMSWebpage(object):
                     self.page))
 
 
-def produce_default_webpage(records, testname, config):
-    """Create a basic test webpage applicable to any AutoCMS test."""
+def _duration(seconds):
+    """Format a number of seconds as [D day[s], ]H:MM:SS, or 'unknown'."""
+    if seconds is None:
+        return 'unknown'
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def produce_default_webpage(records, testname, config, all_records=False):
+    """Create a basic test webpage applicable to any AutoCMS test.
+
+    all_records is passed on to AutoCMSWebpage."""
     webpath = os.path.join(config['AUTOCMS_WEBDIR'], testname)
     runtime_plot_path = os.path.join(webpath, 'runtime.png')
     recent_successes = [job for job in records
                         if job.start_time > int(time.time()) - 3600*24 and
                         job.completed and job.is_success()]
-    webpage = AutoCMSWebpage(records, testname, config)
+    webpage = AutoCMSWebpage(records, testname, config, all_records)
     webpage.begin_page()
     webpage.add_divider()
     webpage.add_test_description(100)
@@ -462,11 +577,19 @@ def produce_default_webpage(records, testname, config):
                         'CSV file</a>.')
         webpage.add_floating_image(45, 'stats.png', plot_desc,
                                    caption=plot_caption)
+        # resource usage is only known for schedulers reporting it
+        if ('mean_max_rss' in df and
+                df['mean_max_rss'].notnull().any()):
+            usage_plot_path = os.path.join(webpath, 'usage.png')
+            create_resource_usage_plot(df, usage_plot_path)
+            plot_desc = 'Recent job memory and CPU usage:'
+            webpage.add_floating_image(45, 'usage.png', plot_desc)
     webpage.add_divider()
     webpage.add_job_failure_rates(30, [24, 3], 90.0)
     webpage.add_failures_by_node(25, 24)
     webpage.add_failures_by_reason(40, 24)
     webpage.add_divider()
+    webpage.add_command_latencies(95)
     webpage.add_failed_job_listing(24)
     if config['AUTOCMS_PRINT_SUCCESS'] == 'TRUE':
         webpage.add_job_listing(recent_successes,
@@ -479,18 +602,14 @@ def produce_default_webpage(records, testname, config):
 def purge_old_web_logs(testname, config):
     """Remove logs older than AUTOCMS_LOG_LIFETIME in test webdir.
 
-    Any file ending in '.log' in a test directory is considered
-    a log file."""
+    Any file ending in '.log' or '.log.gz' in a test directory is
+    considered a log file."""
     webdir = os.path.join(config['AUTOCMS_WEBDIR'], testname)
     if not os.path.exists(webdir):
         return
-    logs = []
-    for logfile in os.listdir(webdir):
-        if re.search(r'\.log$', logfile):
-            logs.append(logfile)
     purgetime = int(time.time()) - 3600*24*int(config['AUTOCMS_LOG_LIFETIME'])
-    for logfile in logs:
-        if int(os.path.getmtime(logfile)) < purgetime:
+    for logfile, mtime in scan_log_files(webdir):
+        if mtime < purgetime:
             os.remove(logfile)
 
 
@@ -501,13 +620,22 @@ def perform_test_reporting(testname, config):
     webdir = os.path.join(config['AUTOCMS_WEBDIR'], testname)
     if not os.path.exists(webdir):
         os.makedirs(webdir)
-    records = load_records(testname, config)
+    # only load the trailing AUTOCMS_REPORT_HOURS of jobs if configured
+    since = None
+    if 'AUTOCMS_REPORT_HOURS' in config:
+        since = int(time.time()) - 3600*int(config['AUTOCMS_REPORT_HOURS'])
+    records = load_records(testname, config, since)
     # use a custom webpage if the test has configured one
-    produce_webpage = produce_default_webpage
+    produce_webpage = None
     try:
         test_custom = importlib.import_module('autocms.custom.' + testname)
         if hasattr(test_custom, 'produce_webpage'):
             produce_webpage = getattr(test_custom, 'produce_webpage')
     except ImportError:
         pass
-    produce_webpage(records, testname, config)
+    if produce_webpage is not None:
+        produce_webpage(records, testname, config)
+    else:
+        # the default page may count from the snapshot of all records
+        produce_default_webpage(records, testname, config,
+                                all_records=since is None)
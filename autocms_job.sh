@@ -0,0 +1,69 @@
+#!/bin/bash
+#
+# Helper functions for AutoCMS test job scripts.
+#
+# Source this file right after the AutoCMS configuration file in the
+# test script:
+#
+#   source $AUTOCMS_CONFIGFILE
+#   source ${AUTOCMS_BASEDIR}/autocms_job.sh
+#
+# Tokens are then reported with autocms_token and the token name, as in
+#
+#   autocms_token start_time "$(date +%s)"
+#   autocms_token SUCCESS
+#
+# which prints the token line to the job log exactly as
+# echo "${AUTOCMS_start_time_TOKEN}$(date +%s)" would, and also appends
+# the token to a summary file next to the log, named as the log with
+# ".log" replaced by ".jsonl". When the summary file exists the
+# logharvester reads only it and does not scan the log, so every token
+# of a job should then be reported through autocms_token.
+#
+# Jobs submitted together as a slurm job array share AUTOCMS_COUNTER_BASE,
+# and the counter of each task is set here from its array task id.
+
+if [ -n "$AUTOCMS_COUNTER_BASE" ] && [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+  export AUTOCMS_COUNTER=$(( AUTOCMS_COUNTER_BASE + SLURM_ARRAY_TASK_ID ))
+fi
+
+# The job log is whatever file standard output of the job is written to.
+AUTOCMS_SUMMARY=""
+AUTOCMS_JOBLOG=$(readlink -f /proc/$$/fd/1 2>/dev/null)
+if [[ "$AUTOCMS_JOBLOG" == *.log && -f "$AUTOCMS_JOBLOG" ]]; then
+  AUTOCMS_SUMMARY="${AUTOCMS_JOBLOG%.log}.jsonl"
+  : > "$AUTOCMS_SUMMARY"
+fi
+
+autocms_json_escape ()
+{
+  local value="$1"
+  value=${value//\\/\\\\}
+  value=${value//\"/\\\"}
+  value=${value//$'\t'/\\t}
+  value=${value//$'\r'/\\r}
+  value=${value//$'\n'/\\n}
+  # any other control character is written as a \u escape
+  if [[ "$value" == *[[:cntrl:]]* ]]; then
+    local code char escaped
+    for code in {1..8} 11 12 {14..31}; do
+      printf -v char "\\x$(printf %02x $code)"
+      printf -v escaped '\\u%04x' $code
+      value=${value//"$char"/"$escaped"}
+    done
+  fi
+  echo -n "$value"
+}
+
+autocms_token ()
+{
+  local name="$1"
+  shift
+  local value="$*"
+  local token="AUTOCMS_${name}_TOKEN"
+  echo "${!token}${value}"
+  if [ -n "$AUTOCMS_SUMMARY" ]; then
+    echo "{\"token\": \"$(autocms_json_escape "$name")\"," \
+         "\"value\": \"$(autocms_json_escape "$value")\"}" >> "$AUTOCMS_SUMMARY"
+  fi
+}
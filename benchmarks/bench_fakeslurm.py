@@ -0,0 +1,110 @@
+"""Measure submit, harvest, stats and report times at scale.
+
+The fake slurm commands of benchmarks.fakeslurm are installed in a
+temporary directory put first in PATH, and a test is run through the
+real SlurmScheduler for a number of ticks. Each tick submits up to
+num_jobs jobs, then harvests the finished ones, harvests statistics and
+reports, timing each stage. Run from the AutoCMS base directory as:
+
+    python -m benchmarks.bench_fakeslurm -n 10000 -t 3 --latency 0.5
+"""
+
+import os
+import pwd
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from autocms.core import (
+    load_configuration,
+    load_records
+)
+from autocms.submit import perform_test_submission
+from autocms.harvest import perform_test_harvesting
+from autocms.stats import perform_stats_harvesting
+from autocms.web import perform_test_reporting
+from benchmarks import fakeslurm
+
+
+def setup_test(testname, config):
+    """Write a slurm job script and description for the test."""
+    testdir = os.path.join(config['AUTOCMS_BASEDIR'], testname)
+    os.makedirs(testdir)
+    with open(os.path.join(testdir, testname + '.slurm'), 'w') as script:
+        script.write('#!/bin/bash\n'
+                     '#SBATCH --output={0}.slurm.o%A.log\n'.format(testname))
+    with open(os.path.join(testdir, 'description.html'), 'w') as desc:
+        desc.write('<p>Fake slurm benchmark test.</p>\n')
+
+
+def main():
+    """Print the time of each stage for every tick."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark AutoCMS against fake slurm commands.')
+    parser.add_argument('-n', '--num_jobs', type=int, default=10000,
+                        help='jobs submitted per tick')
+    parser.add_argument('-t', '--ticks', type=int, default=3,
+                        help='number of submit, harvest and report ticks')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds every slurm command takes')
+    parser.add_argument('--timeout_rate', type=float, default=0,
+                        help='fraction of slurm commands timing out')
+    parser.add_argument('--failure_rate', type=float, default=0.05,
+                        help='fraction of jobs that fail')
+    parser.add_argument('--max_jobs', type=int, default=0,
+                        help='slurm queue limit, 0 for none')
+    parser.add_argument('--array', action='store_true',
+                        help='submit the jobs of a tick as one job array')
+    parser.add_argument('-c', '--configfile', type=str,
+                        default='autocms.cfg',
+                        help='AutoCMS configuration file name')
+    args = parser.parse_args()
+    config = load_configuration(args.configfile)
+    tmpdir = tempfile.mkdtemp()
+    testname = 'bench'
+    config['AUTOCMS_BASEDIR'] = tmpdir
+    config['AUTOCMS_WEBDIR'] = os.path.join(tmpdir, 'web')
+    config['AUTOCMS_CONFIGFILE'] = os.path.abspath(args.configfile)
+    config['AUTOCMS_SCHEDULER'] = 'slurm'
+    config['AUTOCMS_UNAME'] = pwd.getpwuid(os.getuid()).pw_name
+    config['AUTOCMS_MAXENQUEUE'] = str(args.num_jobs)
+    config['AUTOCMS_TEST_NAMES'] = testname
+    if args.array:
+        config['AUTOCMS_SLURM_ARRAY'] = '1'
+    bindir = os.path.join(tmpdir, 'bin')
+    fakeslurm.install(bindir)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+    os.environ['FAKESLURM_STATE'] = os.path.join(tmpdir, 'fakeslurm.sqlite')
+    os.environ['FAKESLURM_LATENCY'] = str(args.latency)
+    os.environ['FAKESLURM_TIMEOUT_RATE'] = str(args.timeout_rate)
+    os.environ['FAKESLURM_FAILURE_RATE'] = str(args.failure_rate)
+    os.environ['FAKESLURM_MAX_JOBS'] = str(args.max_jobs)
+    stages = [('submit', lambda: perform_test_submission(
+                   args.num_jobs, testname, config)),
+              ('harvest', lambda: perform_test_harvesting(testname, config)),
+              ('stats', lambda: perform_stats_harvesting(testname, config)),
+              ('report', lambda: perform_test_reporting(testname, config))]
+    try:
+        setup_test(testname, config)
+        print '{0:>5} {1:>8} {2:>10} {3:>8}'.format('tick', 'stage',
+                                                    'seconds', 'records')
+        num_records = 0
+        for tick in range(args.ticks):
+            for stage, perform in stages:
+                start = time.time()
+                perform()
+                elapsed = time.time() - start
+                if stage == 'harvest':
+                    num_records = len(load_records(testname, config))
+                print '{0:5d} {1:>8} {2:10.3f} {3:8d}'.format(
+                    tick, stage, elapsed, num_records)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
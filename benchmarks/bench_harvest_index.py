@@ -0,0 +1,120 @@
+"""Measure how logharvest record bookkeeping scales with record count.
+
+Stamp deduplication, completion lookup, and purging are timed for
+the list-based implementation AutoCMS used before RecordIndex and
+for the current harvest functions. Run from the AutoCMS base
+directory as:
+
+    python -m benchmarks.bench_harvest_index -n 10000 100000
+
+The list-based implementation is quadratic, and is only timed up to
+--legacy-max records.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from autocms.core import (
+    JobRecord,
+    RecordIndex
+)
+from autocms.scheduler import Scheduler
+from autocms.harvest import (
+    add_untracked_jobs,
+    parse_completed_job_logs,
+    purge_old_jobs
+)
+
+
+class FakeScheduler(Scheduler):
+    """Scheduler reporting every other checked job as completed."""
+
+    def get_completed_jobs(self, joblist, since=None):
+        return [jobid for jobid in joblist if int(jobid) % 2 == 0]
+
+
+def write_stamps(stampfile, num_records, now):
+    """Write num_records stamps, plus 100 not yet tracked, to stampfile."""
+    with open(stampfile, 'w') as shandle:
+        for count in range(num_records + 100):
+            shandle.write('{0} {1} {2} 0 job_{0}.log\n'.format(
+                count, 100000 + count, now - 10*(num_records - count)))
+
+
+def make_records(num_records, now):
+    """Return num_records incomplete JobRecords matching the stamps."""
+    return [JobRecord(count, str(100000 + count),
+                      now - 10*(num_records - count), 0,
+                      'job_{0}.log'.format(count))
+            for count in range(num_records)]
+
+
+def legacy_harvest(stampfile, records, scheduler, purgetime):
+    """Bookkeeping steps as implemented with list lookups."""
+    jobkeys = [str(job.seq) + '.' + str(job.submit_time) for job in records]
+    with open(stampfile) as shandle:
+        for stamp in shandle.readlines():
+            stampkey = stamp.split()[0] + '.' + stamp.split()[2]
+            if stampkey not in jobkeys:
+                records.append(JobRecord.create_from_stamp(stamp))
+    jobids_to_check = [job.jobid for job in records if not job.completed]
+    completed_jobids = scheduler.get_completed_jobs(jobids_to_check)
+    for job in [job for job in records if job.jobid in completed_jobids]:
+        job.completed = True
+    for job in records[:]:
+        if job.submit_time < purgetime:
+            records.remove(job)
+
+
+def indexed_harvest(stampfile, records, scheduler, config):
+    """Bookkeeping steps as implemented by the harvest module."""
+    index = RecordIndex(records)
+    add_untracked_jobs(stampfile, records, index)
+    parse_completed_job_logs(records, scheduler, 'bench', config, index)
+    purge_old_jobs(records, config, index)
+
+
+def main():
+    """Print bookkeeping times for each requested record count."""
+    parser = argparse.ArgumentParser(description='Benchmark harvesting.')
+    parser.add_argument('-n', '--num_records', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help='record counts to benchmark')
+    parser.add_argument('--legacy-max', type=int, default=20000,
+                        help='largest record count for the list-based code')
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmpdir, 'bench'))
+    stampfile = os.path.join(tmpdir, 'bench', 'submission.stamps')
+    # log files do not exist, so completed jobs are not parsed
+    config = {'AUTOCMS_BASEDIR': tmpdir, 'AUTOCMS_LOG_LIFETIME': '1'}
+    scheduler = FakeScheduler(config)
+    print '{0:>10} {1:>12} {2:>12}'.format('records', 'list s', 'indexed s')
+    try:
+        for num_records in args.num_records:
+            now = int(time.time())
+            purgetime = now - 3600*24
+            write_stamps(stampfile, num_records, now)
+            legacy_time = 'skipped'
+            if num_records <= args.legacy_max:
+                records = make_records(num_records, now)
+                start = time.time()
+                legacy_harvest(stampfile, records, scheduler, purgetime)
+                legacy_time = '{0:.3f}'.format(time.time() - start)
+            records = make_records(num_records, now)
+            start = time.time()
+            indexed_harvest(stampfile, records, scheduler, config)
+            print '{0:10d} {1:>12} {2:12.3f}'.format(
+                num_records, legacy_time, time.time() - start)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,96 @@
+"""Measure log parsing time of a burst of completed jobs.
+
+A directory of synthetic job logs is written, all jobs are reported
+as completed at once, and parse_completed_job_logs is timed for each
+requested number of parse workers. Run from the AutoCMS base
+directory as:
+
+    python -m benchmarks.bench_parse_pool -n 500 -w 1 2 4 8
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from autocms.core import (
+    JobRecord,
+    load_configuration
+)
+from autocms.scheduler import Scheduler
+from autocms.harvest import parse_completed_job_logs
+
+
+class FakeScheduler(Scheduler):
+    """Scheduler reporting every checked job as completed."""
+
+    def get_completed_jobs(self, joblist, since=None):
+        return list(joblist)
+
+
+def write_logs(testdir, num_jobs, log_lines, config):
+    """Write num_jobs synthetic logs with tokens amid filler output."""
+    filler = 'Begin processing the {0}th record. Run 1, Event {0}\n'
+    for count in range(num_jobs):
+        logpath = os.path.join(testdir, 'job_{0}.log'.format(count))
+        with open(logpath, 'w') as log:
+            log.write(config['AUTOCMS_start_time_TOKEN'] + '1400000000\n')
+            log.write(config['AUTOCMS_node_TOKEN'] + 'vmp101\n')
+            for line in range(log_lines):
+                log.write(filler.format(line))
+            log.write(config['AUTOCMS_end_time_TOKEN'] + '1400000100\n')
+            log.write(config['AUTOCMS_exit_code_TOKEN'] + '0\n')
+            log.write(config['AUTOCMS_SUCCESS_TOKEN'] + '\n')
+
+
+def make_records(num_jobs):
+    """Return num_jobs incomplete JobRecords matching the logs."""
+    return [JobRecord(count, str(100000 + count), 1400000000, 0,
+                      'job_{0}.log'.format(count))
+            for count in range(num_jobs)]
+
+
+def main():
+    """Print the parse time for each requested number of workers."""
+    parser = argparse.ArgumentParser(description='Benchmark log parsing.')
+    parser.add_argument('-n', '--num_jobs', type=int, default=500,
+                        help='number of completed jobs')
+    parser.add_argument('-l', '--log_lines', type=int, default=20000,
+                        help='filler lines per log')
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='parse worker counts to benchmark')
+    parser.add_argument('-c', '--configfile', type=str,
+                        default='autocms.cfg',
+                        help='AutoCMS configuration file name')
+    args = parser.parse_args()
+    config = load_configuration(args.configfile)
+    tmpdir = tempfile.mkdtemp()
+    testdir = os.path.join(tmpdir, 'bench')
+    os.makedirs(testdir)
+    config['AUTOCMS_BASEDIR'] = tmpdir
+    scheduler = FakeScheduler(config)
+    try:
+        write_logs(testdir, args.num_jobs, args.log_lines, config)
+        print '{0:>8} {1:>10} {2:>8}'.format('workers', 'seconds', 'speedup')
+        serial_time = None
+        for workers in args.workers:
+            config['AUTOCMS_PARSE_WORKERS'] = str(workers)
+            records = make_records(args.num_jobs)
+            start = time.time()
+            parse_completed_job_logs(records, scheduler, 'bench', config)
+            elapsed = time.time() - start
+            if serial_time is None:
+                serial_time = elapsed
+            print '{0:8d} {1:10.3f} {2:8.2f}'.format(
+                workers, elapsed, serial_time / elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,89 @@
+"""Compare memory and pickle cost of JobRecords with and without __slots__.
+
+Run from the AutoCMS base directory as:
+
+    python -m benchmarks.bench_records -n 50000
+"""
+
+import sys
+import time
+import argparse
+import cPickle as pickle
+
+from autocms.core import JobRecord
+
+
+class LegacyJobRecord(object):
+    """JobRecord layout before __slots__: every attribute in __dict__."""
+    pass
+
+
+def make_records(num_records):
+    """Return lists of equivalent legacy and slotted JobRecords."""
+    legacy_records = []
+    records = []
+    for count in range(num_records):
+        record = JobRecord(count, str(1000000 + count),
+                           1427266702 + 600*count, 0,
+                           'skim_test.slurm.o{0}.log'.format(1000000 + count))
+        record.completed = True
+        record.start_time = record.submit_time + 100
+        record.end_time = record.start_time + 3000
+        record.node = 'vmp{0}'.format(count % 500)
+        record.exit_code = 0
+        record.error_string = ''
+        record.tokens['input_file'] = '/store/file_{0}.root'.format(count % 40)
+        record.tokens['cmsrun_proc_count'] = str(count % 12)
+        record.tokens['node_jobs_count'] = str(count % 16)
+        legacy = LegacyJobRecord()
+        for attr in JobRecord.fields:
+            setattr(legacy, attr, getattr(record, attr))
+        legacy.__dict__.update(record.tokens)
+        legacy_records.append(legacy)
+        records.append(record)
+    return legacy_records, records
+
+
+def container_size(job):
+    """Return bytes used by a record object and its attribute containers."""
+    if hasattr(job, '__dict__'):
+        return sys.getsizeof(job) + sys.getsizeof(job.__dict__)
+    return sys.getsizeof(job) + sys.getsizeof(job.tokens)
+
+
+def time_pickle(records, protocol):
+    """Return pickle size in bytes and dump, load time in seconds."""
+    start = time.time()
+    data = pickle.dumps(records, protocol)
+    dump_time = time.time() - start
+    start = time.time()
+    pickle.loads(data)
+    load_time = time.time() - start
+    return len(data), dump_time, load_time
+
+
+def main():
+    """Print per-record memory and pickle timings before and after."""
+    parser = argparse.ArgumentParser(description='Benchmark JobRecords.')
+    parser.add_argument('-n', '--num_records', type=int, default=50000,
+                        help='number of records to create')
+    args = parser.parse_args()
+    legacy_records, records = make_records(args.num_records)
+    rows = [('legacy __dict__, protocol 0', legacy_records, 0),
+            ('legacy __dict__, protocol 2', legacy_records, 2),
+            ('__slots__ + tokens, protocol 2', records, 2)]
+    print '{0} records'.format(args.num_records)
+    print '{0:32} {1:>12} {2:>12} {3:>10} {4:>10}'.format(
+        'layout', 'bytes/record', 'pickle MB', 'dump s', 'load s')
+    for name, joblist, protocol in rows:
+        per_record = (sum(container_size(job) for job in joblist) /
+                      float(len(joblist)))
+        size, dump_time, load_time = time_pickle(joblist, protocol)
+        print '{0:32} {1:12.1f} {2:12.2f} {3:10.3f} {4:10.3f}'.format(
+            name, per_record, size/1e6, dump_time, load_time)
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
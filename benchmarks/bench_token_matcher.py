@@ -0,0 +1,101 @@
+"""Compare per-token regex matching with the compiled TokenMatcher.
+
+A synthetic cmsRun-like log of the requested size is written to a
+temporary file with the AutoCMS tokens of the given configuration
+file at the start and end, and is then parsed both ways. Run from the
+AutoCMS base directory as:
+
+    python -m benchmarks.bench_token_matcher -s 20
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+
+from autocms.core import (
+    JobRecord,
+    TokenMatcher,
+    load_configuration
+)
+
+
+CMSRUN_LINES = [
+    'Begin processing the {0}th record. Run 1, Event {0}, LumiSection 3 '
+    'at 25-Mar-2015 02:00:{1:02d}.123 CDT',
+    '%MSG-w TriggerResultsFilter:  HLTHighLevel:hltHighLevel {0}',
+    'TimeReport> Time report complete in {0} seconds',
+    '%MSG',
+]
+
+
+def write_log(path, config, size_mb):
+    """Write a synthetic log of about size_mb megabytes to path."""
+    tokens = [(key.replace('AUTOCMS_', '').replace('_TOKEN', ''), val)
+              for key, val in config.iteritems()
+              if re.match(r'AUTOCMS_.*_TOKEN', key)]
+    with open(path, 'w') as log:
+        for name, token in tokens:
+            log.write('{0}{1}\n'.format(token, '1427266802'))
+        count = 0
+        while log.tell() < size_mb * 1e6:
+            line = CMSRUN_LINES[count % len(CMSRUN_LINES)]
+            log.write(line.format(count, count % 60) + '\n')
+            count += 1
+        for name, token in tokens:
+            log.write('{0}{1}\n'.format(token, '1427267170'))
+    return len(tokens)
+
+
+def parse_per_token(logpath, config):
+    """Parse a log the way parse_output did before TokenMatcher."""
+    tokens = [s for s in config.keys()
+              if re.match(r'AUTOCMS_.*_TOKEN', s)]
+    found = dict()
+    with open(logpath, 'r') as handle:
+        log = handle.read().splitlines()
+    for line in log:
+        for tok in tokens:
+            if re.match(config[tok], line):
+                t_name = tok.replace('AUTOCMS_', '').replace('_TOKEN', '')
+                found[t_name] = line.replace(config[tok], '')
+    return found
+
+
+def main():
+    """Print parse times of both methods on a synthetic log."""
+    parser = argparse.ArgumentParser(description='Benchmark token parsing.')
+    parser.add_argument('-s', '--size', type=float, default=20,
+                        help='size of the synthetic log in MB')
+    parser.add_argument('-c', '--configfile', type=str,
+                        default='autocms.cfg',
+                        help='AutoCMS configuration file name')
+    args = parser.parse_args()
+    config = load_configuration(args.configfile)
+    tmpdir = tempfile.mkdtemp()
+    config['AUTOCMS_BASEDIR'] = tmpdir
+    os.makedirs(os.path.join(tmpdir, 'bench'))
+    logpath = os.path.join(tmpdir, 'bench', 'bench.log')
+    try:
+        num_tokens = write_log(logpath, config, args.size)
+        print '{0:.1f} MB log, {1} tokens'.format(
+            os.path.getsize(logpath)/1e6, num_tokens)
+        start = time.time()
+        parse_per_token(logpath, config)
+        print 'per-token re.match:  {0:8.3f} s'.format(time.time() - start)
+        start = time.time()
+        record = JobRecord(1, '1', 1427266702, 0, 'bench.log')
+        record.parse_output('bench', config, TokenMatcher(config))
+        print 'compiled matcher:    {0:8.3f} s'.format(time.time() - start)
+    finally:
+        os.remove(logpath)
+        os.rmdir(os.path.join(tmpdir, 'bench'))
+        os.rmdir(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,479 @@
+"""Stand-in slurm commands for load testing AutoCMS without a cluster.
+
+The sbatch, squeue, sacct and scancel commands are emulated on top of
+a sqlite state file, so SlurmScheduler can be driven through its real
+command line parsing with tens of thousands of jobs. Job scripts are
+not run: at submission each job is given a queue wait, run time, node
+and exit code, and once a job's end time has passed its log is written
+with the AutoCMS tokens a successful or failed test job would print.
+
+Install the commands into a directory and put it first in PATH:
+
+    python -m benchmarks.fakeslurm /tmp/fakebin
+    export PATH=/tmp/fakebin:$PATH
+    export FAKESLURM_STATE=/tmp/fakeslurm.sqlite
+
+The behavior is controlled by environment variables:
+
+    FAKESLURM_STATE         path of the state file (required)
+    FAKESLURM_LATENCY       seconds every command takes (0)
+    FAKESLURM_TIMEOUT_RATE  fraction of commands failing with a socket
+                            timeout as an overloaded slurmctld does (0)
+    FAKESLURM_FAILURE_RATE  fraction of jobs that fail (0)
+    FAKESLURM_WAIT          mean seconds a job is pending (0)
+    FAKESLURM_RUNTIME       mean seconds a job runs (0)
+    FAKESLURM_MAX_JOBS      limit of pending and running jobs, sbatch
+                            is rejected above it (0, no limit)
+    FAKESLURM_NODES         number of worker nodes (100)
+"""
+
+import os
+import re
+import pwd
+import sys
+import time
+import random
+import sqlite3
+
+
+commands = ('sbatch', 'squeue', 'sacct', 'scancel')
+
+timeout_message = ('{0}: error: slurm_receive_msg: Socket timed out on '
+                   'send/recv operation\n')
+
+
+class CommandError(Exception):
+    """Exception for a failed command, the message is printed."""
+    def __init__(self, message):
+        super(CommandError, self).__init__(message)
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+
+def setting(name, default):
+    """Return a FAKESLURM_<name> environment setting as a float."""
+    return float(os.environ.get('FAKESLURM_' + name, default))
+
+
+def connect():
+    """Return a connection to the state file, creating its tables."""
+    path = os.environ.get('FAKESLURM_STATE')
+    if not path:
+        raise CommandError('FAKESLURM_STATE is not set\n')
+    conn = sqlite3.connect(path, timeout=600)
+    conn.text_factory = str
+    conn.executescript(
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        ' id INTEGER NOT NULL, task INTEGER NOT NULL,'
+        ' user TEXT, account TEXT, name TEXT, logpath TEXT,'
+        ' configfile TEXT, submit REAL, start REAL, end REAL,'
+        ' node TEXT, exit_code INTEGER, max_rss INTEGER,'
+        ' cancelled INTEGER DEFAULT 0, logged INTEGER DEFAULT 0,'
+        ' PRIMARY KEY (id, task));\n'
+        'CREATE INDEX IF NOT EXISTS jobs_open ON jobs (logged, end);\n'
+        'CREATE TABLE IF NOT EXISTS sequence (next_id INTEGER);\n'
+    )
+    return conn
+
+
+def install(bindir):
+    """Write sbatch, squeue, sacct and scancel executables to bindir."""
+    if not os.path.isdir(bindir):
+        os.makedirs(bindir)
+    basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in commands:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as handle:
+            handle.write('#!{0}\n'
+                         'import sys\n'
+                         'sys.path.insert(0, {1!r})\n'
+                         'from benchmarks.fakeslurm import main\n'
+                         'sys.exit(main({2!r}, sys.argv[1:]))\n'.format(
+                             sys.executable, basedir, name))
+        os.chmod(path, 0755)
+
+
+def slurm_time(timestamp):
+    """Format a unix time as slurm does, 'Unknown' for None."""
+    if timestamp is None:
+        return 'Unknown'
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp))
+
+
+def slurm_duration(seconds, short=False):
+    """Format seconds as [D-]HH:MM:SS, or [H:]M:SS if short as squeue."""
+    seconds = int(max(seconds, 0))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return '{0}-{1:02d}:{2:02d}:{3:02d}'.format(days, hours, minutes,
+                                                   seconds)
+    if short and not hours:
+        return '{0}:{1:02d}'.format(minutes, seconds)
+    if short:
+        return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+def parse_array(spec):
+    """Return the task ids of an --array value such as '0-9:2,12%4'."""
+    tasks = []
+    for part in spec.split('%')[0].split(','):
+        step = 1
+        if ':' in part:
+            part, step = part.split(':')
+            step = int(step)
+        if '-' in part:
+            first, last = part.split('-')
+            tasks.extend(range(int(first), int(last) + 1, step))
+        else:
+            tasks.append(int(part))
+    return tasks
+
+
+def parse_options(args, short_options=()):
+    """Split arguments into a dict of options and a list of others.
+
+    Options are given as --name=value, --name value, or as -x value for
+    the short options listed; other options starting with - are flags."""
+    options = dict()
+    others = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('--') and '=' in arg:
+            name, value = arg[2:].split('=', 1)
+            options[name] = value
+        elif arg in short_options and args:
+            options[short_options[arg]] = args.pop(0)
+        elif arg.startswith('-'):
+            options[arg.lstrip('-')] = True
+        else:
+            others.append(arg)
+    return options, others
+
+
+def job_display_id(job_id, task):
+    """Return the id slurm shows for a job or an array task."""
+    if task < 0:
+        return str(job_id)
+    return '{0}_{1}'.format(job_id, task)
+
+
+def parse_job_ids(value):
+    """Return (id, task) pairs for a -j list, task None for whole jobs."""
+    ids = []
+    for item in value.split(','):
+        item = item.strip().split('.')[0]
+        if not item:
+            continue
+        if '_' in item:
+            job_id, task = item.split('_', 1)
+            ids.append((int(job_id), int(task)))
+        else:
+            ids.append((int(item), None))
+    return ids
+
+
+def select_jobs(conn, columns, ids=None, where=None, params=()):
+    """Return rows of the jobs table, limited to the given (id, task)s."""
+    query = 'SELECT {0} FROM jobs'.format(columns)
+    clauses = [where] if where else []
+    if ids is not None:
+        if not ids:
+            return []
+        clauses.append('id IN ({0})'.format(
+            ','.join(str(job_id) for job_id, task in ids)))
+    if clauses:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    rows = conn.execute(query + ' ORDER BY id, task', params).fetchall()
+    if ids is None:
+        return rows
+    wanted = set(ids)
+    return [row for row in rows
+            if (row[0], None) in wanted or (row[0], row[1]) in wanted]
+
+
+def job_state(start, end, exit_code, cancelled, now):
+    """Return the slurm state of a job at time now."""
+    if cancelled:
+        return 'CANCELLED'
+    if now < start:
+        return 'PENDING'
+    if now < end:
+        return 'RUNNING'
+    return 'COMPLETED' if exit_code == 0 else 'FAILED'
+
+
+def _token_lines(configfile):
+    """Return the token prefixes of an AutoCMS configuration file."""
+    from autocms.core import load_configuration
+    names = ('start_time', 'end_time', 'node', 'exit_code', 'error_string')
+    tokens = dict((name, name + ' ') for name in names)
+    tokens['SUCCESS'] = 'SUCCESS'
+    if configfile and os.path.isfile(configfile):
+        config = load_configuration(configfile)
+        for name in tokens:
+            tokens[name] = config.get('AUTOCMS_{0}_TOKEN'.format(name),
+                                      tokens[name])
+    return tokens
+
+
+def write_finished_logs(conn, now):
+    """Write the logs of jobs that have ended since the last command."""
+    rows = conn.execute('SELECT id, task, logpath, configfile, start, end,'
+                        ' node, exit_code FROM jobs WHERE logged = 0 AND'
+                        ' end <= ? AND cancelled = 0', (now,)).fetchall()
+    if not rows:
+        return
+    token_cache = dict()
+    for (job_id, task, logpath, configfile, start, end, node,
+         exit_code) in rows:
+        if configfile not in token_cache:
+            token_cache[configfile] = _token_lines(configfile)
+        tokens = token_cache[configfile]
+        lines = [tokens['start_time'] + str(int(start)),
+                 tokens['node'] + node,
+                 'Job {0} running on a fake slurm node'.format(
+                     job_display_id(job_id, task))]
+        if exit_code == 0:
+            lines.append(tokens['SUCCESS'])
+        else:
+            lines.append(tokens['error_string'] + 'fake slurm job failure')
+        lines.append(tokens['end_time'] + str(int(end)))
+        lines.append(tokens['exit_code'] + str(exit_code))
+        try:
+            with open(logpath, 'w') as log:
+                log.write('\n'.join(lines) + '\n')
+        except IOError:
+            pass
+    with conn:
+        conn.executemany('UPDATE jobs SET logged = 1 WHERE id = ? AND'
+                         ' task = ?', [row[0:2] for row in rows])
+
+
+def output_path(pattern, workdir, job_id, task):
+    """Return the log path of a job from an sbatch --output pattern."""
+    path = pattern.replace('%A', str(job_id))
+    path = path.replace('%a', str(max(task, 0)))
+    path = path.replace('%j', job_display_id(job_id, task))
+    return os.path.join(workdir, path)
+
+
+def sbatch(args, now):
+    """Queue a job or job array, return the command output."""
+    options, others = parse_options(args, {'-A': 'account', '-o': 'output',
+                                           '-J': 'job-name', '-a': 'array'})
+    if not others:
+        raise CommandError('sbatch: error: Unable to open file\n')
+    script = others[0]
+    try:
+        with open(script) as handle:
+            for line in handle:
+                match = re.match(r'#SBATCH\s+--([\w-]+)=(\S+)', line)
+                if match and match.group(1) not in options:
+                    options[match.group(1)] = match.group(2).strip('"')
+    except IOError:
+        raise CommandError('sbatch: error: Unable to open file '
+                           '{0}\n'.format(script))
+    tasks = [-1]
+    if 'array' in options:
+        tasks = parse_array(options['array'])
+    conn = connect()
+    max_jobs = int(setting('MAX_JOBS', 0))
+    with conn:
+        # take the write lock for the whole submission
+        conn.execute('BEGIN IMMEDIATE')
+        if max_jobs:
+            queued = conn.execute('SELECT COUNT(*) FROM jobs WHERE end > ?'
+                                  ' AND cancelled = 0', (now,)).fetchone()[0]
+            if queued + len(tasks) > max_jobs:
+                raise CommandError(
+                    'sbatch: error: QOSMaxSubmitJobPerUserLimit\n'
+                    'sbatch: error: Batch job submission failed: Job '
+                    'violates accounting/QOS policy (job submit limit, '
+                    'user\'s size and/or time limits)\n')
+        row = conn.execute('SELECT next_id FROM sequence').fetchone()
+        job_id = row[0] if row else 1000
+        conn.execute('DELETE FROM sequence')
+        conn.execute('INSERT INTO sequence VALUES (?)', (job_id + 1,))
+        wait = setting('WAIT', 0)
+        runtime = setting('RUNTIME', 0)
+        failure_rate = setting('FAILURE_RATE', 0)
+        nodes = int(setting('NODES', 100))
+        pattern = options.get('output', 'slurm-%j.out')
+        rows = []
+        for task in tasks:
+            start = now + random.uniform(0, 2*wait)
+            end = start + random.uniform(0, 2*runtime)
+            exit_code = 1 if random.random() < failure_rate else 0
+            rows.append((job_id, task,
+                         pwd.getpwuid(os.getuid()).pw_name,
+                         options.get('account', ''),
+                         options.get('job-name', os.path.basename(script)),
+                         output_path(pattern, os.getcwd(), job_id, task),
+                         os.environ.get('AUTOCMS_CONFIGFILE', ''),
+                         now, start, end,
+                         'fake{0:03d}'.format(random.randrange(nodes)),
+                         exit_code, random.randint(1 << 10, 1 << 20)))
+        conn.executemany('INSERT INTO jobs (id, task, user, account, name,'
+                         ' logpath, configfile, submit, start, end, node,'
+                         ' exit_code, max_rss) VALUES (?, ?, ?, ?, ?, ?, ?,'
+                         ' ?, ?, ?, ?, ?, ?)', rows)
+    return 'Submitted batch job {0}\n'.format(job_id)
+
+
+def squeue(args, now):
+    """List pending and running jobs, return the command output."""
+    options, others = parse_options(args, {'-o': 'format', '-j': 'jobs',
+                                           '-u': 'user', '-A': 'account'})
+    fmt = options.get('format', '%i %P %j %u %t %M %D %R')
+    codes = re.findall(r'%[.\d]*(\w)', fmt)
+    separators = re.split(r'%[.\d]*\w', fmt)
+    conn = connect()
+    write_finished_logs(conn, now)
+    where = 'end > ? AND cancelled = 0'
+    params = [now]
+    for name in ('user', 'account'):
+        if name in options:
+            where += ' AND {0} = ?'.format(name)
+            params.append(options[name])
+    ids = None
+    if 'jobs' in options:
+        ids = parse_job_ids(options['jobs'])
+    rows = select_jobs(conn, 'id, task, user, account, name, submit, start,'
+                       ' end, node', ids, where, params)
+    lines = []
+    combine = not ('r' in options or 'array' in options)
+    # line index and task ids of the pending tasks of each job array
+    pending_arrays = dict()
+    for job_id, task, user, account, name, submit, start, end, node in rows:
+        pending = now < start
+        if pending and task >= 0 and combine:
+            # pending array tasks are shown on one line like slurm does
+            if job_id in pending_arrays:
+                pending_arrays[job_id][1].append(task)
+                continue
+            pending_arrays[job_id] = (len(lines), [task])
+        values = {'i': job_display_id(job_id, task),
+                  'A': str(job_id),
+                  'K': str(task) if task >= 0 else 'N/A',
+                  'T': 'PENDING' if pending else 'RUNNING',
+                  't': 'PD' if pending else 'R',
+                  'V': slurm_time(submit),
+                  'S': 'N/A' if pending else slurm_time(start),
+                  'M': slurm_duration(0 if pending else now - start, True),
+                  'N': '' if pending else node,
+                  'R': '(Priority)' if pending else node,
+                  'j': name, 'u': user, 'a': account, 'P': 'production',
+                  'D': '1'}
+        lines.append([values.get(code, '') for code in codes])
+    for job_id, (line, tasks) in pending_arrays.iteritems():
+        if len(tasks) > 1:
+            for column, code in enumerate(codes):
+                if code == 'i':
+                    lines[line][column] = '{0}_[{1}-{2}]'.format(
+                        job_id, tasks[0], tasks[-1])
+    output = []
+    for values in lines:
+        text = separators[0]
+        for value, separator in zip(values, separators[1:]):
+            text += value + separator
+        output.append(text)
+    return ''.join(line + '\n' for line in output)
+
+
+def sacct(args, now):
+    """Report accounting information of jobs, return the command output."""
+    options, others = parse_options(args, {'-j': 'jobs', '-o': 'format',
+                                           '-u': 'user', '-S': 'starttime'})
+    fields = options.get('format',
+                         'JobID,JobName,Account,State,ExitCode').split(',')
+    delimiter = '|' if 'P' in options or 'parsable2' in options else ' '
+    conn = connect()
+    write_finished_logs(conn, now)
+    where = None
+    params = ()
+    if 'user' in options:
+        where = 'user = ?'
+        params = (options['user'],)
+    ids = None
+    if 'jobs' in options:
+        ids = parse_job_ids(options['jobs'])
+    rows = select_jobs(conn, 'id, task, user, account, name, submit, start,'
+                       ' end, node, exit_code, max_rss, cancelled', ids,
+                       where, params)
+    output = []
+    if not ('n' in options or 'noheader' in options):
+        output.append(delimiter.join(fields))
+    for (job_id, task, user, account, name, submit, start, end, node,
+         exit_code, max_rss, cancelled) in rows:
+        state = job_state(start, end, exit_code, cancelled, now)
+        started = state != 'PENDING' and now >= start
+        ended = state not in ('PENDING', 'RUNNING')
+        elapsed = (min(now, end) - start) if started else 0
+        values = {'JobID': job_display_id(job_id, task),
+                  'JobIDRaw': str(job_id),
+                  'JobName': name, 'Account': account, 'User': user,
+                  'State': state if not cancelled else 'CANCELLED by 0',
+                  'Submit': slurm_time(submit),
+                  'Start': slurm_time(start if started else None),
+                  'End': slurm_time(end if ended else None),
+                  'NodeList': node if started else 'None assigned',
+                  'ExitCode': '{0}:0'.format(exit_code if ended else 0),
+                  'Elapsed': slurm_duration(elapsed),
+                  'TotalCPU': slurm_duration(elapsed * 0.8)}
+        output.append(delimiter.join(values.get(field, '')
+                                     for field in fields))
+        if 'X' in options or 'allocations' in options or not started:
+            continue
+        values['JobID'] += '.batch'
+        values['JobName'] = 'batch'
+        values.update({'MaxRSS': '{0}K'.format(max_rss),
+                       'AveDiskRead': '{0}K'.format(max_rss // 4),
+                       'AveDiskWrite': '{0}K'.format(max_rss // 8)})
+        output.append(delimiter.join(values.get(field, '')
+                                     for field in fields))
+    return ''.join(line + '\n' for line in output)
+
+
+def scancel(args, now):
+    """Cancel jobs, return the command output."""
+    options, others = parse_options(args)
+    ids = []
+    for item in others:
+        ids.extend(parse_job_ids(item))
+    conn = connect()
+    rows = select_jobs(conn, 'id, task', ids, 'end > ? AND cancelled = 0',
+                       (now,))
+    with conn:
+        conn.executemany('UPDATE jobs SET cancelled = 1, end = ? WHERE'
+                         ' id = ? AND task = ?',
+                         [(now, job_id, task) for job_id, task in rows])
+    return ''
+
+
+def main(name, args):
+    """Run the named command with its arguments, return the exit code."""
+    time.sleep(setting('LATENCY', 0))
+    if random.random() < setting('TIMEOUT_RATE', 0):
+        sys.stderr.write(timeout_message.format(name))
+        return 1
+    command = {'sbatch': sbatch, 'squeue': squeue, 'sacct': sacct,
+               'scancel': scancel}[name]
+    try:
+        sys.stdout.write(command(args, time.time()))
+    except CommandError as err:
+        sys.stderr.write(err.message)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write('usage: python -m benchmarks.fakeslurm BINDIR\n')
+        sys.exit(2)
+    install(sys.argv[1])
@@ -4,18 +4,32 @@ import sys
 import argparse
 
 from autocms.core import load_configuration
-from autocms.harvest import perform_test_harvesting
+from autocms.harvest import (
+    perform_harvesting,
+    perform_test_harvesting
+)
 
 
 def main():
-    """Call perform_test_harvesting with command line arguments."""
+    """Call perform_test_harvesting with command line arguments.
+
+    With --all every test in AUTOCMS_TEST_NAMES is harvested by
+    perform_harvesting with a single scheduler query."""
     parser = argparse.ArgumentParser(description='Submit one or more jobs.')
-    parser.add_argument('testname', help='test directory')
+    parser.add_argument('testname', nargs='?', help='test directory')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='harvest all tests in AUTOCMS_TEST_NAMES')
     parser.add_argument('-c', '--configfile', type=str,
                         default='autocms.cfg',
                         help='AutoCMS configuration file name')
     args = parser.parse_args()
+    if args.all == (args.testname is not None):
+        parser.error('give either a testname or --all')
     config = load_configuration(args.configfile)
+    if args.all:
+        failed = perform_harvesting(config['AUTOCMS_TEST_NAMES'].split(':'),
+                                    config)
+        return 1 if failed else 0
     perform_test_harvesting(args.testname, config)
     return 0
 
@@ -1,9 +1,23 @@
 """Print all records in the pickle for the specified test"""
 
 import sys
+import time
 import argparse
 
 from autocms.core import (load_configuration, load_records)
+from autocms.snapshot import load_record_snapshot
+from autocms.archive import iter_archived_records
+
+
+def print_snapshot(snapshot):
+    """Print one line per job from a RecordSnapshot."""
+    print 'seq submit_time start_time end_time exit_code completed node'
+    for row in xrange(len(snapshot)):
+        print '{0} {1} {2} {3} {4} {5} {6}'.format(
+            snapshot.seq[row], snapshot.submit_time[row],
+            snapshot.start_time[row], snapshot.end_time[row],
+            snapshot.exit_code[row], snapshot.completed[row],
+            snapshot.node_table[snapshot.node_codes[row]])
 
 
 def main():
@@ -13,9 +27,26 @@ def main():
     parser.add_argument('-c', '--configfile', type=str,
                         default='autocms.cfg',
                         help='AutoCMS configuration file name')
+    parser.add_argument('-s', '--snapshot', action='store_true',
+                        help='print a line per job from the columnar '
+                             'snapshot written by the logharvester')
+    parser.add_argument('-a', '--archive', type=int, metavar='DAYS',
+                        help='print archived records submitted in the '
+                             'last DAYS days instead')
     args = parser.parse_args()
     config = load_configuration(args.configfile)
-    records = load_records(args.testname,config)
+    if args.snapshot:
+        snapshot = load_record_snapshot(args.testname, config)
+        if snapshot is None:
+            print 'No record snapshot found for ' + args.testname
+            return 1
+        print_snapshot(snapshot)
+        return 0
+    if args.archive is not None:
+        start = int(time.time()) - 3600*24*args.archive
+        records = iter_archived_records(args.testname, config, start)
+    else:
+        records = load_records(args.testname,config)
     for job in records:
         print str(job)+'\n'
     return 0
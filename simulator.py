@@ -0,0 +1,82 @@
+"""Simulate AutoCMS operation from job history and report resource use."""
+
+import sys
+import shutil
+import argparse
+import tempfile
+
+from autocms.core import load_configuration
+from autocms.simulate import (
+    JobHistory,
+    Simulation,
+    SimulationError
+)
+
+
+def select_tests(testnames, config):
+    """Restrict the configured tests and their submission settings."""
+    configured = config['AUTOCMS_TEST_NAMES'].split(':')
+    for key in ('AUTOCMS_TEST_SUBWAITS', 'AUTOCMS_TEST_SUBCOUNTS'):
+        values = dict(zip(configured, config[key].split(':')))
+        config[key] = ':'.join(values[testname] for testname in testnames)
+    config['AUTOCMS_TEST_NAMES'] = ':'.join(testnames)
+
+
+def main():
+    """Run a Simulation with command line arguments and print its report.
+
+    Configuration values to try out are given as --set KEY=VALUE, e.g.
+    --set AUTOCMS_MAXENQUEUE=50, and apply only to the simulation."""
+    parser = argparse.ArgumentParser(
+        description='Simulate AutoCMS with historical job outcomes.')
+    parser.add_argument('testnames', nargs='*',
+                        help='tests to simulate, AUTOCMS_TEST_NAMES if none')
+    parser.add_argument('-d', '--days', type=float, default=7,
+                        help='days of operation to simulate')
+    parser.add_argument('-s', '--set', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='configuration value for the simulation')
+    parser.add_argument('-o', '--simdir', type=str,
+                        help='keep the simulated base directory here '
+                             'instead of a removed temporary one')
+    parser.add_argument('--skip', nargs='+', default=[],
+                        choices=['submit', 'harvest', 'stats', 'report'],
+                        help='stages not to perform')
+    parser.add_argument('--seed', type=int,
+                        help='random seed for reproducible simulations')
+    parser.add_argument('-c', '--configfile', type=str,
+                        default='autocms.cfg',
+                        help='AutoCMS configuration file name')
+    args = parser.parse_args()
+    config = load_configuration(args.configfile)
+    if args.testnames:
+        select_tests(args.testnames, config)
+    testnames = config['AUTOCMS_TEST_NAMES'].split(':')
+    try:
+        histories = dict((testname, JobHistory.from_test(testname, config))
+                         for testname in testnames)
+    except SimulationError as err:
+        print err.message
+        return 1
+    sim_config = dict(config)
+    for setting in args.set:
+        key, value = setting.split('=', 1)
+        sim_config[key] = value
+    simdir = args.simdir or tempfile.mkdtemp()
+    try:
+        stages = [stage for stage in ('submit', 'harvest', 'stats', 'report')
+                  if stage not in args.skip]
+        simulation = Simulation(histories, sim_config, simdir,
+                                seed=args.seed, stages=stages)
+        simulation.setup(config['AUTOCMS_BASEDIR'])
+        simulation.run(int(args.days*86400))
+        sys.stdout.write(simulation.report())
+    finally:
+        if args.simdir is None:
+            shutil.rmtree(simdir)
+    return 0
+
+
+if __name__ == '__main__':
+    status = main()
+    sys.exit(status)
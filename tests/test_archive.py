@@ -0,0 +1,96 @@
+"""Test the per-day archive of purged JobRecords."""
+
+import os
+import shutil
+import time
+import unittest
+
+from autocms.core import (
+    JobRecord,
+    load_configuration
+)
+from autocms.archive import (
+    archive_records,
+    day_key,
+    iter_archived_records,
+    list_archive_segments,
+    purge_old_archive_segments
+)
+from autocms.harvest import purge_old_jobs
+
+
+class TestRecordArchive(unittest.TestCase):
+    """Test archiving, querying, and expiring archived records."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        os.makedirs(self.testdir)
+        self.now = int(time.time())
+        self.records = [JobRecord(count, str(count*100),
+                                  self.now - 3600*24*count, 0,
+                                  'test_' + str(count) + '.log')
+                        for count in range(0, 10)]
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_archive_segments(self):
+        """Check that records are stored in one segment per day."""
+        archive_records(self.records, 'uscratch', self.config)
+        segments = list_archive_segments('uscratch', self.config)
+        self.assertEqual(len(segments), 10)
+        self.assertEqual(segments[-1][0], day_key(self.now))
+
+    def test_archive_append(self):
+        """Check that archiving to an existing segment keeps all jobs."""
+        archive_records(self.records[0:1], 'uscratch', self.config)
+        job = JobRecord(20, '2000', self.records[0].submit_time, 0, 'a.log')
+        job.tokens['dice_sum'] = '7'
+        archive_records([job], 'uscratch', self.config)
+        archived = list(iter_archived_records('uscratch', self.config))
+        self.assertEqual(sorted(job.seq for job in archived), [0, 20])
+        self.assertEqual(archived[-1].dice_sum, '7')
+
+    def test_archive_twice(self):
+        """Check that a job archived again is returned once."""
+        archive_records(self.records[0:2], 'uscratch', self.config)
+        self.records[0].exit_code = 0
+        archive_records(self.records[0:1], 'uscratch', self.config)
+        archived = list(iter_archived_records('uscratch', self.config))
+        self.assertEqual(sorted(job.seq for job in archived), [0, 1])
+        self.assertEqual([job.exit_code for job in archived
+                          if job.seq == 0], [0])
+
+    def test_archive_query_window(self):
+        """Check that queries only return jobs within the interval."""
+        archive_records(self.records, 'uscratch', self.config)
+        start = self.now - 3600*24*3 - 10
+        end = self.now - 3600*24
+        archived = iter_archived_records('uscratch', self.config, start, end)
+        self.assertEqual(sorted(job.seq for job in archived), [2, 3])
+
+    def test_archive_purged_jobs(self):
+        """Check that purged jobs are returned for archiving."""
+        records = self.records[:]
+        time.sleep(2)
+        expired = purge_old_jobs(records, self.config)
+        log_lifetime = int(self.config['AUTOCMS_LOG_LIFETIME'])
+        self.assertEqual(len(records), log_lifetime)
+        self.assertEqual(len(expired), 10 - log_lifetime)
+
+    def test_archive_lifetime(self):
+        """Check that old segments are removed after the archive lifetime."""
+        archive_records(self.records, 'uscratch', self.config)
+        purge_old_archive_segments('uscratch', self.config)
+        self.assertEqual(len(list_archive_segments('uscratch',
+                                                   self.config)), 10)
+        self.config['AUTOCMS_ARCHIVE_LIFETIME'] = '4'
+        purge_old_archive_segments('uscratch', self.config)
+        remaining = list_archive_segments('uscratch', self.config)
+        self.assertTrue(4 <= len(remaining) <= 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Test the execution of scheduler commands."""
+
+import os
+import unittest
+
+from autocms.core import load_configuration
+from autocms.command import (
+    CommandFailed,
+    check_command,
+    load_command_metrics,
+    metrics_path,
+    run_command
+)
+from autocms.web import AutoCMSWebpage
+
+
+class TestRunCommand(unittest.TestCase):
+    """Test timeouts and latency metrics of commands."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_COMMAND_TIMEOUT'] = '10'
+
+    def tearDown(self):
+        if os.path.exists(metrics_path(self.config)):
+            os.remove(metrics_path(self.config))
+
+    def test_output_and_metrics(self):
+        """Test that output is returned and latencies are recorded."""
+        result = run_command(['echo', 'a b'], self.config)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.output, 'a b\n')
+        self.assertFalse(result.timed_out)
+        run_command(['false'], self.config)
+        run_command(['echo', 'again'], self.config)
+        metrics = load_command_metrics(self.config)
+        self.assertEqual(metrics['echo']['calls'], 2)
+        self.assertEqual(sum(metrics['echo']['buckets']), 2)
+        self.assertEqual(metrics['false']['failures'], 1)
+
+    def test_timeout(self):
+        """Test that a command is killed after its own timeout."""
+        self.config['AUTOCMS_SLEEP_TIMEOUT'] = '0.2'
+        result = run_command(['sleep', '5'], self.config)
+        self.assertTrue(result.timed_out)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertLess(result.latency, 4)
+        self.assertIn('timed out', result.output)
+        self.assertEqual(load_command_metrics(self.config)['sleep']
+                         ['timeouts'], 1)
+
+    def test_failures(self):
+        """Test missing commands and check_command failures."""
+        result = run_command(['autocms-no-such-command'], self.config)
+        self.assertEqual(result.returncode, 127)
+        self.assertRaises(CommandFailed, check_command,
+                          ['sh', '-c', 'exit 3'], self.config)
+        self.assertEqual(check_command(['echo', 'ok'], self.config), 'ok\n')
+
+    def test_webpage_table(self):
+        """Test that the latency table is added to the webpage."""
+        page = AutoCMSWebpage([], 'uscratch', self.config)
+        page.add_command_latencies(95)
+        self.assertEqual(page.page, '')
+        run_command(['echo'], self.config)
+        page.add_command_latencies(95)
+        self.assertIn('<td>echo</td><td>1</td>', page.page)
+
+
+if __name__ == '__main__':
+    unittest.main()
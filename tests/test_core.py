@@ -1,12 +1,21 @@
 """Test the AutoCMS core functionality."""
 
 import os
+import shutil
+import sqlite3
 import unittest
+import cPickle as pickle
 
 from autocms.core import (JobRecord,
+                          RecordIndex,
+                          TokenMatcher,
+                          iter_log_lines,
+                          get_token_matcher,
                           load_configuration,
                           load_records,
-                          save_records)
+                          save_records,
+                          merge_records,
+                          create_record_store)
 
 
 class TestConfiguration(unittest.TestCase):
@@ -37,20 +46,184 @@ class TestJobRecord(unittest.TestCase):
         record = JobRecord(1, 928417, 1427266702, 0, 'data/example_A.log')
         record.parse_output('tests', self.config)
         self.assertEqual(getattr(record, 'num_proc'), '383')
+        self.assertEqual(record.tokens, {'num_proc': '383', 'dice_sum': '9'})
         self.assertEqual(record.exit_code, 0)
         self.assertEqual(record.start_time, 1427266802)
         self.assertEqual(record.end_time, 1427267170)
 
+    def test_jobrecord_parse_summary(self):
+        """Test that a job summary is used instead of the log."""
+        datadir = os.path.join(self.config['AUTOCMS_BASEDIR'], 'tests', 'data')
+        shutil.copyfile(os.path.join(datadir, 'example_A.log'),
+                        os.path.join(datadir, 'example_B.log'))
+        summary = os.path.join(datadir, 'example_B.jsonl')
+        with open(summary, 'w') as handle:
+            handle.write('{"token": "start_time", "value": "1427266900"}\n'
+                         '{"token": "num_proc", "value": "12 \\"x\\""}\n'
+                         '{"token": "SUCCESS", "value": ""}\n'
+                         '{"token": "end_time", "value": "1427267000"}\n'
+                         '{"token": "exit_co')
+        try:
+            record = JobRecord(1, 928417, 1427266702, 0, 'data/example_B.log')
+            record.parse_output('tests', self.config)
+        finally:
+            os.remove(os.path.join(datadir, 'example_B.log'))
+            os.remove(summary)
+        self.assertEqual(record.tokens, {'num_proc': '12 "x"'})
+        self.assertEqual(record.exit_code, 0)
+        self.assertEqual(record.start_time, 1427266900)
+        self.assertEqual(record.end_time, 1427267000)
+
+    def test_jobrecord_legacy_pickle(self):
+        """Test loading a record pickled before JobRecord used __slots__."""
+        legacy = LegacyJobRecord()
+        legacy.__dict__.update(seq=1, jobid='928417', submit_time=1427266702,
+                               submit_status=0, start_time=1427266802,
+                               end_time=1427267170, node='vmp544',
+                               exit_code=0, error_string='', completed=True,
+                               logfile='a.log', dice_sum='9')
+        legacy_pickle = pickle.dumps([legacy]).replace(
+            'tests.test_core\nLegacyJobRecord', 'autocms.core\nJobRecord')
+        record = pickle.loads(legacy_pickle)[0]
+        self.assertIsInstance(record, JobRecord)
+        self.assertEqual(record.node, 'vmp544')
+        self.assertEqual(record.tokens, {'dice_sum': '9'})
+        self.assertEqual(record.dice_sum, '9')
+        self.assertFalse(hasattr(record, 'num_proc'))
+
+    def test_jobrecord_usage_pickle(self):
+        """Test loading a record pickled before resource usage was kept."""
+        record = JobRecord(1, '928417', 1427266702, 0, 'a.log')
+        state = tuple(getattr(record, attr) for attr in JobRecord.fields)
+        old_record = JobRecord.__new__(JobRecord)
+        old_record.__setstate__(state + ({'dice_sum': '9'},))
+        self.assertEqual(old_record.logfile, 'a.log')
+        self.assertEqual(old_record.dice_sum, '9')
+        self.assertIsNone(old_record.max_rss)
+        self.assertIsNone(old_record.cpu_efficiency())
+
     def test_jobrecord_stamp(self):
         """Test writing and constructing from a stamp."""
         record = JobRecord(1, '928417', 1427266702, 0, 'data/example_A.log')
         stamp = record.stamp()
         record_copy = JobRecord.create_from_stamp(stamp)
-        self.assertEqual(record.__dict__, record_copy.__dict__)
+        self.assertEqual(record.__getstate__(),
+                         record_copy.__getstate__())
         record = JobRecord(3, None, 427266792, 4, 'c.log')
         stamp = record.stamp()
         record_copy = JobRecord.create_from_stamp(stamp)
-        self.assertEqual(record.__dict__, record_copy.__dict__)
+        self.assertEqual(record.__getstate__(),
+                         record_copy.__getstate__())
+
+
+class TestRecordIndex(unittest.TestCase):
+    """Test the hash indexes over a JobRecord list."""
+
+    def setUp(self):
+        self.records = [JobRecord(1, '928417', 1427266702, 0, 'a.log'),
+                        JobRecord(2, '928423', 1427266742, 0, 'b.log'),
+                        JobRecord(3, None, 1427266792, 4, 'c.log')]
+        self.index = RecordIndex(self.records)
+
+    def test_index_lookup(self):
+        """Check lookup by key and of pending jobs."""
+        self.assertIn((2, 1427266742), self.index)
+        self.assertNotIn((2, 1427266743), self.index)
+        self.assertEqual(sorted(self.index.pending), ['928417', '928423'])
+
+    def test_index_add_complete_remove(self):
+        """Check that the indexes follow changes to the records."""
+        self.index.add(JobRecord(4, '928500', 1427266900, 0, 'd.log'))
+        self.assertEqual(len(self.records), 4)
+        self.assertIn('928500', self.index.pending)
+        completed = self.index.complete('928417')
+        self.assertEqual([job.seq for job in completed], [1])
+        self.assertTrue(self.records[0].completed)
+        self.assertNotIn('928417', self.index.pending)
+        removed = self.index.remove_if(lambda job: job.seq % 2 == 0)
+        self.assertEqual([job.seq for job in removed], [2, 4])
+        self.assertEqual([job.seq for job in self.records], [1, 3])
+        self.assertNotIn((4, 1427266900), self.index)
+        self.assertEqual(self.index.pending, {})
+
+
+class TestTokenMatcher(unittest.TestCase):
+    """Test matching of configured tokens against log lines."""
+
+    def setUp(self):
+        self.config = {'AUTOCMS_node_TOKEN': 'AutoCMS: worker node ',
+                       'AUTOCMS_node_jobs_TOKEN': 'AutoCMS: worker node jobs ',
+                       'AUTOCMS_price_TOKEN': 'AutoCMS: cost ($) ',
+                       'AUTOCMS_BASEDIR': '/tmp'}
+        self.matcher = TokenMatcher(self.config)
+
+    def test_token_match(self):
+        """Check token names and values are returned for token lines."""
+        self.assertEqual(self.matcher.match('AutoCMS: worker node vmp544'),
+                         (['node'], 'vmp544'))
+        self.assertIsNone(self.matcher.match('cmsRun: worker node vmp544'))
+        self.assertIsNone(self.matcher.match(' AutoCMS: worker node vmp5'))
+
+    def test_token_longest_match(self):
+        """Check that the longest of overlapping tokens is matched."""
+        self.assertEqual(self.matcher.match('AutoCMS: worker node jobs 3'),
+                         (['node_jobs'], '3'))
+
+    def test_token_literal_match(self):
+        """Check that tokens are not interpreted as regular expressions."""
+        self.assertEqual(self.matcher.match('AutoCMS: cost ($) 12'),
+                         (['price'], '12'))
+        self.assertIsNone(self.matcher.match('AutoCMS: cost $ 12'))
+
+    def test_token_matcher_cache(self):
+        """Check that matchers are reused for the same tokens."""
+        config = dict(self.config)
+        config['AUTOCMS_BASEDIR'] = '/var/tmp'
+        self.assertIs(get_token_matcher(self.config),
+                      get_token_matcher(config))
+
+
+class TestLogLines(unittest.TestCase):
+    """Test streaming of log lines with and without head/tail windows."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.logpath = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'tests', 'data', 'window.log')
+        with open(self.logpath, 'w') as log:
+            log.write('first\nsecond\n')
+            log.write('middle line\n' * 1000)
+            log.write('second to last\nlast\n')
+
+    def tearDown(self):
+        os.remove(self.logpath)
+
+    def test_log_lines_full(self):
+        """Check that all lines are returned without a window."""
+        lines = list(iter_log_lines(self.logpath))
+        self.assertEqual(len(lines), 1004)
+        self.assertEqual(lines[0], 'first')
+        self.assertEqual(lines[-1], 'last')
+
+    def test_log_lines_window(self):
+        """Check that only whole lines in the head and tail are returned."""
+        lines = list(iter_log_lines(self.logpath, 16, 25))
+        self.assertEqual(lines, ['first', 'second', 'second to last', 'last'])
+        lines = list(iter_log_lines(self.logpath, 13, 20))
+        self.assertEqual(lines, ['first', 'second', 'second to last', 'last'])
+        lines = list(iter_log_lines(self.logpath, 12, 19))
+        self.assertEqual(lines, ['first', 'last'])
+
+    def test_log_lines_small_file(self):
+        """Check that logs smaller than the window are read completely."""
+        lines = list(iter_log_lines(self.logpath, 100000, 100000))
+        self.assertEqual(len(lines), 1004)
+
+
+class LegacyJobRecord(object):
+    """Stand-in for a JobRecord with an instance dictionary."""
+    pass
+
 
 class TestRecordPersistance(unittest.TestCase):
     """Test that jobrecord lists are loaded and saved correctly."""
@@ -58,6 +231,7 @@ class TestRecordPersistance(unittest.TestCase):
     def setUp(self):
         """Make a sample list of JobRecords and try to save it."""
         self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_RECORD_STORE'] = 'pickle'
         self.records = []
         self.records.append(JobRecord(1, '928417', 1427266702, 0, 'a.log'))
         self.records.append(JobRecord(2, '928423', 427266742, 0, 'b.log'))
@@ -82,8 +256,128 @@ class TestRecordPersistance(unittest.TestCase):
         records_copy = load_records('tests', self.config)
         rdict_copy = {job.seq : job for job in records_copy}
         for key in rdict.viewkeys():
-            self.assertEqual(rdict[key].__dict__,
-                             rdict_copy[key].__dict__)
+            self.assertEqual(rdict[key].__getstate__(),
+                             rdict_copy[key].__getstate__())
+
+
+class TestSqliteRecordStore(unittest.TestCase):
+    """Test the sqlite record store and migration from a pickle."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_RECORD_STORE'] = 'sqlite'
+        self.testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        os.makedirs(self.testdir)
+        self.records = []
+        self.records.append(JobRecord(1, '928417', 1427266702, 0, 'a.log'))
+        self.records.append(JobRecord(2, '928423', 427266742, 0, 'b.log'))
+        self.records.append(JobRecord(3, None, 427266792, 4, 'c.log'))
+        self.records[0].tokens['dice_sum'] = '7'
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_sqlite_roundtrip(self):
+        """Check that records and token attributes survive the database."""
+        save_records(self.records, 'uscratch', self.config)
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir,
+                                                    'records.sqlite')))
+        records_copy = load_records('uscratch', self.config)
+        rdict_copy = {job.seq : job for job in records_copy}
+        for job in self.records:
+            self.assertEqual(job.__getstate__(),
+                             rdict_copy[job.seq].__getstate__())
+
+    def test_sqlite_row_updates(self):
+        """Check that changed, added, and removed records are saved."""
+        save_records(self.records, 'uscratch', self.config)
+        store = create_record_store('uscratch', self.config)
+        records = store.load()
+        records.sort(key=lambda job: job.seq)
+        records[0].completed = True
+        records[0].exit_code = 0
+        del records[2]
+        records.append(JobRecord(4, '928500', 1427266900, 0, 'd.log'))
+        store.save(records)
+        records_copy = load_records('uscratch', self.config)
+        rdict_copy = {job.seq : job for job in records_copy}
+        self.assertEqual(sorted(rdict_copy.keys()), [1, 2, 4])
+        self.assertTrue(rdict_copy[1].completed)
+        self.assertEqual(rdict_copy[1].exit_code, 0)
+
+    def test_sqlite_time_window(self):
+        """Check that windowed loads skip jobs completed before since."""
+        self.records[1].completed = True
+        self.records[1].end_time = 427266800
+        save_records(self.records, 'uscratch', self.config)
+        records_copy = load_records('uscratch', self.config, 1427000000)
+        self.assertEqual(sorted(job.seq for job in records_copy), [1])
+
+    def test_windowed_save(self):
+        """Check merging a windowed load and replacing all records."""
+        self.records[1].completed = True
+        self.records[1].end_time = 427266800
+        for store_type in ('pickle', 'sqlite'):
+            self.config['AUTOCMS_RECORD_STORE'] = store_type
+            save_records(self.records, 'uscratch', self.config)
+            records = load_records('uscratch', self.config, 1427000000)
+            merge_records(records, 'uscratch', self.config)
+            store = create_record_store('uscratch', self.config)
+            records = store.load(1427000000)
+            store.save([job for job in records if job.seq != 1])
+            self.assertEqual(sorted(job.seq for job in
+                                    load_records('uscratch', self.config)),
+                             [2, 3])
+            # saving a list without a load replaces the stored records
+            save_records(records, 'uscratch', self.config)
+            self.assertEqual([job.seq for job in
+                              load_records('uscratch', self.config)], [1])
+            os.remove(create_record_store('uscratch', self.config).filepath)
+
+    def test_sqlite_usage_columns(self):
+        """Check that a database without usage columns is extended."""
+        conn = sqlite3.connect(os.path.join(self.testdir, 'records.sqlite'))
+        conn.execute('CREATE TABLE jobs (seq INTEGER NOT NULL,'
+                     ' submit_time INTEGER NOT NULL, jobid,'
+                     ' submit_status INTEGER, start_time INTEGER,'
+                     ' end_time INTEGER, node, exit_code INTEGER,'
+                     ' error_string TEXT, completed INTEGER,'
+                     ' logfile TEXT, tokens TEXT)')
+        conn.close()
+        self.records[0].max_rss = 1 << 20
+        self.records[0].total_cpu = 12.5
+        save_records(self.records, 'uscratch', self.config)
+        rdict_copy = {job.seq: job
+                      for job in load_records('uscratch', self.config)}
+        self.assertEqual(rdict_copy[1].max_rss, 1 << 20)
+        self.assertEqual(rdict_copy[1].total_cpu, 12.5)
+        self.assertIsNone(rdict_copy[2].max_rss)
+
+    def test_pickle_migration(self):
+        """Check that an existing pickle is migrated into the database."""
+        self.config['AUTOCMS_RECORD_STORE'] = 'pickle'
+        save_records(self.records, 'uscratch', self.config)
+        self.config['AUTOCMS_RECORD_STORE'] = 'sqlite'
+        records_copy = load_records('uscratch', self.config)
+        self.assertEqual(len(records_copy), 3)
+        self.assertFalse(os.path.isfile(os.path.join(self.testdir,
+                                                     'records.pickle')))
+
+    def test_pickle_migration_into_rows(self):
+        """Check that a pickle is merged into a non-empty database."""
+        save_records(self.records[:2], 'uscratch', self.config)
+        self.config['AUTOCMS_RECORD_STORE'] = 'pickle'
+        changed = JobRecord(1, '928417', 1427266702, 0, 'changed.log')
+        save_records([changed, self.records[2]], 'uscratch', self.config)
+        self.config['AUTOCMS_RECORD_STORE'] = 'sqlite'
+        rdict_copy = {job.seq: job
+                      for job in load_records('uscratch', self.config)}
+        self.assertEqual(sorted(rdict_copy), [1, 2, 3])
+        # rows already in the database are kept
+        self.assertEqual(rdict_copy[1].logfile, 'a.log')
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.testdir, 'records.pickle.migrated')))
 
 
 if __name__ == '__main__':
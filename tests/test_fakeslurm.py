@@ -0,0 +1,98 @@
+"""Test SlurmScheduler against the stand-in slurm commands."""
+
+import os
+import shutil
+import unittest
+
+from autocms.core import (
+    load_configuration,
+    load_records
+)
+from autocms.scheduler import SlurmScheduler
+from autocms.submit import (
+    perform_test_submission,
+    submit_and_stamp_jobs
+)
+from autocms.harvest import perform_test_harvesting
+from benchmarks import fakeslurm
+
+
+class TestFakeSlurm(unittest.TestCase):
+    """Drive the slurm scheduler through fake sbatch, squeue and sacct."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_SCHEDULER'] = 'slurm'
+        self.config['AUTOCMS_QUEUE_TTL'] = '0'
+        self.config['AUTOCMS_SLURM_ARRAY'] = '1'
+        self.testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        os.makedirs(self.testdir)
+        with open(os.path.join(self.testdir, 'uscratch.slurm'), 'w') as handle:
+            handle.write('#!/bin/bash\n'
+                         '#SBATCH --output=uscratch.slurm.o%A.log\n')
+        fakeslurm.install(os.path.join(self.testdir, 'bin'))
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = (os.path.join(self.testdir, 'bin') +
+                              os.pathsep + os.environ['PATH'])
+        os.environ['FAKESLURM_STATE'] = os.path.join(self.testdir,
+                                                     'fakeslurm.sqlite')
+        self.scheduler = SlurmScheduler(self.config)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.testdir)
+        queue_snapshot = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                      'queue.snapshot')
+        if os.path.exists(queue_snapshot):
+            os.remove(queue_snapshot)
+
+    def test_queue_and_cancel(self):
+        """Test that queued array tasks are listed and can be cancelled."""
+        os.environ['FAKESLURM_WAIT'] = '3600'
+        records = self.scheduler.submit_jobs([1, 2, 3], 'uscratch')
+        jobids = [job.jobid for job in records]
+        queue = self.scheduler.query_queue()
+        self.assertEqual([job.jobid for job in queue], jobids)
+        self.assertEqual(set(job.state for job in queue), set(['PENDING']))
+        self.assertEqual(fakeslurm.main('scancel', [jobids[1]]), 0)
+        self.assertEqual(len(self.scheduler.query_queue()), 2)
+        completions = self.scheduler.get_job_completions(jobids)
+        self.assertEqual(completions.keys(), [jobids[1]])
+        self.assertEqual(completions[jobids[1]].state, 'CANCELLED')
+
+    def test_submit_and_harvest(self):
+        """Test that finished jobs are harvested from sacct and logs."""
+        os.environ['FAKESLURM_FAILURE_RATE'] = '0'
+        submit_and_stamp_jobs([1, 2, 3], 'uscratch', self.scheduler,
+                              self.config)
+        single = self.scheduler.submit_job(4, 'uscratch')
+        self.assertEqual(single.logfile,
+                         'uscratch.slurm.o{0}.log'.format(single.jobid))
+        perform_test_harvesting('uscratch', self.config)
+        records = load_records('uscratch', self.config)
+        self.assertEqual(len(records), 3)
+        for job in records:
+            self.assertTrue(job.completed)
+            self.assertTrue(job.is_success())
+            self.assertTrue(job.node.startswith('fake'))
+            self.assertGreater(job.max_rss, 0)
+
+    def test_timeout_injection(self):
+        """Test that an injected timeout is recorded as jobid 1."""
+        os.environ['FAKESLURM_TIMEOUT_RATE'] = '1'
+        record = self.scheduler.submit_job(1, 'uscratch')
+        self.assertEqual(record.jobid, 1)
+        self.assertTrue(record.is_retry())
+
+    def test_unknown_queue(self):
+        """Test that nothing is submitted if squeue fails."""
+        os.environ['FAKESLURM_TIMEOUT_RATE'] = '1'
+        perform_test_submission(3, 'uscratch', self.config)
+        self.assertFalse(os.path.exists(os.path.join(self.testdir,
+                                                     'counter')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,17 +6,35 @@ import unittest
 import time
 import re
 
-from autocms.core import load_configuration
+from autocms.core import (
+    append_stamps,
+    find_log_file,
+    iter_log_lines,
+    load_configuration,
+    load_records,
+    stamp_journal_dir,
+    stamp_segment_path,
+    summary_path
+)
 from autocms.harvest import (
     list_log_files,
-    purge_old_log_files,
+    manage_log_files,
     append_new_stamps,
+    list_stamp_segments,
     purge_old_stamps,
     add_untracked_jobs,
     purge_old_jobs,
-    parse_completed_job_logs
+    parse_completed_job_logs,
+    load_harvest_checkpoint,
+    perform_harvesting,
+    perform_test_harvesting,
+    quarantine_path,
+    TestHarvest
+)
+from autocms.scheduler import (
+    create_scheduler,
+    job_completion
 )
-from autocms.scheduler import create_scheduler
 from autocms.submit import submit_and_stamp
 
 class TestRecordAndLogMaintenance(unittest.TestCase):
@@ -61,50 +79,87 @@ class TestRecordAndLogMaintenance(unittest.TestCase):
         """Test removal of old log files."""
         time.sleep(2)
         log_lifetime = int(self.config['AUTOCMS_LOG_LIFETIME'])
-        purge_old_log_files('uscratch', self.config)
+        manage_log_files('uscratch', self.config)
+        logs = list_log_files('uscratch', self.config)
+        self.assertEqual(len(logs), log_lifetime)
+
+    def test_compress_log_files(self):
+        """Test compression of old log files and reading them back."""
+        time.sleep(2)
+        log_lifetime = int(self.config['AUTOCMS_LOG_LIFETIME'])
+        self.config['AUTOCMS_LOG_COMPRESS_AGE'] = '2'
+        manage_log_files('uscratch', self.config)
         logs = list_log_files('uscratch', self.config)
         self.assertEqual(len(logs), log_lifetime)
+        compressed = [log for log in logs if log.endswith('.log.gz')]
+        self.assertEqual(len(compressed), log_lifetime - 2)
+        logpath = os.path.join(self.testdir, 'test_3.log')
+        self.assertEqual(find_log_file(logpath), logpath + '.gz')
+        self.assertEqual(list(iter_log_lines(logpath + '.gz')),
+                         ['test log 3'])
+        mtime = int(time.time()) - 3600*24*3
+        self.assertTrue(abs(os.path.getmtime(logpath + '.gz') - mtime) < 10)
 
     def test_append_new_stamps(self):
-        """Test adding new stamps to combined file."""
-        stampfile = os.path.join(self.testdir, 'stest')
+        """Test moving legacy stamp files into the stamp journal."""
         stamps_to_be_removed = []
         for item in os.listdir(self.testdir):
             if re.match(r'stamp', item):
                 stamps_to_be_removed.append(os.path.join(self.testdir, item))
-        append_new_stamps(stampfile, 'uscratch', self.config)
+        append_new_stamps('uscratch', self.config)
         for stamp in stamps_to_be_removed:
             self.assertFalse(os.path.exists(stamp))
-        with open(stampfile) as shandle:
-            recorded_stamps = shandle.read().splitlines()
+        segments = list_stamp_segments('uscratch', self.config)
+        self.assertEqual(len(segments), 10)
+        recorded_stamps = []
+        for day, path in segments:
+            with open(path) as shandle:
+                recorded_stamps.extend(shandle.read().splitlines())
         self.assertEqual(len(recorded_stamps), 10)
 
     def test_purge_old_stamps(self):
-        """Test removal of old stamps."""
-        time.sleep(2)
+        """Test removal of old stamp journal segments."""
         log_lifetime = int(self.config['AUTOCMS_LOG_LIFETIME'])
-        stampfile = os.path.join(self.testdir, 'stest2')
-        append_new_stamps(stampfile, 'uscratch', self.config)
-        purge_old_stamps(stampfile, self.config)
-        with open(stampfile) as shandle:
-            recorded_stamps = shandle.read().splitlines()
-        self.assertEqual(len(recorded_stamps), log_lifetime)
+        append_new_stamps('uscratch', self.config)
+        removed = purge_old_stamps('uscratch', self.config)
+        self.assertEqual(len(removed), 10 - log_lifetime - 1)
+        segments = list_stamp_segments('uscratch', self.config)
+        self.assertEqual(len(segments), log_lifetime + 1)
+
+    def test_quarantine_malformed_stamps(self):
+        """Test that malformed stamps are moved aside without a rewrite."""
+        stampfile = os.path.join(self.testdir, 'stest5')
+        good_stamp = '300 30000 1000 0 test_good.log'
+        append_stamps(stampfile, [good_stamp, 'garbage', good_stamp])
+        size = os.path.getsize(stampfile)
+        records = []
+        offset = add_untracked_jobs(stampfile, records)
+        self.assertEqual(offset, size)
+        self.assertEqual(os.path.getsize(stampfile), size)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1].submit_status, -1)
+        with open(os.path.join(self.testdir, 'malformed.stamps')) as shandle:
+            self.assertEqual(shandle.read(), 'garbage\n')
 
     def test_add_untracked_jobs(self):
         """Test adding new jobs to a JobRecord list from stamps."""
-        stampfile = os.path.join(self.testdir, 'stest3')
-        append_new_stamps(stampfile, 'uscratch', self.config)
+        append_new_stamps('uscratch', self.config)
         records = []
-        add_untracked_jobs(stampfile, records)
+        offsets = dict()
+        for day, path in list_stamp_segments('uscratch', self.config):
+            offsets[path] = add_untracked_jobs(path, records)
         self.assertEqual(len(records), 10)
         # make a few more stamps and add them
-        with open(stampfile, 'a') as sfile:
-            mtime = int(time.time())
-            for count in range(0, 4):
-                stamp = (str(count + 200) + ' ' + str(count*100 + 5) +
-                         ' ' + str(mtime) + ' ' + '0 ' +
-                         'test_a_' + str(count) + '.log\n')
-                sfile.write(stamp)
+        mtime = int(time.time())
+        stampfile = stamp_segment_path('uscratch', self.config, mtime)
+        stamps = []
+        for count in range(0, 4):
+            stamps.append(str(count + 200) + ' ' + str(count*100 + 5) +
+                          ' ' + str(mtime) + ' ' + '0 ' +
+                          'test_a_' + str(count) + '.log')
+        append_stamps(stampfile, stamps)
+        add_untracked_jobs(stampfile, records, offset=offsets[stampfile])
+        self.assertEqual(len(records), 14)
         add_untracked_jobs(stampfile, records)
         self.assertEqual(len(records), 14)
 
@@ -112,10 +167,10 @@ class TestRecordAndLogMaintenance(unittest.TestCase):
         """Test purging old jobs from a JobRecords list."""
         time.sleep(2)
         log_lifetime = int(self.config['AUTOCMS_LOG_LIFETIME'])
-        stampfile = os.path.join(self.testdir, 'stest4')
-        append_new_stamps(stampfile, 'uscratch', self.config)
+        append_new_stamps('uscratch', self.config)
         records = []
-        add_untracked_jobs(stampfile, records)
+        for day, path in list_stamp_segments('uscratch', self.config):
+            add_untracked_jobs(path, records)
         purge_old_jobs(records, self.config)
         self.assertEqual(len(records), log_lifetime)
 
@@ -147,8 +202,7 @@ class TestRecordHarvesting(unittest.TestCase):
     def test_parse_completed_job_logs(self):
         """Full test of log file parsing starting from local submission."""
         time.sleep(2)
-        stampfile = os.path.join(self.testdir, 'stest')
-        append_new_stamps(stampfile, 'uscratch', self.config)
+        stampfile = stamp_segment_path('uscratch', self.config, time.time())
         records = []
         add_untracked_jobs(stampfile, records)
         parse_completed_job_logs(records, self.scheduler,
@@ -157,6 +211,115 @@ class TestRecordHarvesting(unittest.TestCase):
         for job in records:
             self.assertEqual(int(job.exit_code), 0)
             self.assertTrue(job.completed)
+            self.assertIn('num_proc', job.tokens)
+            self.assertEqual(job.tokens['banner'],
+                             'AutoCMS\t\x1b[1mtest\x1b[0m')
+            self.assertTrue(os.path.isfile(summary_path(
+                os.path.join(self.testdir, job.logfile))))
+
+    def test_scheduler_completion_info(self):
+        """Test that scheduler completion info is kept for lost logs."""
+        time.sleep(2)
+        stampfile = stamp_segment_path('uscratch', self.config, time.time())
+        records = []
+        add_untracked_jobs(stampfile, records)
+        os.remove(os.path.join(self.testdir, records[0].logfile))
+        completions = dict((job.jobid, job_completion(job.jobid))
+                           for job in records)
+        completions[records[0].jobid] = job_completion(
+            records[0].jobid, 'NODE_FAIL', 1400000000, 1400000060,
+            'vmp999', 1)
+        parse_completed_job_logs(records, self.scheduler, 'uscratch',
+                                 self.config, completions=completions)
+        lost = records[0]
+        self.assertEqual(lost.node, 'vmp999')
+        self.assertEqual(lost.end_time - lost.start_time, 60)
+        self.assertIn('NODE_FAIL', lost.error_string)
+        self.assertTrue(all(job.is_success() for job in records[1:]))
+
+    def test_parallel_parse_completed_job_logs(self):
+        """Test that a parse worker pool gives the same records."""
+        time.sleep(2)
+        stampfile = stamp_segment_path('uscratch', self.config, time.time())
+        serial_records = []
+        add_untracked_jobs(stampfile, serial_records)
+        parse_completed_job_logs(serial_records, self.scheduler,
+                                 'uscratch', self.config)
+        self.config['AUTOCMS_PARSE_WORKERS'] = '3'
+        records = []
+        add_untracked_jobs(stampfile, records)
+        parse_completed_job_logs(records, self.scheduler,
+                                 'uscratch', self.config)
+        self.assertEqual([job.__getstate__() for job in records],
+                         [job.__getstate__() for job in serial_records])
+
+    def test_incremental_harvest(self):
+        """Test that a harvest without changes leaves the records alone."""
+        time.sleep(2)
+        perform_test_harvesting('uscratch', self.config)
+        checkpoint = load_harvest_checkpoint('uscratch', self.config)
+        self.assertFalse(checkpoint['dirty'])
+        self.assertEqual(checkpoint['pending'], [])
+        for day, path in list_stamp_segments('uscratch', self.config):
+            self.assertEqual(checkpoint['stamp_offsets'][day],
+                             os.path.getsize(path))
+        snapshot = os.path.join(self.testdir, 'records.snapshot')
+        inode = os.stat(snapshot).st_ino
+        perform_test_harvesting('uscratch', self.config)
+        self.assertEqual(os.stat(snapshot).st_ino, inode)
+        submit_and_stamp(4, 'uscratch', self.scheduler, self.config)
+        time.sleep(2)
+        perform_test_harvesting('uscratch', self.config)
+        self.assertNotEqual(os.stat(snapshot).st_ino, inode)
+        records = load_records('uscratch', self.config)
+        self.assertEqual(len(records), 5)
+        self.assertTrue(all(job.completed for job in records))
+
+    def test_rerun_interrupted_harvest(self):
+        """Test that a rerun after a crash quarantines stamps only once."""
+        time.sleep(2)
+        stampfile = stamp_segment_path('uscratch', self.config, time.time())
+        append_stamps(stampfile, ['garbage'])
+        perform_test_harvesting('uscratch', self.config)
+        quarantine = quarantine_path(stamp_journal_dir('uscratch',
+                                                       self.config))
+        with open(quarantine) as handle:
+            quarantined = handle.read()
+        self.assertEqual(quarantined, 'garbage\n')
+        append_stamps(stampfile, ['garbage 2'])
+        # the harvest dies after reading the stamps
+        TestHarvest('uscratch', self.config)
+        self.assertTrue(load_harvest_checkpoint('uscratch',
+                                                self.config)['dirty'])
+        with open(quarantine) as handle:
+            quarantined = handle.read()
+        perform_test_harvesting('uscratch', self.config)
+        with open(quarantine) as handle:
+            self.assertEqual(handle.read(), quarantined)
+        records = load_records('uscratch', self.config)
+        self.assertEqual(sum(job.submit_status == -1 for job in records), 2)
+
+    def test_combined_harvest(self):
+        """Test harvesting several tests in one pass."""
+        testdir2 = os.path.join(self.config['AUTOCMS_BASEDIR'], 'uscratch2')
+        shutil.copytree(self.testdir, testdir2)
+        os.rename(os.path.join(testdir2, 'uscratch.local'),
+                  os.path.join(testdir2, 'uscratch2.local'))
+        shutil.rmtree(os.path.join(testdir2, 'stamps'))
+        try:
+            for count in range(0, 2):
+                submit_and_stamp(count, 'uscratch2', self.scheduler,
+                                 self.config)
+            time.sleep(2)
+            failed = perform_harvesting(['uscratch', 'missing', 'uscratch2'],
+                                        self.config)
+            self.assertEqual(failed, ['missing'])
+            for testname, num_jobs in (('uscratch', 4), ('uscratch2', 2)):
+                records = load_records(testname, self.config)
+                self.assertEqual(len(records), num_jobs)
+                self.assertTrue(all(job.completed for job in records))
+        finally:
+            shutil.rmtree(testdir2)
 
 
 if __name__ == '__main__':
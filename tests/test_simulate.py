@@ -0,0 +1,125 @@
+"""Test the AutoCMS simulation of operation from job history."""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import autocms.harvest
+from autocms.core import (
+    JobRecord,
+    load_configuration,
+    load_records
+)
+from autocms.simulate import (
+    JobHistory,
+    Simulation,
+    VirtualClock,
+    crontab_schedule
+)
+
+
+def make_history(num_jobs):
+    """Return a JobHistory of jobs waiting 5 and running 20 minutes."""
+    records = []
+    for count in range(num_jobs):
+        job = JobRecord(count, str(5000 + count), 1400000000 + 600*count,
+                        0 if count % 10 else 1, 'sim.log')
+        if job.submit_status == 0:
+            job.start_time = job.submit_time + 300
+            job.end_time = job.start_time + 1200
+            job.node = 'vmp{0}'.format(count % 3)
+            job.exit_code = 0 if count % 4 else 1
+            job.error_string = 'Simulated stage-out failure.'
+            job.completed = True
+        records.append(job)
+    return JobHistory(records)
+
+
+class TestSimulation(unittest.TestCase):
+    """Simulate a test with the real submit, harvest and stats stages."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_TEST_NAMES'] = 'simtest'
+        self.config['AUTOCMS_TEST_SUBWAITS'] = '10'
+        self.config['AUTOCMS_TEST_SUBCOUNTS'] = '2'
+        self.config['AUTOCMS_STAT_INTERVAL'] = '6'
+        self.simdir = tempfile.mkdtemp()
+        # start at a multiple of six hours to know the number of stats
+        self.start = int(time.time()) // (6*3600) * (6*3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.simdir)
+
+    def test_history(self):
+        """Test that only completed jobs are sampled."""
+        history = make_history(100)
+        self.assertEqual(len(history.samples), 90)
+        self.assertAlmostEqual(history.submit_failure_rate, 0.1)
+
+    def test_crontab_schedule(self):
+        """Test that the schedule matches the printed crontab."""
+        self.assertEqual(crontab_schedule(self.config),
+                         [('submit', 'simtest', 600, 0),
+                          ('harvest', 'simtest', 600, 0),
+                          ('report', 'simtest', 600, 300),
+                          ('stats', 'simtest', 6*3600, 57*60)])
+        self.config['AUTOCMS_COMBINED_HARVEST'] = '1'
+        self.config['AUTOCMS_TEST_SUBWAITS'] = '120'
+        self.assertEqual(crontab_schedule(self.config)[:2],
+                         [('harvest', None, 600, 0),
+                          ('submit', 'simtest', 7200, 0)])
+
+    def test_virtual_clock(self):
+        """Test that the clock reports the simulated time."""
+        clock = VirtualClock(1400000000)
+        clock.sleep(60)
+        self.assertEqual(clock.time(), 1400000060)
+        self.assertEqual(clock.ctime(), time.ctime(1400000060))
+        self.assertEqual(clock.strftime('%c'),
+                         time.strftime('%c', time.localtime(1400000060)))
+
+    def test_simulate_hours(self):
+        """Test six simulated hours of submitting and harvesting."""
+        simulation = Simulation({'simtest': make_history(100)}, self.config,
+                                self.simdir, start=self.start, seed=1,
+                                stages=['submit', 'harvest', 'stats'])
+        simulation.setup(self.config['AUTOCMS_BASEDIR'])
+        simulation.run(6*3600)
+        self.assertIs(autocms.harvest.time, time)
+        self.assertEqual(simulation.stages['submit'].calls, 36)
+        self.assertEqual(simulation.stages['harvest'].calls, 36)
+        self.assertEqual(simulation.stages['stats'].calls, 1)
+        self.assertEqual(simulation.stages['report'].calls, 0)
+        self.assertEqual(simulation.cluster.submitted, 72)
+        self.assertEqual(simulation.num_records['simtest'], 72)
+        # only jobs submitted in the last 25 minutes may be incomplete
+        records = load_records('simtest', simulation.config)
+        self.assertGreaterEqual(sum(job.completed for job in records), 66)
+        self.assertEqual(set(job.node for job in records
+                             if job.completed and job.submit_status == 0),
+                         set(['vmp1', 'vmp2', 'vmp0']))
+        with open(os.path.join(self.simdir, 'simtest', 'counter')) as handle:
+            self.assertEqual(handle.read(), '73')
+        statfile = os.path.join(self.simdir, 'simtest', 'statistics.csv')
+        with open(statfile) as handle:
+            self.assertEqual(len(handle.readlines()), 2)
+        self.assertIn('harvest', simulation.report())
+
+    def test_simulate_reports(self):
+        """Test that the report is written in the simulation webdir."""
+        simulation = Simulation({'simtest': make_history(100)}, self.config,
+                                self.simdir, start=self.start, seed=1,
+                                stages=['submit', 'harvest', 'report'])
+        simulation.setup(self.config['AUTOCMS_BASEDIR'])
+        simulation.run(3600)
+        self.assertEqual(simulation.stages['report'].calls, 6)
+        self.assertTrue(os.path.exists(os.path.join(self.simdir, 'web',
+                                                    'simtest',
+                                                    'index.html')))
+
+
+if __name__ == '__main__':
+    unittest.main()
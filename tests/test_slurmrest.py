@@ -0,0 +1,254 @@
+"""Test the slurmrestd scheduler against a stand-in HTTP server."""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+from autocms.core import load_configuration
+from autocms.command import (
+    CommandFailed,
+    load_command_metrics,
+    metrics_path
+)
+from autocms.scheduler import create_scheduler
+from autocms.slurmrest import close_connection_pools
+
+
+class FakeSlurmRestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer slurmrestd requests from the state of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return 'client'
+
+    def reply(self, status, result):
+        body = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        if self.headers.get('X-SLURM-USER-TOKEN') != 'test-jwt':
+            self.reply(401, {'errors': [{'error': 'Authentication failure'}]})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        path = self.path.split('?')[0]
+        if path == '/slurm/v0.0.39/jobs':
+            self.reply(200, {'jobs': self.server.queue, 'errors': []})
+        elif path == '/slurmdb/v0.0.39/jobs':
+            self.server.queries.append(self.path)
+            self.reply(200, {'jobs': self.server.accounting, 'errors': []})
+        else:
+            self.reply(404, {'errors': [{'error': 'Unknown path'}]})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length))
+        if not self.authorized():
+            return
+        job = payload['job']
+        self.server.submitted.append(payload)
+        jobid = 2000 + len(self.server.submitted)
+        array = 'array' in job
+        self.server.queue.append({
+            'job_id': jobid, 'job_state': ['PENDING'],
+            'user_name': self.server.user, 'account': job['account'],
+            'submit_time': {'set': True, 'number': 1500000000},
+            'start_time': {'set': True, 'number': 0},
+            'array_job_id': {'set': True, 'number': jobid if array else 0},
+            'array_task_id': {'set': False, 'number': 0},
+            'array_task_string': job.get('array', ''), 'nodes': ''})
+        self.reply(200, {'job_id': jobid, 'step_id': 'batch', 'errors': []})
+
+
+class FakeSlurmRest(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Stand-in slurmrestd on a TCP port."""
+
+    daemon_threads = True
+
+    def __init__(self, user):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeSlurmRestHandler)
+        self.user = user
+        self.connections = 0
+        self.submitted = []
+        self.queue = []
+        self.accounting = []
+        self.queries = []
+
+
+class FakeUnixSlurmRest(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    """Stand-in slurmrestd on a unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, path, user):
+        SocketServer.UnixStreamServer.__init__(self, path,
+                                               FakeSlurmRestHandler)
+        self.user = user
+        self.connections = 0
+        self.submitted = []
+        self.queue = []
+        self.accounting = []
+        self.queries = []
+
+
+class TestSlurmRestScheduler(unittest.TestCase):
+    """Submit, list, and harvest jobs through slurmrestd requests."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_SCHEDULER'] = 'slurmrest'
+        self.config['AUTOCMS_SLURMREST_TOKEN'] = 'test-jwt'
+        self.config['AUTOCMS_SLURM_ARRAY'] = '1'
+        self.testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        os.makedirs(self.testdir)
+        with open(os.path.join(self.testdir, 'uscratch.slurm'), 'w') as handle:
+            handle.write('#!/bin/bash\necho test\n')
+        self.tmpdir = tempfile.mkdtemp()
+        self.servers = []
+
+    def tearDown(self):
+        close_connection_pools()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.testdir)
+        shutil.rmtree(self.tmpdir)
+        if os.path.exists(metrics_path(self.config)):
+            os.remove(metrics_path(self.config))
+
+    def start(self, server):
+        """Serve requests in a thread until the test ends."""
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return server
+
+    def tcp_server(self):
+        server = self.start(FakeSlurmRest(self.config['AUTOCMS_UNAME']))
+        self.config['AUTOCMS_SLURMREST_URL'] = (
+            'http://127.0.0.1:{0}'.format(server.server_address[1]))
+        return server
+
+    def test_submit_and_queue(self):
+        """Test array and single submissions and the queue listing."""
+        server = self.tcp_server()
+        scheduler = create_scheduler('slurmrest', self.config)
+        records = scheduler.submit_jobs([1, 2, 3], 'uscratch')
+        self.assertEqual([job.jobid for job in records],
+                         ['2001_0', '2001_1', '2001_2'])
+        self.assertEqual(records[2].logfile, 'uscratch.slurm.o2001_2.log')
+        single = scheduler.submit_job(4, 'uscratch')
+        self.assertEqual(single.jobid, '2002')
+        array_job = server.submitted[0]['job']
+        self.assertEqual(array_job['array'], '0-2')
+        self.assertIn('AUTOCMS_COUNTER_BASE=1', array_job['environment'])
+        self.assertIn('AUTOCMS_COUNTER=4',
+                      server.submitted[1]['job']['environment'])
+        self.assertEqual(server.submitted[1]['script'],
+                         '#!/bin/bash\necho test\n')
+        server.queue.append({
+            'job_id': 1999, 'job_state': 'RUNNING',
+            'user_name': self.config['AUTOCMS_UNAME'],
+            'account': self.config['AUTOCMS_GNAME'],
+            'submit_time': 1500000000, 'start_time': 1500000100,
+            'array_job_id': 1990, 'array_task_id': 7, 'nodes': 'vmp101'})
+        queue = scheduler.query_queue()
+        self.assertEqual([job.jobid for job in queue],
+                         ['2001_0', '2001_1', '2001_2', '2002', '1990_7'])
+        self.assertEqual(queue[-1].node, 'vmp101')
+        self.assertEqual(queue[-1].start_time, 1500000100)
+        # every request went over the same kept-alive connection
+        self.assertEqual(server.connections, 1)
+        metrics = load_command_metrics(self.config)
+        self.assertEqual(metrics['slurmrest.submit']['calls'], 2)
+        self.assertEqual(metrics['slurmrest.jobs']['calls'], 1)
+
+    def test_completions(self):
+        """Test completions and resource usage from the accounting."""
+        server = self.tcp_server()
+        server.accounting = [
+            {'job_id': 2010, 'array': {'job_id': 2005, 'task_id': 3},
+             'state': {'current': ['COMPLETED']}, 'nodes': 'vmp102',
+             'exit_code': {'status': 'SUCCESS', 'return_code': 0},
+             'time': {'start': 1500000100, 'end': 1500000400,
+                      'elapsed': 300,
+                      'total': {'seconds': 250, 'microseconds': 500000}},
+             'steps': [{'tres': {
+                 'requested': {'max': [{'type': 'mem', 'count': 2048}],
+                               'total': [{'type': 'fs', 'count': 100}]},
+                 'consumed': {'total': [{'type': 'fs', 'count': 50}]}}}]},
+            {'job_id': 2011, 'array': {'job_id': 0, 'task_id': None},
+             'state': {'current': 'CANCELLED'}, 'nodes': 'None assigned',
+             'exit_code': {'status': 'SIGNALED', 'return_code': 0,
+                           'signal': {'signal_id': 9}},
+             'time': {'start': 0, 'end': 1500000500, 'elapsed': 0}},
+            {'job_id': 2012, 'state': {'current': 'RUNNING'},
+             'time': {'start': 1500000100, 'end': 0}}]
+        scheduler = create_scheduler('slurmrest', self.config)
+        completions = scheduler.get_job_completions(
+            ['2005_3', '2011', '2012', '2013'], since=1500000000)
+        self.assertEqual(sorted(completions), ['2005_3', '2011'])
+        task = completions['2005_3']
+        self.assertEqual((task.state, task.node, task.exit_code),
+                         ('COMPLETED', 'vmp102', 0))
+        self.assertEqual((task.max_rss, task.disk_read, task.disk_write),
+                         (2048, 100, 50))
+        self.assertAlmostEqual(task.total_cpu, 250.5)
+        cancelled = completions['2011']
+        self.assertEqual((cancelled.node, cancelled.start_time,
+                          cancelled.exit_code), (None, None, 137))
+        # the window reaches back to jobs recorded late by slurmdbd
+        self.assertIn('start_time=1499999700', server.queries[0])
+
+    def test_bad_token(self):
+        """Test that rejected requests fail submissions and queries."""
+        self.tcp_server()
+        self.config['AUTOCMS_SLURMREST_TOKEN'] = 'expired'
+        scheduler = create_scheduler('slurmrest', self.config)
+        record = scheduler.submit_job(1, 'uscratch')
+        self.assertEqual(record.jobid, 2)
+        with open(os.path.join(self.testdir, record.logfile)) as log:
+            self.assertIn('Authentication failure', log.read())
+        self.assertRaises(CommandFailed, scheduler.query_queue)
+        self.assertEqual(scheduler.get_job_completions(['2001']), {})
+
+    def test_unix_socket(self):
+        """Test requests over a unix domain socket."""
+        path = os.path.join(self.tmpdir, 'slurmrestd.socket')
+        server = self.start(FakeUnixSlurmRest(path,
+                                              self.config['AUTOCMS_UNAME']))
+        self.config['AUTOCMS_SLURMREST_URL'] = 'unix://' + path
+        scheduler = create_scheduler('slurmrest', self.config)
+        record = scheduler.submit_job(1, 'uscratch')
+        self.assertEqual(record.jobid, '2001')
+        self.assertEqual([job.jobid for job in scheduler.query_queue()],
+                         ['2001'])
+        self.assertEqual(server.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""Test the columnar JobRecord snapshot."""
+
+import os
+import shutil
+import time
+import unittest
+
+import numpy as np
+
+from autocms.core import (
+    JobRecord,
+    load_configuration
+)
+from autocms.snapshot import (
+    write_record_snapshot,
+    load_record_snapshot
+)
+from autocms.stats import (
+    append_stats_row,
+    harvest_default_stats,
+    harvest_snapshot_stats
+)
+from autocms.web import AutoCMSWebpage
+
+
+class TestRecordSnapshot(unittest.TestCase):
+    """Test writing, mapping, and aggregating a record snapshot."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        os.makedirs(self.testdir)
+        now = int(time.time())
+        self.records = []
+        for count in range(0, 10):
+            job = JobRecord(count, str(1000 + count), now - 600*count, 0,
+                            'test_' + str(count) + '.log')
+            job.completed = count < 8
+            job.start_time = now - 600*count + 60
+            job.end_time = job.start_time + 100*count
+            job.node = 'vmp' + str(count % 3)
+            if count % 4 == 0:
+                job.exit_code = 0
+                job.error_string = ''
+            else:
+                job.error_string = 'ERROR ' + str(count % 2)
+            if count % 2 == 0:
+                job.max_rss = (count + 1) << 20
+                job.total_cpu = 50.0*count
+                job.elapsed = 100.0*count
+            self.records.append(job)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_snapshot_columns(self):
+        """Check that snapshot columns match the records."""
+        write_record_snapshot(self.records, 'uscratch', self.config)
+        snapshot = load_record_snapshot('uscratch', self.config)
+        self.assertEqual(len(snapshot), 10)
+        self.assertEqual(list(snapshot.seq), range(0, 10))
+        self.assertEqual(list(snapshot.completed),
+                         [job.completed for job in self.records])
+        self.assertEqual([snapshot.node_table[code]
+                          for code in snapshot.node_codes],
+                         [job.node for job in self.records])
+        self.assertEqual(snapshot.max_rss[2], 3 << 20)
+        self.assertTrue(np.isnan(snapshot.max_rss[1]))
+
+    def test_snapshot_count_by(self):
+        """Check counting a string column over a mask."""
+        write_record_snapshot(self.records, 'uscratch', self.config)
+        snapshot = load_record_snapshot('uscratch', self.config)
+        mask = snapshot.completed & ~snapshot.success()
+        self.assertEqual(snapshot.count_by('error_string', mask),
+                         {'ERROR 1': 4, 'ERROR 0': 2})
+
+    def test_snapshot_stats(self):
+        """Check that snapshot statistics match the record statistics."""
+        write_record_snapshot(self.records, 'uscratch', self.config)
+        snapshot = load_record_snapshot('uscratch', self.config)
+        row = harvest_default_stats(self.records, self.config)
+        snapshot_row = harvest_snapshot_stats(snapshot, self.config)
+        self.assertEqual(row.split(',')[1:], snapshot_row.split(',')[1:])
+        # mean and max peak memory of jobs 0, 2, 4, 6 in MB
+        self.assertEqual(row.split(',')[6:8], ['4.0', '7.0'])
+        self.assertEqual(row.split(',')[-2:], ['', ''])
+
+    def test_stats_columns_extended(self):
+        """Check that an older statistics file gains the new columns."""
+        statfile = os.path.join(self.testdir, 'statistics.csv')
+        with open(statfile, 'w') as handle:
+            handle.write('time,success,failure\n1,2,3\n')
+        append_stats_row(['time', 'success', 'failure', 'mean_max_rss'],
+                         '4,5,6,7.0', 'uscratch', self.config)
+        with open(statfile) as handle:
+            self.assertEqual(handle.read(), 'time,success,failure,'
+                             'mean_max_rss\n1,2,3,\n4,5,6,7.0\n')
+
+    def test_snapshot_versions(self):
+        """Check that a new snapshot version replaces the symlink."""
+        snapdir = os.path.join(self.testdir, 'records.snapshot')
+        os.makedirs(snapdir)
+        for count in range(1, 4):
+            write_record_snapshot(self.records[:count], 'uscratch',
+                                  self.config)
+            self.assertTrue(os.path.islink(snapdir))
+            snapshot = load_record_snapshot('uscratch', self.config)
+            self.assertEqual(len(snapshot), count)
+        # the current and the previous version are kept
+        versions = [name for name in os.listdir(self.testdir)
+                    if name.startswith('records.snapshot.')]
+        self.assertEqual(len(versions), 2)
+
+    def test_webpage_counts(self):
+        """Check that only pages of all records count from the snapshot."""
+        write_record_snapshot(self.records, 'uscratch', self.config)
+        page = AutoCMSWebpage(self.records, 'uscratch', self.config,
+                              all_records=True)
+        self.assertIsNotNone(page.snapshot)
+        page.add_failures_by_node(25, 24)
+        self.assertIn('<td>2</td><td>vmp1</td>', page.page)
+        selected = [job for job in self.records if job.node == 'vmp0']
+        page = AutoCMSWebpage(selected, 'uscratch', self.config)
+        self.assertIsNone(page.snapshot)
+        page.add_failures_by_node(25, 24)
+        page.add_job_failure_rates(30, [24], 90.0)
+        self.assertNotIn('vmp1', page.page)
+        self.assertIn('<td>2</td><td>vmp0</td>', page.page)
+        self.assertIn('Successful jobs in the last 24 hours: 1', page.page)
+
+    def test_empty_snapshot(self):
+        """Check that a snapshot of no records can be mapped."""
+        self.assertIsNone(load_record_snapshot('uscratch', self.config))
+        write_record_snapshot([], 'uscratch', self.config)
+        snapshot = load_record_snapshot('uscratch', self.config)
+        self.assertEqual(len(snapshot), 0)
+        self.assertEqual(snapshot.count_by('node', snapshot.completed), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,11 +7,36 @@ import time
 
 from autocms.core import (
     load_configuration,
+    stamp_segment_path,
     JobRecord
 )
-from autocms.scheduler import create_scheduler
+from autocms.jobqueue import (
+    QueueJob,
+    QueueSnapshot,
+    get_queue_snapshot,
+    invalidate_queue_snapshot,
+    load_queue_snapshot,
+    purge_queue_latency,
+    queue_latency_path,
+    queue_snapshot_path
+)
+from autocms import localexec
+from autocms.scheduler import (
+    LocalScheduler,
+    Scheduler,
+    SlurmScheduler,
+    create_scheduler,
+    sacct_bytes,
+    sacct_duration,
+    sacct_exit_code,
+    sacct_time
+)
 from autocms.submit import (
+    SubmitHealth,
+    perform_test_submission,
     submit_and_stamp,
+    submit_and_stamp_jobs,
+    submit_concurrently,
     get_job_counter,
     set_job_counter
 )
@@ -54,14 +79,18 @@ class TestSubmission(unittest.TestCase):
 
 
     def test_submit_and_stamp(self):
-        """Test that proper stamp file is created on submission."""
+        """Test that a proper stamp is appended to the journal on submission."""
         stamp_path = submit_and_stamp(2,
                                       'uscratch',
                                       self.scheduler,
                                       self.config)
         self.assertTrue(os.path.isfile(stamp_path))
+        self.assertEqual(submit_and_stamp(3, 'uscratch', self.scheduler,
+                                          self.config), stamp_path)
         with open(stamp_path) as stampfile:
-            stamp = stampfile.read()
+            stamps = stampfile.read().splitlines()
+        self.assertEqual(len(stamps), 2)
+        stamp = stamps[0]
         record = JobRecord.create_from_stamp(stamp)
         self.assertEqual(int(record.seq), 2)
         self.assertEqual(record.logfile,
@@ -75,3 +104,345 @@ class TestSubmission(unittest.TestCase):
         set_job_counter(42, 'uscratch', self.config)
         count = get_job_counter('uscratch', self.config)
         self.assertEqual(count, 42)
+
+
+class TestSlurmAccounting(unittest.TestCase):
+    """Test interpretation of slurm accounting output."""
+
+    def test_parse_sacct_output(self):
+        """Test that only finished jobs are returned with their details."""
+        output = ('1001|COMPLETED|2016-05-01T10:00:00|2016-05-01T10:05:00|'
+                  'vmp101|0:0|00:05:00|00:02:30|||\n'
+                  '1001.batch|COMPLETED|2016-05-01T10:00:00|'
+                  '2016-05-01T10:05:00|vmp101|0:0|00:05:00|00:02:00|'
+                  '1024K|2M|0\n'
+                  '1001.0|COMPLETED|2016-05-01T10:00:00|'
+                  '2016-05-01T10:05:00|vmp101|0:0|00:04:00|00:00:30|'
+                  '3M|1M|512K\n'
+                  '1002|RUNNING|2016-05-01T10:00:00|Unknown|vmp102|0:0|'
+                  '00:01:00|00:00:00|||\n'
+                  '1003|CANCELLED by 42|2016-05-01T10:00:00|'
+                  '2016-05-01T10:01:00|vmp103|0:15|00:01:00|00:00:00|||\n'
+                  '1004|FAILED|Unknown|Unknown|None assigned|1:0|'
+                  '00:00:00|00:00:00|||\n'
+                  '1005_3|COMPLETED|2016-05-01T10:00:00|'
+                  '2016-05-01T10:02:00|vmp104|0:0|00:02:00|00:01:00|||\n'
+                  '1005_3.batch|COMPLETED|2016-05-01T10:00:00|'
+                  '2016-05-01T10:02:00|vmp104|0:0|00:02:00|00:01:00|'
+                  '2G|0|0\n'
+                  '1005_[4-9]|PENDING|Unknown|Unknown|None assigned|0:0|'
+                  '00:00:00|00:00:00|||\n')
+        completions = SlurmScheduler.parse_sacct_output(output)
+        self.assertEqual(sorted(completions),
+                         ['1001', '1003', '1004', '1005_3'])
+        self.assertEqual(completions['1001'].end_time -
+                         completions['1001'].start_time, 300)
+        self.assertEqual(completions['1001'].node, 'vmp101')
+        self.assertEqual(completions['1001'].exit_code, 0)
+        self.assertEqual(completions['1003'].state, 'CANCELLED')
+        self.assertEqual(completions['1003'].exit_code, 143)
+        self.assertIsNone(completions['1004'].start_time)
+        self.assertIsNone(completions['1004'].node)
+        self.assertEqual(completions['1004'].exit_code, 1)
+        self.assertEqual(completions['1001'].elapsed, 300)
+        self.assertEqual(completions['1001'].total_cpu, 150)
+        self.assertEqual(completions['1001'].max_rss, 3 << 20)
+        self.assertEqual(completions['1001'].disk_read, 3 << 20)
+        self.assertEqual(completions['1001'].disk_write, 512 << 10)
+        self.assertIsNone(completions['1003'].max_rss)
+        self.assertEqual(completions['1005_3'].max_rss, 2 << 30)
+
+    def test_sacct_values(self):
+        """Test conversion of sacct time and exit code values."""
+        self.assertIsNone(sacct_time('None'))
+        self.assertEqual(sacct_time('2016-05-01T10:00:01') -
+                         sacct_time('2016-05-01T10:00:00'), 1)
+        self.assertEqual(sacct_exit_code('2:0'), 2)
+        self.assertIsNone(sacct_exit_code(''))
+        self.assertEqual(sacct_duration('1-02:03:04'), 93784)
+        self.assertEqual(sacct_duration('01:02.500'), 62.5)
+        self.assertIsNone(sacct_duration(''))
+        self.assertEqual(sacct_bytes('1.5K'), 1536)
+        self.assertIsNone(sacct_bytes(''))
+
+
+class TimeoutScheduler(Scheduler):
+    """Scheduler whose first submissions time out."""
+
+    def __init__(self, config, timeouts):
+        Scheduler.__init__(self, config)
+        self.timeouts = timeouts
+        self.calls = 0
+
+    def submit_job(self, counter, testname):
+        self.calls += 1
+        jobid = 1 if self.calls <= self.timeouts else str(1000 + self.calls)
+        return JobRecord(counter, jobid, int(time.time()),
+                         1 if jobid == 1 else 0, 'a.log')
+
+
+class TestSubmitHealth(unittest.TestCase):
+    """Test submission backoff and the circuit breaker."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_SUBMIT_BACKOFF'] = '0'
+        self.testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        os.makedirs(self.testdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+        for path in (SubmitHealth.path(self.config),
+                     queue_snapshot_path(self.config)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_backoff_delay(self):
+        """Test exponential growth, cap, and jitter of the delay."""
+        self.config['AUTOCMS_SUBMIT_BACKOFF'] = '10'
+        health = SubmitHealth(self.config)
+        self.assertEqual(health.backoff_delay(1, lambda: 0), 10)
+        self.assertEqual(health.backoff_delay(3, lambda: 0), 40)
+        self.assertEqual(health.backoff_delay(3, lambda: 1), 20)
+        self.assertEqual(health.backoff_delay(20, lambda: 0), 600)
+
+    def test_circuit_breaker(self):
+        """Test that failures open and a healthy submission closes it."""
+        self.config['AUTOCMS_SUBMIT_BACKOFF'] = '60'
+        health = SubmitHealth(self.config)
+        for count in range(0, 3):
+            self.assertFalse(health.circuit_open())
+            self.assertFalse(health.record(1.0, True))
+        self.assertTrue(health.circuit_open())
+        self.assertFalse(health.circuit_open(health.retry_after))
+        health.save()
+        saved = SubmitHealth.load(self.config)
+        self.assertEqual(saved.failures, 3)
+        self.assertTrue(saved.circuit_open())
+        self.assertTrue(health.record(1.0, False))
+        self.assertFalse(health.circuit_open())
+
+    def test_shared_health(self):
+        """Test that submitters of several tests count failures together."""
+        first = SubmitHealth.load(self.config)
+        second = SubmitHealth.load(self.config)
+        first.record(1.0, True)
+        second.record(1.0, True)
+        first.record(1.0, True)
+        self.assertEqual(first.failures, 3)
+        self.assertEqual(SubmitHealth.load(self.config).failures, 3)
+        second.record(1.0, False)
+        self.assertEqual(SubmitHealth.load(self.config).failures, 0)
+
+    def test_retry_timeouts(self):
+        """Test that timed out submissions are stamped and retried."""
+        scheduler = TimeoutScheduler(self.config, 2)
+        stamp_path = submit_and_stamp(7, 'uscratch', scheduler, self.config)
+        self.assertEqual(scheduler.calls, 3)
+        with open(stamp_path) as handle:
+            jobids = [line.split()[1] for line in handle]
+        self.assertEqual(jobids, ['1', '1', '1003'])
+
+    def test_open_circuit_skips_submission(self):
+        """Test that no job is submitted while the circuit is open."""
+        health = SubmitHealth(self.config)
+        health.failures = 5
+        health.retry_after = time.time() + 600
+        health.save()
+        perform_test_submission(3, 'uscratch', self.config)
+        self.assertEqual(get_job_counter('uscratch', self.config), 1)
+        self.assertEqual(os.listdir(self.testdir), [])
+
+    def test_concurrent_submission(self):
+        """Test that concurrent submission stamps every job."""
+        self.config['AUTOCMS_SUBMIT_CONCURRENCY'] = '3'
+        scheduler = TimeoutScheduler(self.config, 0)
+        health = SubmitHealth(self.config)
+        submit_concurrently([1, 2, 3, 4], 'uscratch', scheduler,
+                            self.config, health)
+        self.assertEqual(scheduler.calls, 4)
+        stamp_path = stamp_segment_path('uscratch', self.config,
+                                        int(time.time()))
+        with open(stamp_path) as handle:
+            seqs = sorted(int(line.split()[0]) for line in handle)
+        self.assertEqual(seqs, [1, 2, 3, 4])
+        self.assertEqual(health.failures, 0)
+
+
+class TestSlurmArraySubmission(unittest.TestCase):
+    """Test job array submission against a stand-in sbatch command."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        self.config['AUTOCMS_SLURM_ARRAY'] = '1'
+        self.testdir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        bindir = os.path.join(self.testdir, 'bin')
+        os.makedirs(bindir)
+        sbatch = os.path.join(bindir, 'sbatch')
+        with open(sbatch, 'w') as handle:
+            handle.write('#!/bin/bash\n'
+                         'echo "$@ $AUTOCMS_COUNTER_BASE" >> sbatch.args\n'
+                         'echo "Submitted batch job 4242"\n')
+        os.chmod(sbatch, 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bindir + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.testdir)
+
+    def test_array_submission(self):
+        """Test that one sbatch call submits and stamps all jobs."""
+        scheduler = SlurmScheduler(self.config)
+        records = submit_and_stamp_jobs([5, 6, 7], 'uscratch', scheduler,
+                                        self.config)
+        self.assertEqual([job.jobid for job in records],
+                         ['4242_0', '4242_1', '4242_2'])
+        self.assertEqual(records[2].logfile,
+                         'uscratch.slurm.o4242_2.log')
+        with open(os.path.join(self.testdir, 'sbatch.args')) as handle:
+            calls = handle.read().splitlines()
+        self.assertEqual(len(calls), 1)
+        self.assertIn('--array=0-2', calls[0])
+        self.assertTrue(calls[0].endswith('uscratch.slurm 5'))
+        stamp_path = stamp_segment_path('uscratch', self.config,
+                                        records[0].submit_time)
+        with open(stamp_path) as handle:
+            stamps = handle.read().splitlines()
+        self.assertEqual(stamps, [job.stamp() for job in records])
+        self.assertEqual(SlurmScheduler.array_spec([0, 2, 3]), '0,2,3')
+
+    def test_arrays_off_by_default(self):
+        """Test that jobs are submitted one by one unless arrays are set."""
+        del self.config['AUTOCMS_SLURM_ARRAY']
+        scheduler = SlurmScheduler(self.config)
+        self.assertFalse(scheduler.submits_in_batches())
+        records = scheduler.submit_jobs([5, 6], 'uscratch')
+        self.assertEqual([job.jobid for job in records], ['4242', '4242'])
+        with open(os.path.join(self.testdir, 'sbatch.args')) as handle:
+            self.assertEqual(len(handle.read().splitlines()), 2)
+
+
+class TestLocalSupervisor(unittest.TestCase):
+    """Test the local job supervisor in-process."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+        # use a private base directory so no other supervisor interferes
+        self.basedir = os.path.join(self.config['AUTOCMS_BASEDIR'],
+                                    'uscratch')
+        self.config['AUTOCMS_BASEDIR'] = self.basedir
+        self.config['AUTOCMS_MAXENQUEUE'] = '2'
+        os.makedirs(os.path.join(self.basedir, 'sleeper'))
+        with open(os.path.join(self.basedir, 'sleeper',
+                               'sleeper.local'), 'w') as handle:
+            handle.write('sleep 1\nexit $AUTOCMS_COUNTER\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_supervisor(self):
+        """Test the concurrency cap and the recorded job status."""
+        jobids = [localexec.spool_job(count, 'sleeper', self.config)['jobid']
+                  for count in range(3, 6)]
+        supervisor = localexec.Supervisor(self.config)
+        supervisor.scan(time.time())
+        states = [localexec.read_job_status(jobid, self.config)['state']
+                  for jobid in jobids]
+        self.assertEqual(states, ['RUNNING', 'RUNNING', 'PENDING'])
+        scheduler = LocalScheduler(self.config)
+        self.assertEqual(len(scheduler.query_queue()), 3)
+        while supervisor.scan(time.time()) or supervisor.children:
+            time.sleep(0.1)
+            supervisor.reap()
+        # a job of the supervisor without status file stays pending,
+        # an older process id is completed
+        lost = str(int(jobids[2]) + 1)
+        completions = scheduler.get_job_completions(jobids + ['999', lost])
+        self.assertEqual(sorted(completions), sorted(jobids + ['999']))
+        self.assertEqual(completions[jobids[2]].exit_code, 5)
+        self.assertGreater(completions[jobids[0]].max_rss, 0)
+        self.assertGreaterEqual(completions[jobids[0]].elapsed, 1)
+        self.assertIsNone(completions['999'].exit_code)
+
+
+class CountingScheduler(Scheduler):
+    """Scheduler with a fixed queue counting how often it is queried."""
+
+    def __init__(self, config):
+        Scheduler.__init__(self, config)
+        self.queries = 0
+
+    def query_queue(self):
+        self.queries += 1
+        return [QueueJob('1001', 'RUNNING', 1462096800, 1462096860,
+                         300.0, 'vmp101'),
+                QueueJob('1002', 'PENDING', 1462096900, None, 0.0, None)]
+
+
+class TestQueueSnapshot(unittest.TestCase):
+    """Test the shared queue snapshot."""
+
+    def setUp(self):
+        self.config = load_configuration('autocms.cfg')
+
+    def tearDown(self):
+        for path in (queue_snapshot_path(self.config),
+                     queue_latency_path(self.config)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_parse_squeue_output(self):
+        """Test parsing squeue output of the explicit format."""
+        output = ('1001|RUNNING|2016-05-01T10:00:00|2016-05-01T10:01:00|'
+                  '1-00:05:00|vmp101\n'
+                  '1002|PENDING|2016-05-01T10:02:00|N/A|0:00|\n')
+        jobs = SlurmScheduler.parse_squeue_output(output)
+        self.assertEqual([job.jobid for job in jobs], ['1001', '1002'])
+        self.assertEqual(jobs[0].start_time - jobs[0].submit_time, 60)
+        self.assertEqual(jobs[0].elapsed, 86700)
+        self.assertIsNone(jobs[1].start_time)
+        self.assertIsNone(jobs[1].node)
+
+    def test_snapshot_shared(self):
+        """Test that consumers within the TTL share one query."""
+        scheduler = CountingScheduler(self.config)
+        self.assertEqual(scheduler.enqueued_job_count(), 2)
+        snapshot = get_queue_snapshot(scheduler, self.config)
+        self.assertEqual(scheduler.queries, 1)
+        self.assertEqual([job.jobid for job in snapshot.pending()], ['1002'])
+        self.assertEqual(snapshot.running()[0].node, 'vmp101')
+        with open(queue_latency_path(self.config)) as handle:
+            self.assertEqual(len(handle.readlines()), 1)
+        self.config['AUTOCMS_QUEUE_TTL'] = '0'
+        get_queue_snapshot(scheduler, self.config)
+        self.assertEqual(scheduler.queries, 2)
+        invalidate_queue_snapshot(self.config)
+        self.assertIsNone(load_queue_snapshot(self.config))
+
+    def test_purge_queue_latency(self):
+        """Test that latency lines older than the log lifetime are removed."""
+        now = int(time.time())
+        old = now - 3600*24*(int(self.config['AUTOCMS_LOG_LIFETIME']) + 1)
+        with open(queue_latency_path(self.config), 'w') as handle:
+            handle.write('{0} 0.500 3\n{1} 0.250 2\n'.format(old, now))
+        purge_queue_latency(self.config)
+        with open(queue_latency_path(self.config)) as handle:
+            self.assertEqual(handle.read(), '{0} 0.250 2\n'.format(now))
+
+    def test_time_in_state(self):
+        """Test pending and running durations computed from a snapshot."""
+        scheduler = CountingScheduler(self.config)
+        running, pending = scheduler.query_queue()
+        snapshot = QueueSnapshot([running, pending], 1462097000, 0.1)
+        now = 1462097100
+        self.assertEqual(snapshot.time_in_state(pending, now), 200)
+        self.assertEqual(snapshot.time_in_state(running, now), 400)
+        unknown = running._replace(elapsed=None, start_time=None)
+        self.assertIsNone(snapshot.time_in_state(unknown, now))
+
+
+if __name__ == '__main__':
+    unittest.main()
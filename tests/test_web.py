@@ -4,8 +4,15 @@ import os
 import shutil
 import unittest
 import re
+import time
 
 from autocms.core import load_configuration
+from autocms.jobqueue import (
+    QueueJob,
+    QueueSnapshot,
+    invalidate_queue_snapshot,
+    save_queue_snapshot
+)
 # cannot import perform_test_reporting function from autocms.web
 # as nose thinks it is a test
 import autocms.web
@@ -51,6 +58,23 @@ class TestWebPageCreation(unittest.TestCase):
             webpage_contents = webpage.read()
         self.assertTrue(re.search(self.page_description, webpage_contents))
 
+    def test_queue_boxes_from_snapshot(self):
+        """Test that queue boxes use the cached queue snapshot."""
+        jobs = [QueueJob('1001', 'RUNNING', 1000, 1100, 300.0, 'vmp101'),
+                QueueJob('1002', 'PENDING', int(time.time()) - 3600, None,
+                         0.0, None)]
+        save_queue_snapshot(QueueSnapshot(jobs, int(time.time()), 0.5),
+                            self.config)
+        try:
+            webpage = autocms.web.AutoCMSWebpage([], 'uscratch', self.config)
+            webpage.add_currentrunning_jobs(40)
+            webpage.add_currentpending_jobs(40)
+        finally:
+            invalidate_queue_snapshot(self.config)
+        self.assertIn('Job 1001 has been running on vmp101 for 0:05',
+                      webpage.page)
+        self.assertIn('Job 1002 has been pending for 1:00', webpage.page)
+
 
 if __name__ == '__main__':
     unittest.main()